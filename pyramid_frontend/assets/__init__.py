@@ -1,23 +1,54 @@
 from __future__ import absolute_import, print_function, division
 
-from webhelpers2.html.tags import literal
+import logging
+
+import gc
+
+from webhelpers2.html.tags import HTML, literal
+from pyramid.events import ApplicationCreated
 from pyramid.settings import asbool
 
+from .static import PrecompressedStaticView
+from .less import less_view
+from .builds import compiled_root
 
-def asset_tag(request, key, **kwargs):
+log = logging.getLogger(__name__)
+
+
+def compiled_asset_url(theme, key):
+    return '/compiled/' + theme.key + '/' + theme.compiled_asset_path(key)
+
+
+def integrity_attrs(theme, key, crossorigin=None):
     """
-    Request method to render an HTML fragment containing tags which reference
-    the supplied entry point. This will dispatch to the appropriate tag
-    rendering function based on context and entry point type.
+    Return the ``integrity`` and ``crossorigin`` attributes for the compiled
+    file of an entry point, or an empty dict if the build manifest doesn't
+    record an integrity digest for it.
     """
-    theme = request.theme
-    asset = theme.stacked_assets[key]
-    settings = request.registry.settings
-    should_compile = asbool(settings.get('pyramid_frontend.compile'))
+    entry = theme.manifest.get(key)
+    if not entry or not entry.get('integrity'):
+        return {}
+    return {'integrity': entry['integrity'],
+            'crossorigin': crossorigin or 'anonymous'}
+
 
+def should_compile_assets(registry):
+    should_compile = getattr(registry, 'pfe_compile_assets', None)
+    if should_compile is None:
+        should_compile = \
+            asbool(registry.settings.get('pyramid_frontend.compile'))
+    return should_compile
+
+
+def render_asset_tag(theme, key, should_compile, integrity=False,
+                     crossorigin=None, **kwargs):
+    asset = theme.stacked_assets[key]
     if should_compile:
-        filename = theme.compiled_asset_path(key)
-        url_path = '/compiled/' + theme.key + '/' + filename
+        url_path = compiled_asset_url(theme, key)
+        if crossorigin:
+            kwargs['crossorigin'] = crossorigin
+        if integrity:
+            kwargs.update(integrity_attrs(theme, key, crossorigin))
     else:
         url_path = asset.url_path
 
@@ -25,9 +56,147 @@ def asset_tag(request, key, **kwargs):
                              **kwargs))
 
 
+def asset_tag(request, key, **kwargs):
+    """
+    Request method to render an HTML fragment containing tags which reference
+    the supplied entry point. This will dispatch to the appropriate tag
+    rendering function based on context and entry point type.
+
+    Pass ``integrity=True`` to add ``integrity`` and ``crossorigin``
+    attributes to compiled CSS and JS tags, using the digests recorded in the
+    build manifest.
+
+    When assets are compiled, the output for a given theme and entry point
+    never changes, so tags without extra attributes (other than
+    ``integrity`` and ``crossorigin``) are rendered once and memoized on the
+    theme. Tags with other attributes, such as ``alt`` or ``class_``, whose
+    values often vary per request, are rendered on every call.
+    """
+    theme = request.theme
+    should_compile = should_compile_assets(request.registry)
+
+    if not should_compile:
+        return render_asset_tag(theme, key, False, **kwargs)
+
+    integrity = bool(kwargs.pop('integrity', False))
+    crossorigin = kwargs.pop('crossorigin', None)
+    if kwargs:
+        return render_asset_tag(theme, key, True, integrity=integrity,
+                                crossorigin=crossorigin, **kwargs)
+
+    memo_key = (key, integrity, crossorigin)
+    tag = theme._asset_tag_cache.get(memo_key)
+    if tag is None:
+        tag = theme._asset_tag_cache[memo_key] = \
+            render_asset_tag(theme, key, True, integrity=integrity,
+                             crossorigin=crossorigin)
+    return tag
+
+
+def asset_preload(request, *keys, **kwargs):
+    """
+    Request method to render ``<link rel="preload">`` tags for the compiled
+    files of the supplied entry points, and add a corresponding ``Link``
+    header to ``request.response``, so that browsers start fetching them
+    while the page is still being parsed. Pass ``integrity=True`` if the asset
+    tags use it, so that the preloaded responses can be reused. Pass
+    ``header=False`` to skip the header.
+
+    Returns an empty fragment when assets aren't compiled.
+    """
+    integrity = kwargs.pop('integrity', False)
+    crossorigin = kwargs.pop('crossorigin', None)
+    header = kwargs.pop('header', True)
+    assert not kwargs, "unexpected keyword arguments: %r" % list(kwargs)
+
+    if not should_compile_assets(request.registry):
+        return literal('')
+
+    theme = request.theme
+    tags = []
+    links = []
+    for key in keys:
+        asset = theme.stacked_assets[key]
+        if not asset.preload_as:
+            continue
+        url = compiled_asset_url(theme, key)
+        attrs = {'as': asset.preload_as}
+        if crossorigin:
+            attrs['crossorigin'] = crossorigin
+        if integrity:
+            attrs.update(integrity_attrs(theme, key, crossorigin))
+        tags.append(HTML.link(rel='preload', href=url, **attrs))
+        link = '<%s>; rel=preload; as=%s' % (url, asset.preload_as)
+        if 'crossorigin' in attrs:
+            link += '; crossorigin=%s' % attrs['crossorigin']
+        links.append(link)
+
+    if header and links:
+        request.response.headers.add('Link', ', '.join(links))
+    return literal(''.join(tags))
+
+
+def preload_theme_assets(theme):
+    """
+    Look up the compiled file of every entry point of ``theme``, and render
+    its tag without extra attributes into the theme's tag cache, so that
+    requests don't need to read map files or render those tags.
+    """
+    for key in sorted(theme.stacked_assets):
+        try:
+            theme._asset_tag_cache[(key, False, None)] = \
+                render_asset_tag(theme, key, True)
+        except (IOError, OSError) as e:
+            log.warn('Could not preload compiled asset %s/%s: %s',
+                     theme.key, key, e)
+
+
+def preload_assets(event):
+    """
+    Subscriber to ``ApplicationCreated`` which preloads the compiled assets of
+    every theme, when the ``pyramid_frontend.preload_assets`` setting is
+    enabled. This runs in the app factory, so a preforking server (such as
+    gunicorn with ``--preload``) loads them once, before forking workers,
+    which then share the lookups copy-on-write.
+
+    If the ``pyramid_frontend.gc_freeze`` setting is also enabled, on Python
+    3.7+ every object in the process is then moved out of the garbage
+    collector's reach with ``gc.freeze()``, so that collections in the
+    workers don't write to, and so unshare, their pages. This affects the
+    whole process, so it is off by default.
+    """
+    registry = event.app.registry
+    if not should_compile_assets(registry):
+        return
+    settings = registry.settings
+    themes = settings.get('pyramid_frontend.theme_registry', {})
+    for theme in themes.values():
+        preload_theme_assets(theme)
+    log.info('Preloaded compiled assets of %d themes', len(themes))
+    if asbool(settings.get('pyramid_frontend.gc_freeze')) and \
+            hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
 def includeme(config):
     config.add_request_method(asset_tag, 'asset_tag')
+    config.add_request_method(asset_preload, 'asset_preload')
+
+    settings = config.registry.settings
+    config.registry.pfe_compile_assets = \
+        asbool(settings.get('pyramid_frontend.compile'))
+
+    compiled_path = compiled_root(settings)
+    if asbool(settings.get('pyramid_frontend.serve_precompressed')):
+        config.add_route('pfe_compiled', '/compiled/*subpath')
+        config.add_view(PrecompressedStaticView(compiled_path),
+                        route_name='pfe_compiled')
+    else:
+        config.add_static_view(name='compiled', path=compiled_path)
+
+    if asbool(settings.get('pyramid_frontend.serve_less')):
+        config.add_route('pfe_less', '/_pfe_less/{theme}/*subpath')
+        config.add_view(less_view, route_name='pfe_less')
 
-    compiled_path = \
-        config.registry.settings['pyramid_frontend.compiled_asset_dir']
-    config.add_static_view(name='compiled', path=compiled_path)
+    if asbool(settings.get('pyramid_frontend.preload_assets')):
+        config.add_subscriber(preload_assets, ApplicationCreated)
@@ -7,19 +7,137 @@ import tempfile
 import time
 import subprocess
 import io
+import gzip
+import hashlib
+import threading
 
 from contextlib import contextmanager
-from hashlib import sha1
 
 import six
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .daemon import get_compiler, CompilerUnavailable, CompilerDaemonError
+from .sourcemap import encode_map
+
 log = logging.getLogger(__name__)
 
 
+_tool_versions = {}
+
+
+def tool_version(argv):
+    """
+    Return the version string output by running ``argv``, or ``None`` if the
+    command fails. Results are cached for the life of the process.
+    """
+    argv = tuple(argv)
+    if argv not in _tool_versions:
+        try:
+            output = subprocess.check_output(argv, stderr=subprocess.STDOUT)
+            _tool_versions[argv] = output.decode('utf-8', 'replace').strip()
+        except (OSError, subprocess.CalledProcessError):
+            _tool_versions[argv] = None
+    return _tool_versions[argv]
+
+
+# The size of the chunks which compiled files are read and hashed in.
+chunk_size = 64 * 1024
+
+
+def read_chunks(f, size=chunk_size):
+    """
+    Iterate over a binary file object in chunks of ``size`` bytes.
+    """
+    return iter(lambda: f.read(size), b'')
+
+
+def temp_path_for(path):
+    """
+    Return the path of a temporary file to write before renaming it to
+    ``path``, which is unique to this process and thread.
+    """
+    return '%s.%d.%d.tmp' % (path, os.getpid(),
+                             threading.current_thread().ident)
+
+
+def has_size(path, size):
+    """
+    Return whether the file at ``path`` exists and is ``size`` bytes long.
+    """
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
+
+
+def write_atomic(path, data):
+    """
+    Write a bytestring to a file by writing a temporary file and renaming it
+    into place, so that readers never see a partially written file, and a
+    file which is hard-linked into another build is replaced rather than
+    modified.
+    """
+    temp_path = temp_path_for(path)
+    with io.open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+def gzip_compress(data):
+    """
+    Compress a bytestring with gzip at the maximum compression level. The
+    output does not include a timestamp, so it is reproducible.
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def brotli_compress(data):
+    """
+    Compress a bytestring with brotli at the maximum compression level.
+    """
+    return brotli.compress(data, quality=11)
+
+
+def precompressors():
+    """
+    Return a list of ``(extension, compress)`` pairs for the precompressed
+    variants which should be written alongside compiled assets. Brotli is
+    only used if the ``brotli`` package is installed.
+    """
+    compressors = [('.gz', gzip_compress)]
+    if brotli:
+        compressors.append(('.br', brotli_compress))
+    return compressors
+
+
 class Asset(object):
     """
     Generic superclass for other asset handler classes to inherit from.
     """
+    # Whether to write gzip and brotli compressed copies of compiled files.
+    precompress = True
+    # The type of content to preload compiled files as, for
+    # <link rel="preload" as="...">, or None if they shouldn't be preloaded.
+    preload_as = None
+    # The comment appended to compiled files to reference their source map.
+    source_map_comment = u'/*# sourceMappingURL=%s */'
+    # The hashlib algorithm used to fingerprint compiled file names, and the
+    # number of hex digits of the digest to keep, or None to keep them all.
+    # For example, 'blake2b' and 16 for short names which are fast to hash.
+    hash_algorithm = 'sha1'
+    hash_length = None
+    # Attributes, generally set on the class, which affect the compiled file
+    # or its name. See theme_options().
+    output_attributes = ('extension', 'hash_algorithm', 'hash_length',
+                         'precompress', 'source_map', 'source_map_comment')
 
     def __init__(self, url_path):
         self.url_path = url_path
@@ -39,6 +157,58 @@ class Asset(object):
         elapsed_time = time.time() - start_time
         log.debug('Command completed in %0.4f seconds.', elapsed_time)
 
+    def pipe_command(self, argv, data):
+        """
+        Run a shell command with ``data`` (a bytestring) on its standard input,
+        and return its standard output as a bytestring.
+        """
+        log.debug('Piping %d bytes through command: %s ...', len(data),
+                  ' '.join(argv))
+        start_time = time.time()
+        proc = subprocess.Popen(argv,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output, errors = proc.communicate(data)
+        if proc.returncode:
+            log.error(errors)
+            raise subprocess.CalledProcessError(proc.returncode, argv,
+                                                output=errors)
+        elapsed_time = time.time() - start_time
+        log.debug('Command completed in %0.4f seconds.', elapsed_time)
+        return output
+
+    def run_pipeline(self, stages, data):
+        """
+        Pass ``data`` (a bytestring) through each command in ``stages`` in
+        turn, using ``pipe_command()``, and return the final output.
+        """
+        for argv in stages:
+            data = self.pipe_command(argv, data)
+        return data
+
+    def run_compiler(self, type, **params):
+        """
+        Run a job on the active compiler worker pool, and return its output.
+        Returns ``None`` if no compiler worker is available, in which case the
+        caller should fall back to ``run_command()``.
+        """
+        compiler = get_compiler()
+        if compiler is None:
+            return None
+        log.debug('Running %s job on compiler worker ...', type)
+        start_time = time.time()
+        try:
+            output = compiler.request(type, **params)
+        except CompilerUnavailable:
+            return None
+        except CompilerDaemonError as e:
+            log.error(e)
+            raise
+        elapsed_time = time.time() - start_time
+        log.debug('Job completed in %0.4f seconds.', elapsed_time)
+        return output
+
     def write(self, key, contents, entry_point, output_dir):
         """
         Write the compiled result for a particular entry point to the
@@ -47,36 +217,189 @@ class Asset(object):
         The ``contents`` field should always be a unicode type (str on 3.x).
         """
         assert isinstance(contents, six.text_type)
+        return self.write_bytes(key, contents.encode('utf-8'), entry_point,
+                                output_dir)
+
+    def new_hash(self):
+        """
+        Return a new hash object for fingerprinting compiled files.
+        """
+        return hashlib.new(self.hash_algorithm)
+
+    def hashed_file_name(self, entry_point, h):
+        """
+        Return the name of the compiled file for ``entry_point``, given the
+        hash object of its contents.
+        """
+        digest = h.hexdigest()
+        if self.hash_length:
+            digest = digest[:self.hash_length]
+        return u'{name}-{hash}.{ext}'.format(
+            name=os.path.basename(entry_point), hash=digest,
+            ext=self.extension)
+
+    def write_bytes(self, key, data, entry_point, output_dir,
+                    source_map=None):
+        """
+        Like ``write()``, but takes the compiled result as an already encoded
+        bytestring, which is hashed and written as-is. If a file with the
+        same name and size already exists, it isn't rewritten.
+
+        If a ``source_map`` dict is supplied, it is written alongside the
+        compiled file, with the same name plus ``.map``, and referenced by a
+        ``sourceMappingURL`` comment appended to the compiled file. The map is
+        included in the hash, so a changed map is never served with a cached
+        compiled file.
+        """
+        assert isinstance(data, six.binary_type)
         log.debug('Write - key: %r, entry_point: %r', key, entry_point)
-        hash = sha1(contents.encode('utf-8')).hexdigest()
+        h = self.new_hash()
+        h.update(data)
+        if source_map is not None:
+            source_map.pop('file', None)
+            h.update(encode_map(source_map))
 
-        name = os.path.basename(entry_point)
-        file_name = u'{name}-{hash}.{ext}'.format(
-            name=name, hash=hash, ext=self.extension)
+        file_name = self.hashed_file_name(entry_point, h)
         file_path = os.path.join(output_dir, file_name)
 
         if not os.path.isdir(output_dir):
             os.makedirs(output_dir)
 
-        log.debug('Writing to %s ...', file_path)
-        with io.open(file_path, 'w', encoding='utf8') as f:
-            f.write(contents)
+        if source_map is not None:
+            source_map['file'] = file_name
+            comment = self.source_map_comment % (file_name + u'.map')
+            data = data.rstrip(b'\n') + b'\n' + comment.encode('utf-8')
+        unchanged = has_size(file_path, len(data))
 
-        map_path = os.path.join(output_dir, key + '.map')
-        log.debug('Writing map file to %s ...', map_path)
-        with io.open(map_path, 'w') as f:
-            f.write(file_name)
+        if source_map is not None:
+            map_path = file_path + '.map'
+            if not (unchanged and os.path.exists(map_path)):
+                log.debug('Writing source map to %s ...', map_path)
+                write_atomic(map_path, encode_map(source_map))
+
+        if unchanged:
+            log.debug('%s is unchanged, not rewriting it.', file_path)
+        else:
+            log.debug('Writing to %s ...', file_path)
+            write_atomic(file_path, data)
+        self.write_compressed(file_path, data)
+
+        self.write_map(key, file_name, output_dir)
+        return file_path
+
+    def write_stream(self, key, chunks, entry_point, output_dir):
+        """
+        Like ``write_bytes()``, but takes the compiled result as an iterable
+        of bytestring chunks, which are hashed as they're written to a
+        temporary file, so that a large compiled file is never held in memory
+        at once. The temporary file is then renamed to the hashed file name,
+        or discarded if a file with that name and size already exists.
+        """
+        log.debug('Write stream - key: %r, entry_point: %r', key,
+                  entry_point)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
 
+        h = self.new_hash()
+        size = 0
+        temp_path = temp_path_for(os.path.join(output_dir, key))
+        try:
+            with io.open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            file_name = self.hashed_file_name(entry_point, h)
+            file_path = os.path.join(output_dir, file_name)
+            if has_size(file_path, size):
+                log.debug('%s is unchanged, not rewriting it.', file_path)
+                os.remove(temp_path)
+            else:
+                log.debug('Writing to %s ...', file_path)
+                os.rename(temp_path, file_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.write_compressed(file_path)
+
+        self.write_map(key, file_name, output_dir)
         return file_path
 
+    def write_compressed(self, file_path, data=None):
+        """
+        Write precompressed copies of a compiled file alongside it (e.g.
+        ``main-<hash>.css.gz``), so that they can be served without
+        compressing on every request. Copies which already exist are left
+        alone. If ``data`` is not supplied, the compiled file is read only if
+        a copy needs to be written.
+        """
+        if not self.precompress:
+            return
+        for ext, compress in precompressors():
+            out_path = file_path + ext
+            if os.path.exists(out_path):
+                continue
+            if data is None:
+                with io.open(file_path, 'rb') as f:
+                    data = f.read()
+            log.debug('Writing to %s ...', out_path)
+            write_atomic(out_path, compress(data))
+
+    def sidecar_paths(self, file_path):
+        """
+        Return the paths of the files which may be written alongside the
+        compiled file ``file_path``, such as its source map and precompressed
+        copies. They are reused along with the compiled file when it is
+        linked into another theme or build.
+        """
+        return ([file_path + '.map'] +
+                [file_path + ext for ext, compress in precompressors()])
+
+    def write_map(self, key, file_name, output_dir):
+        """
+        Write the map file which points an entry point key to its compiled
+        file name. The file is replaced atomically, so that a running process
+        never reads a partially written map file.
+        """
+        map_path = os.path.join(output_dir, key + '.map')
+        log.debug('Writing map file to %s ...', map_path)
+        write_atomic(map_path, six.text_type(file_name).encode('utf-8'))
+
     def write_from_file(self, key, file_name, entry_point, output_dir):
         """
         Like ``write()``, but writes from a source file instead of a buffer
-        variable.
+        variable. The file is streamed with ``write_stream()``.
+        """
+        with io.open(file_name, 'rb') as f:
+            return self.write_stream(key, read_chunks(f), entry_point,
+                                     output_dir)
+
+    def dependencies(self, theme):
+        """
+        Return a list of the filesystem paths of all input files which the
+        compiled output for ``theme`` depends on. Used to decide whether an
+        asset needs to be recompiled.
+        """
+        return [theme.static_url_to_filesystem_path(self.url_path)]
+
+    def theme_options(self, theme):
         """
-        with io.open(file_name, encoding='utf8') as f:
-            contents = f.read()
-        return self.write(key, contents, entry_point, output_dir)
+        Return a JSON-serializable value of any options derived from ``theme``
+        (other than the contents of input files) which affect the compiled
+        output. The default is the values of ``output_attributes``, since
+        class attributes aren't part of an asset's own configuration, so
+        subclasses which extend this should include it.
+        """
+        return [(name, getattr(self, name, None))
+                for name in self.output_attributes]
+
+    def tool_versions(self):
+        """
+        Return a dict mapping the external tools used to compile this asset to
+        their version strings.
+        """
+        return {}
 
     @contextmanager
     def tempfile(self, *args, **kwargs):
@@ -89,8 +412,12 @@ class Asset(object):
         finally:
             f.close()
 
-    def tag(self, theme, url, production=True):
+    def tag(self, theme, url, production=True, **attrs):
+        """
+        Return an HTML fragment to use this entry point. Extra attributes
+        for the tag (such as ``integrity``) are only used in production.
+        """
         if production:
-            return self.tag_production(theme, url)
+            return self.tag_production(theme, url, **attrs)
         else:
             return self.tag_development(theme, url)
@@ -0,0 +1,167 @@
+"""
+Versioned compiled asset builds. When the ``pyramid_frontend.versioned_builds``
+setting is enabled, each run of ``pcompile`` writes into a new directory::
+
+    <compiled asset dir>/builds/<build id>/<theme key>/...
+    <compiled asset dir>/builds/<build id>/manifest.json
+
+and, once every asset has compiled, atomically points the
+``<compiled asset dir>/current`` symlink at it, so that running processes
+never see a partially written build. Compiled assets are served from, and
+looked up in, ``current``. Only the newest ``pyramid_frontend.keep_builds``
+builds are kept.
+"""
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import shutil
+import datetime
+
+from pyramid.settings import asbool
+
+log = logging.getLogger(__name__)
+
+
+def versioned_builds(settings):
+    return asbool(settings.get('pyramid_frontend.versioned_builds'))
+
+
+def keep_builds(settings):
+    return int(settings.get('pyramid_frontend.keep_builds', 5))
+
+
+def compiled_root(settings):
+    """
+    Return the directory which compiled assets are served from: the current
+    build if builds are versioned, otherwise the compiled asset dir itself.
+    """
+    root = settings['pyramid_frontend.compiled_asset_dir']
+    if versioned_builds(settings):
+        return os.path.join(root, 'current')
+    return root
+
+
+def builds_dir(root):
+    return os.path.join(root, 'builds')
+
+
+def list_builds(root):
+    """
+    Return the IDs of the builds in ``root``, oldest first.
+    """
+    try:
+        return sorted(os.listdir(builds_dir(root)))
+    except OSError:
+        return []
+
+
+def current_build(root):
+    """
+    Return the ID of the build which ``current`` points to, or ``None``.
+    """
+    try:
+        target = os.readlink(os.path.join(root, 'current'))
+    except OSError:
+        return None
+    return os.path.basename(os.path.normpath(target))
+
+
+def start_build(root):
+    """
+    Create the directory for a new build, and return its path. Build IDs are
+    UTC timestamps, so they sort in the order they were started.
+    """
+    build_id = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    build_dir = os.path.join(builds_dir(root), build_id)
+    os.makedirs(build_dir)
+    log.info('Starting build %s', build_id)
+    return build_dir
+
+
+def link_file(src, dest):
+    """
+    Hard-link ``src`` to ``dest`` (or copy it, if that isn't possible), if
+    ``src`` exists and ``dest`` doesn't.
+    """
+    if not os.path.exists(src) or os.path.exists(dest):
+        return
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def seed_build(previous_dir, build_dir, manifest, themes):
+    """
+    Hard-link the compiled files of a previous build which are listed in its
+    ``manifest``, along with their map files and the files written alongside
+    them (see ``Asset.sidecar_paths()``), into a new build, so that unchanged
+    assets don't need to be recompiled. ``themes`` maps theme keys to themes.
+    Files which are no longer in use are left behind, and removed along with
+    the old build.
+    """
+    for theme_key, entries in (manifest or {}).items():
+        theme = themes.get(theme_key)
+        src_dir = os.path.join(previous_dir, theme_key)
+        dest_dir = os.path.join(build_dir, theme_key)
+        if theme is None or not os.path.isdir(src_dir):
+            continue
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        for key, entry in entries.items():
+            asset = theme.stacked_assets.get(key)
+            if asset is None:
+                continue
+            src = os.path.join(src_dir, entry['file'])
+            paths = ([src, os.path.join(src_dir, key + '.map')] +
+                     asset.sidecar_paths(src))
+            for path in paths:
+                link_file(path, os.path.join(dest_dir,
+                                             os.path.basename(path)))
+
+
+def activate_build(root, build_dir):
+    """
+    Atomically point the ``current`` symlink in ``root`` at ``build_dir``.
+    """
+    link_path = os.path.join(root, 'current')
+    temp_path = '%s.%d.tmp' % (link_path, os.getpid())
+    target = os.path.relpath(build_dir, root)
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(target, temp_path)
+    os.rename(temp_path, link_path)
+    log.warn('Activated build %s', os.path.basename(build_dir))
+
+
+def prune_builds(root, keep):
+    """
+    Remove all but the newest ``keep`` builds in ``root``, and never the
+    current build. Returns the IDs of the removed builds.
+    """
+    current = current_build(root)
+    builds = list_builds(root)
+    removed = []
+    for build_id in builds[:max(len(builds) - keep, 0)]:
+        if build_id == current:
+            continue
+        log.info('Removing build %s', build_id)
+        shutil.rmtree(os.path.join(builds_dir(root), build_id))
+        removed.append(build_id)
+    return removed
+
+
+def rollback(root):
+    """
+    Point ``current`` at the build before the current one, and return its
+    ID. Raises ``ValueError`` if there is no earlier build.
+    """
+    current = current_build(root)
+    builds = list_builds(root)
+    if current not in builds or builds.index(current) == 0:
+        raise ValueError('no build to roll back to')
+    previous = builds[builds.index(current) - 1]
+    activate_build(root, os.path.join(builds_dir(root), previous))
+    return previous
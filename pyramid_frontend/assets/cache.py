@@ -0,0 +1,124 @@
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import io
+import json
+import threading
+from hashlib import sha1
+
+import six
+
+log = logging.getLogger(__name__)
+
+
+class BuildCache(object):
+    """
+    Records a fingerprint of the inputs of each compiled asset, so that assets
+    whose inputs have not changed since the last build can be skipped.
+
+    A fingerprint covers the content of every input file reported by
+    ``Asset.dependencies()``, the versions of the external tools used, the
+    asset's configuration (its public instance attributes) and any
+    theme-specific options, and the ``minify`` flag. It does not include the
+    theme itself, so identical assets in different themes share a
+    fingerprint. The cache is stored as a
+    JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_hashes = {}
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with io.open(path, encoding='utf8') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                log.warn('Ignoring corrupt build cache %s', path)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def file_hash(self, path):
+        """
+        Return the SHA-1 of a file's contents, or ``None`` if it does not
+        exist. Hashes are memoized by path, size and modification time for the
+        life of the cache object, since inputs are commonly shared between
+        entry points.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        memo_key = (path, st.st_size, st.st_mtime)
+        digest = self.file_hashes.get(memo_key)
+        if digest is None:
+            h = sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+            digest = self.file_hashes[memo_key] = h.hexdigest()
+        return digest
+
+    def fingerprint(self, theme, asset, minify):
+        """
+        Return a hex digest which changes whenever the compiled output of
+        ``asset`` for ``theme`` could change.
+        """
+        inputs = []
+        for path in asset.dependencies(theme):
+            if path not in inputs:
+                inputs.append(path)
+        data = {
+            'asset': '%s.%s' % (asset.__class__.__module__,
+                                asset.__class__.__name__),
+            'config': sorted((k, repr(v)) for k, v in vars(asset).items()
+                             if not k.startswith('_')),
+            'theme': asset.theme_options(theme),
+            'tools': sorted(asset.tool_versions().items()),
+            'minify': bool(minify),
+            'inputs': [(path, self.file_hash(path)) for path in inputs],
+        }
+        encoded = json.dumps(data, sort_keys=True).encode('utf-8')
+        return sha1(encoded).hexdigest()
+
+    def lookup(self, theme, key, fingerprint):
+        """
+        Return the compiled file name recorded for ``key`` in ``theme`` if its
+        fingerprint matches and the compiled file still exists, otherwise
+        ``None``.
+        """
+        with self.lock:
+            entry = self.entries.get('%s/%s' % (theme.key, key))
+        if not entry or entry['fingerprint'] != fingerprint:
+            return None
+        file_name = entry['file_name']
+        if not os.path.exists(os.path.join(theme.compiled_asset_dir,
+                                           file_name)):
+            return None
+        return file_name
+
+    def record(self, theme, key, fingerprint, file_path):
+        with self.lock:
+            self.entries['%s/%s' % (theme.key, key)] = {
+                'fingerprint': fingerprint,
+                'file_name': os.path.basename(file_path),
+            }
+
+    def save(self):
+        """
+        Atomically write the cache file.
+        """
+        dirpath = os.path.dirname(self.path)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with self.lock:
+            encoded = json.dumps(self.entries, indent=2, sort_keys=True)
+        with io.open(temp_path, 'w', encoding='utf8') as f:
+            f.write(six.text_type(encoded))
+        os.rename(temp_path, self.path)
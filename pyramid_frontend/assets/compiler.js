@@ -0,0 +1,109 @@
+/*
+ * Long-lived asset compiler worker, used by pcompile to avoid starting a new
+ * Node process for every LESS and RequireJS entry point.
+ *
+ * Reads one JSON request per line on stdin, and writes one JSON response per
+ * line on stdout. Requests are handled one at a time, in order.
+ *
+ * Requests:
+ *
+ *   {"id": 1, "type": "less", "source": "...", "minify": true,
+ *    "autoprefix": true, "sourceMap": false}
+ *   {"id": 2, "type": "requirejs", "config": {...}, "sourceMap": false}
+ *   {"id": 3, "type": "ping"}
+ *
+ * With "sourceMap", LESS output has an inline source map comment, and
+ * RequireJS output is an object with the code and the source map.
+ *
+ * Responses:
+ *
+ *   {"id": 1, "ok": true, "output": "..."}
+ *   {"id": 2, "ok": true, "output": {"code": "...", "map": "..."}}
+ *   {"id": 1, "ok": false, "error": "..."}
+ */
+'use strict';
+
+var readline = require('readline');
+
+var modules = {};
+
+function load(name) {
+  if (!modules[name]) {
+    modules[name] = require(name);
+  }
+  return modules[name];
+}
+
+function compileLess(request) {
+  var less = load('less');
+  var options = {compress: !!request.minify};
+  if (request.sourceMap) {
+    options.sourceMap = {sourceMapFileInline: true};
+  }
+  return less.render(request.source, options).then(function (result) {
+    if (!request.autoprefix) {
+      return result.css;
+    }
+    var postcss = load('postcss');
+    var autoprefixer = load('autoprefixer');
+    return postcss([autoprefixer]).process(result.css, {
+      from: undefined,
+      map: request.sourceMap ? {inline: true} : false
+    }).then(function (prefixed) {
+      return prefixed.css;
+    });
+  });
+}
+
+function compileRequireJS(request) {
+  var requirejs = load('requirejs');
+  return new Promise(function (resolve, reject) {
+    var config = request.config;
+    var output = null;
+    config.out = function (text, sourceMapText) {
+      output = request.sourceMap ? {code: text, map: sourceMapText} : text;
+    };
+    config.logLevel = 4;
+    requirejs.optimize(config, function () {
+      resolve(output);
+    }, reject);
+  });
+}
+
+var handlers = {
+  less: compileLess,
+  requirejs: compileRequireJS,
+  ping: function () {
+    // Fail early if any of the compiler packages are missing.
+    ['less', 'postcss', 'autoprefixer', 'requirejs'].forEach(load);
+    return Promise.resolve('pong');
+  }
+};
+
+function respond(response) {
+  process.stdout.write(JSON.stringify(response) + '\n');
+}
+
+var queue = Promise.resolve();
+
+readline.createInterface({input: process.stdin}).on('line', function (line) {
+  var request;
+  try {
+    request = JSON.parse(line);
+  } catch (e) {
+    respond({id: null, ok: false, error: 'invalid request: ' + e.message});
+    return;
+  }
+  queue = queue.then(function () {
+    var handler = handlers[request.type];
+    if (!handler) {
+      throw new Error('unknown request type: ' + request.type);
+    }
+    return handler(request);
+  }).then(function (output) {
+    respond({id: request.id, ok: true, output: output});
+  }, function (err) {
+    respond({id: request.id, ok: false, error: String(err && err.stack ||
+                                                      err)});
+  });
+});
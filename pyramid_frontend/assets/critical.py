@@ -0,0 +1,148 @@
+"""
+Approximate "critical CSS" extraction: select the rules of a stylesheet which
+apply to the first elements of a set of representative rendered pages, so that
+they can be inlined, and the full stylesheet loaded without blocking
+rendering.
+
+This does not lay out the page, so "above the fold" is approximated by the
+first ``max_elements`` elements in the ``<body>`` of each page. A selector is
+considered to match if every tag name, class and ID it mentions is used by
+one of those elements (combinators, attribute selectors and pseudo-classes
+are ignored), which errs on the side of including rules.
+"""
+from __future__ import absolute_import, print_function, division
+
+import re
+
+from six.moves.html_parser import HTMLParser
+
+
+class DocumentSelectors(HTMLParser):
+    """
+    Collects the tag names, classes and IDs used by the first
+    ``max_elements`` elements in the body of an HTML document.
+    """
+
+    def __init__(self, max_elements=200):
+        HTMLParser.__init__(self)
+        self.max_elements = max_elements
+        self.count = 0
+        self.in_body = False
+        self.tags = set(['html', 'body'])
+        self.classes = set()
+        self.ids = set()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body':
+            self.in_body = True
+            return
+        if not self.in_body or self.count >= self.max_elements:
+            return
+        self.count += 1
+        self.tags.add(tag.lower())
+        for name, value in attrs:
+            if name == 'class' and value:
+                self.classes.update(value.split())
+            elif name == 'id' and value:
+                self.ids.add(value)
+
+    def feed_document(self, html):
+        # Treat fragments without a <body> tag as body content.
+        if '<body' not in html.lower():
+            self.in_body = True
+        self.feed(html)
+        self.close()
+        self.in_body = False
+        self.count = 0
+
+
+comment_re = re.compile(r'/\*.*?\*/', re.S)
+ignored_re = re.compile(r'\[[^\]]*\]|::?[\w-]+(\([^)]*\))?|\*')
+simple_re = re.compile(r'([.#]?)(-?[_a-zA-Z][\w-]*)')
+
+
+def split_blocks(css):
+    """
+    Split a stylesheet into a list of top-level ``(prelude, body)`` pairs,
+    where ``body`` is ``None`` for statements such as ``@import``.
+    """
+    css = comment_re.sub('', css)
+    blocks = []
+    start = 0
+    depth = 0
+    body_start = None
+    quote = None
+    for ii, c in enumerate(css):
+        if quote:
+            if c == quote and css[ii - 1] != '\\':
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '{':
+            if depth == 0:
+                body_start = ii + 1
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                blocks.append((css[start:body_start - 1].strip(),
+                               css[body_start:ii]))
+                start = ii + 1
+        elif c == ';' and depth == 0:
+            blocks.append((css[start:ii].strip(), None))
+            start = ii + 1
+    return blocks
+
+
+def selector_matches(selector, doc):
+    """
+    Return whether every tag name, class and ID in ``selector`` is used in
+    the document summarized by a ``DocumentSelectors``.
+    """
+    selector = ignored_re.sub(' ', selector)
+    for prefix, name in simple_re.findall(selector):
+        if prefix == '.':
+            if name not in doc.classes:
+                return False
+        elif prefix == '#':
+            if name not in doc.ids:
+                return False
+        elif name.lower() not in doc.tags:
+            return False
+    return True
+
+
+def extract_rules(css, docs):
+    out = []
+    for prelude, body in split_blocks(css):
+        if body is None:
+            if prelude.startswith(('@import', '@charset')):
+                out.append(prelude + ';')
+        elif prelude.startswith(('@media', '@supports')):
+            inner = extract_rules(body, docs)
+            if inner:
+                out.append('%s{%s}' % (prelude, inner))
+        elif prelude.startswith('@'):
+            # @font-face, @keyframes, etc. are left to the full stylesheet.
+            continue
+        else:
+            selectors = [sel.strip() for sel in prelude.split(',')]
+            matched = [sel for sel in selectors
+                       if any(selector_matches(sel, doc) for doc in docs)]
+            if matched:
+                out.append('%s{%s}' % (','.join(matched), body.strip()))
+    return ''.join(out)
+
+
+def extract_critical(css, documents, max_elements=200):
+    """
+    Return the rules of the stylesheet ``css`` (a unicode string) which are
+    needed to render the first ``max_elements`` elements of any of the HTML
+    ``documents``.
+    """
+    docs = []
+    for html in documents:
+        doc = DocumentSelectors(max_elements)
+        doc.feed_document(html)
+        docs.append(doc)
+    return extract_rules(css, docs)
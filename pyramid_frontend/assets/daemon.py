@@ -0,0 +1,206 @@
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import json
+import threading
+import subprocess
+import pkg_resources
+
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+
+script_path = pkg_resources.resource_filename('pyramid_frontend.assets',
+                                              'compiler.js')
+
+
+class CompilerUnavailable(Exception):
+    """
+    Raised when the compiler worker can't be started or has died. Callers
+    should fall back to running the one-shot command line tools.
+    """
+
+
+class CompilerDaemonError(Exception):
+    """
+    Raised when the compiler worker reports that compilation failed.
+    """
+
+
+def global_node_modules(npm_path='npm'):
+    """
+    Return the directory where npm installs global packages, or ``None``.
+    """
+    try:
+        output = subprocess.check_output([npm_path, 'root', '-g'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf-8').strip()
+
+
+class CompilerDaemon(object):
+    """
+    A long-lived Node process which compiles LESS and RequireJS entry points
+    using the ``less``, ``autoprefixer`` and ``requirejs`` npm packages,
+    speaking a JSON-lines protocol over stdin and stdout. See
+    ``compiler.js``.
+    """
+
+    def __init__(self, node_path='node', node_modules=None,
+                 script_path=script_path):
+        self.node_path = node_path
+        self.node_modules = node_modules
+        self.script_path = script_path
+        self.proc = None
+        self.counter = 0
+
+    def start(self):
+        env = os.environ.copy()
+        node_modules = self.node_modules or global_node_modules()
+        if node_modules:
+            paths = [node_modules]
+            if env.get('NODE_PATH'):
+                paths.append(env['NODE_PATH'])
+            env['NODE_PATH'] = os.pathsep.join(paths)
+        log.debug('Starting compiler worker: %s %s', self.node_path,
+                  self.script_path)
+        try:
+            self.proc = subprocess.Popen([self.node_path, self.script_path],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         env=env,
+                                         close_fds=True)
+        except OSError as e:
+            raise CompilerUnavailable('could not start %s: %s' %
+                                      (self.node_path, e))
+        try:
+            self.request('ping')
+        except CompilerDaemonError as e:
+            self.close()
+            raise CompilerUnavailable(str(e))
+
+    def request(self, type, **params):
+        """
+        Send a request to the worker and return its output.
+        """
+        if self.proc is None:
+            raise CompilerUnavailable('compiler worker is not running')
+        self.counter += 1
+        params['id'] = self.counter
+        params['type'] = type
+        line = json.dumps(params) + '\n'
+        try:
+            self.proc.stdin.write(line.encode('utf-8'))
+            self.proc.stdin.flush()
+            response = self.proc.stdout.readline()
+        except (IOError, OSError) as e:
+            self.close()
+            raise CompilerUnavailable('compiler worker failed: %s' % e)
+        if not response:
+            self.close()
+            raise CompilerUnavailable('compiler worker exited')
+        response = json.loads(response.decode('utf-8'))
+        assert response['id'] == params['id'], \
+            "compiler worker response out of order"
+        if not response['ok']:
+            raise CompilerDaemonError(response['error'])
+        return response['output']
+
+    def close(self):
+        if self.proc:
+            proc = self.proc
+            self.proc = None
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            proc.wait()
+
+
+class CompilerPool(object):
+    """
+    A pool of up to ``size`` compiler workers, started on demand, so that
+    concurrent compile jobs don't wait for each other. If a worker can't be
+    started, the pool is marked unavailable, and every subsequent request
+    raises ``CompilerUnavailable`` immediately.
+    """
+
+    def __init__(self, size=1, **daemon_kwargs):
+        self.size = size
+        self.daemon_kwargs = daemon_kwargs
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.available = True
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                if not self.available:
+                    raise CompilerUnavailable('compiler workers unavailable')
+                should_start = self.started < self.size
+                if should_start:
+                    self.started += 1
+            if should_start:
+                break
+            # Re-check periodically, in case a busy worker dies.
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+        daemon = CompilerDaemon(**self.daemon_kwargs)
+        try:
+            daemon.start()
+        except Exception:
+            with self.lock:
+                self.available = False
+                self.started -= 1
+            daemon.close()
+            log.warn('Compiler worker unavailable, falling back to command '
+                     'line tools.')
+            raise CompilerUnavailable('could not start compiler worker')
+        return daemon
+
+    def request(self, type, **params):
+        daemon = self.acquire()
+        try:
+            return daemon.request(type, **params)
+        finally:
+            if daemon.proc:
+                self.idle.put(daemon)
+            else:
+                with self.lock:
+                    self.started -= 1
+
+    def close(self):
+        while True:
+            try:
+                daemon = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            daemon.close()
+
+
+# The compiler pool in use by the current compile run, if any.
+active_compiler = None
+
+
+def get_compiler():
+    """
+    Return the active ``CompilerPool``, or ``None`` if assets should be
+    compiled with the one-shot command line tools.
+    """
+    return active_compiler
+
+
+def set_compiler(compiler):
+    global active_compiler
+    active_compiler = compiler
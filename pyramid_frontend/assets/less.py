@@ -1,14 +1,45 @@
 from __future__ import absolute_import, print_function, division
 
+import logging
+
 import os
 import re
 import io
+import threading
+import collections
+
+from hashlib import sha1
 
-from webhelpers2.html.tags import HTML
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+from pyramid.settings import asbool
+from webhelpers2.html.tags import HTML, literal
 
 import six
 
-from .asset import Asset
+from .asset import Asset, tool_version, write_atomic
+from .critical import extract_critical
+from .sourcemap import extract_inline_map, remap_concatenated
+
+log = logging.getLogger(__name__)
+
+
+class ImportCycleError(Exception):
+    """
+    Raised when LESS files ``@import`` each other in a cycle.
+    """
+
+
+# Parsed LESS files, shared by all LessAsset instances, least recently used
+# first. See LessAsset.parse().
+parsed_files = collections.OrderedDict()
+parsed_files_lock = threading.Lock()
+max_parsed_files = 2000
+
+# CSS compiled for development, keyed by theme key and URL path. See
+# LessAsset.compile_development().
+compiled_css = {}
+compiled_css_lock = threading.Lock()
 
 
 class LessAsset(Asset):
@@ -16,52 +47,245 @@ class LessAsset(Asset):
     Asset handler for LESS CSS files. In production, autoprefixer is used.
     """
     extension = 'css'
+    preload_as = 'style'
 
     import_re = re.compile(r'@import[ ]+"(?P<path>.*)";')
+    line_re = re.compile(r'[^\n]*\n|[^\n]+')
 
     def __init__(self, url_path,
                  less_path='/_pfe/less.js',
                  lessc_path='lessc',
-                 autoprefixer_path='autoprefixer'):
+                 autoprefixer_path='autoprefixer',
+                 critical_templates=None,
+                 critical_elements=200,
+                 source_map=False):
         self.url_path = url_path
         self.less_path = less_path
         self.lessc_path = lessc_path
         self.autoprefixer_path = autoprefixer_path
+        self.critical_templates = critical_templates
+        self.critical_elements = critical_elements
+        self.source_map = source_map
 
     def compile(self, key, theme, output_dir, minify=True):
         """
         Compile a LESS entry point.
+
+        If ``source_map`` is set, a source map is written alongside the
+        compiled file. The compilers only see the concatenated source, so
+        their map is rewritten to point at the original files.
         """
         entry_point = theme.static_url_to_filesystem_path(self.url_path)
 
-        lessc_flags = [self.lessc_path]
-        lessc_flags.append('--verbose')
-        if minify:
-            lessc_flags.append('--compress')
-
         preprocessed = self.concatenate(theme, entry_point)
         assert isinstance(preprocessed, six.text_type)
 
-        preprocessed = preprocessed.encode('utf-8')
+        compiled = self.run_compilers(preprocessed, minify)
+
+        source_map = None
+        if self.source_map:
+            compiled, source_map = extract_inline_map(compiled)
+            if source_map is None:
+                log.warn('No source map in compiled output for %s',
+                         self.url_path)
+            else:
+                remap_concatenated(source_map,
+                                   self.line_origins(theme, entry_point),
+                                   theme.filesystem_path_to_static_url)
+        file_path = self.write_bytes(key, compiled, entry_point, output_dir,
+                                     source_map=source_map)
+        self.write_critical(theme, file_path, compiled)
+        return file_path
+
+    def run_compilers(self, preprocessed, minify=True):
+        """
+        Compile concatenated LESS source (a unicode string) with the compiler
+        worker if possible, otherwise by piping it through ``stages()``, and
+        return the CSS as a bytestring.
+        """
+        compiled = None
+        # The compiler worker uses its own copy of less, so it can only be
+        # used when the asset isn't configured with particular executables.
+        if (self.lessc_path == 'lessc' and
+                self.autoprefixer_path == 'autoprefixer'):
+            compiled = self.run_compiler('less',
+                                         source=preprocessed,
+                                         minify=minify,
+                                         autoprefix=True,
+                                         sourceMap=self.source_map)
+            if compiled is not None:
+                compiled = compiled.encode('utf-8')
+        if compiled is None:
+            compiled = self.run_pipeline(self.stages(minify),
+                                         preprocessed.encode('utf-8'))
+        return compiled
+
+    def compile_development(self, theme):
+        """
+        Compile the entry point for ``theme`` without minifying, and return
+        the CSS as a bytestring, for serving in development. The result is
+        cached for the life of the process, and only recompiled when the size
+        or modification time of a file in the import graph changes.
+        """
+        entry_point = theme.static_url_to_filesystem_path(self.url_path)
+        deps = []
+        preprocessed = self.concatenate(theme, entry_point, deps=deps)
+        stamp = []
+        for path in deps:
+            st = os.stat(path)
+            stamp.append((path, st.st_size, st.st_mtime))
+        memo_key = (theme.key, self.url_path)
+        with compiled_css_lock:
+            entry = compiled_css.get(memo_key)
+        if entry and entry[0] == stamp:
+            return entry[1]
 
-        with self.tempfile() as (in_f, in_name):
-            in_f.write(preprocessed)
-            in_f.flush()
-            lessc_cmd = lessc_flags + [in_name]
-            with self.tempfile() as (out_f, out_name):
+        log.debug('Compiling %s for development ...', self.url_path)
+        compiled = self.run_compilers(preprocessed, minify=False)
+        # Inline source maps refer to the concatenated source, so drop them.
+        compiled = extract_inline_map(compiled)[0]
+        with compiled_css_lock:
+            compiled_css[memo_key] = stamp, compiled
+        return compiled
 
-                lessc_cmd.append(out_name)
-                self.run_command(lessc_cmd)
+    def critical_path(self, file_path):
+        """
+        Return the path of the critical CSS file corresponding to a compiled
+        file.
+        """
+        return os.path.splitext(file_path)[0] + '.critical.css'
 
-                autoprefixer_cmd = [self.autoprefixer_path, out_name]
-                self.run_command(autoprefixer_cmd)
+    def sidecar_paths(self, file_path):
+        return (Asset.sidecar_paths(self, file_path) +
+                [self.critical_path(file_path)])
 
-                file_path = self.write_from_file(key, out_name, entry_point,
-                                                 output_dir)
+    def write_critical(self, theme, file_path, css):
+        """
+        If ``critical_templates`` is set, render each of those templates with
+        the theme's template lookup, and write the rules of the compiled
+        stylesheet ``css`` (UTF-8 encoded bytes) which apply to the first
+        ``critical_elements`` elements of any of them alongside the compiled
+        file, to be inlined by ``tag_production()``. The templates are
+        rendered without any arguments, so they should be representative
+        pages which don't need a request.
+        """
+        if not self.critical_templates:
+            return
+        css = css.decode('utf-8')
+        documents = []
+        for name in self.critical_templates:
+            template = theme.lookup.get_template(name)
+            documents.append(template.render_unicode())
+        critical = extract_critical(css, documents, self.critical_elements)
+        critical_path = self.critical_path(file_path)
+        log.debug('Writing %d bytes of critical CSS to %s ...',
+                  len(critical), critical_path)
+        write_atomic(critical_path, critical.encode('utf-8'))
 
-        return file_path
+    def stages(self, minify=True):
+        """
+        Return the commands which the concatenated LESS source is piped
+        through, in order. Each reads from stdin and writes to stdout.
+        """
+        lessc_cmd = [self.lessc_path]
+        autoprefixer_cmd = [self.autoprefixer_path]
+        if minify:
+            lessc_cmd.append('--compress')
+        if self.source_map:
+            # Both tools pass the map along in an inline comment.
+            lessc_cmd.append('--source-map-map-inline')
+            autoprefixer_cmd.append('--inline-map')
+        lessc_cmd.append('-')
+        return [lessc_cmd, autoprefixer_cmd]
+
+    def dependencies(self, theme):
+        entry_point = theme.static_url_to_filesystem_path(self.url_path)
+        deps = []
+        self.concatenate(theme, entry_point, deps=deps)
+        if self.critical_templates:
+            # Templates can inherit from and include each other, so treat
+            # every template in the theme as an input.
+            for dir in theme.template_dirs:
+                for dirpath, dirnames, filenames in os.walk(dir):
+                    dirnames.sort()
+                    deps.extend(os.path.join(dirpath, filename)
+                                for filename in sorted(filenames))
+        return deps
+
+    def theme_options(self, theme):
+        options = Asset.theme_options(self, theme)
+        if self.critical_templates:
+            return [options, theme.template_dirs]
+        return options
+
+    def tool_versions(self):
+        return {
+            self.lessc_path: tool_version([self.lessc_path, '--version']),
+            self.autoprefixer_path: tool_version([self.autoprefixer_path,
+                                                  '--version']),
+        }
 
-    def concatenate(self, theme, start_path):
+    def parse(self, path):
+        """
+        Split a LESS file into a list of ``(kind, value)`` chunks, where
+        ``kind`` is either ``'text'``, with a unicode string of literal LESS
+        source, or ``'import'``, with the path of an ``@import`` as written.
+
+        Parsed files are cached, since partials such as variables and mixins
+        are imported by many entry points and themes. A file is reparsed if
+        its size or modification time changes, which replaces its entry, and
+        only the ``max_parsed_files`` most recently used files are kept, so
+        long-running processes (``pcompile --watch`` and
+        ``pyramid_frontend.serve_less``) don't accumulate them.
+        """
+        memo_key = (path, self.import_re.pattern)
+        try:
+            st = os.stat(path)
+        except OSError:
+            with parsed_files_lock:
+                parsed_files.pop(memo_key, None)
+            raise
+        stamp = (st.st_size, st.st_mtime)
+        with parsed_files_lock:
+            entry = parsed_files.pop(memo_key, None)
+            if entry and entry[0] == stamp:
+                parsed_files[memo_key] = entry
+                return entry[1]
+
+        chunks = []
+        literal = []
+        with io.open(path, encoding='utf8') as fp:
+            for line in fp:
+                match = self.import_re.match(line.strip())
+                if match:
+                    if literal:
+                        chunks.append(('text', u''.join(literal)))
+                        literal = []
+                    chunks.append(('import', match.groupdict()['path']))
+                else:
+                    literal.append(line)
+        if literal:
+            chunks.append(('text', u''.join(literal)))
+
+        with parsed_files_lock:
+            parsed_files[memo_key] = stamp, chunks
+            while len(parsed_files) > max_parsed_files:
+                parsed_files.popitem(last=False)
+        return chunks
+
+    def resolve_import(self, theme, directory, path):
+        """
+        Return the filesystem path of an ``@import`` found in a file in
+        ``directory``.
+        """
+        ext = os.path.splitext(path)[1]
+        if ext not in ('.css', '.less'):
+            path = '.'.join((path, 'less'))
+        if os.path.isabs(path):
+            return theme.static_url_to_filesystem_path(path)
+        return os.path.normpath(os.path.join(directory, path))
+
+    def concatenate(self, theme, start_path, deps=None, _stack=()):
         """
         Combine a LESS file and its `@import`s, recursively. Used to keep
         the ``lessc`` command-line compiler from having to traverse a directory
@@ -69,39 +293,122 @@ class LessAsset(Asset):
 
         Always assumes file encodings are UTF-8, and should always return a
         unicode string (unicode on 2.x, str on 3.x).
+
+        If a ``deps`` list is supplied, the path of each file read is appended
+        to it. Raises ``ImportCycleError`` if a file imports itself, directly
+        or indirectly.
         """
         err = 'File does not exist {0}'.format(start_path)
         assert os.path.isfile(start_path), err
-        contents = []
+        if start_path in _stack:
+            cycle = _stack[_stack.index(start_path):] + (start_path,)
+            raise ImportCycleError('LESS import cycle: %s' %
+                                   ' -> '.join(cycle))
+        if deps is not None:
+            deps.append(start_path)
+        stack = _stack + (start_path,)
         directory = os.path.dirname(start_path)
-        with io.open(start_path, encoding='utf8') as fp:
-            for line in fp:
-                match = self.import_re.match(line.strip())
-                if match:
-                    path = match.groupdict()['path']
-                    ext = os.path.splitext(path)[1]
-                    if ext not in ('.css', '.less'):
-                        path = '.'.join((path, 'less'))
-                    if os.path.isabs(path):
-                        path = theme.static_url_to_filesystem_path(path)
-                    else:
-                        path = os.path.join(directory, path)
-                    contents.append(self.concatenate(theme, path))
-                else:
-                    contents.append(line)
+        contents = []
+        for kind, value in self.parse(start_path):
+            if kind == 'import':
+                path = self.resolve_import(theme, directory, value)
+                contents.append(self.concatenate(theme, path, deps, stack))
+            else:
+                contents.append(value)
         return u''.join(contents)
 
+    def line_origins(self, theme, start_path):
+        """
+        Return a list of the ``(path, line)`` which each line of the output
+        of ``concatenate()`` came from, with zero-based line numbers. A line
+        made up of the end of an imported file without a trailing newline and
+        the line after its ``@import`` is attributed to the imported file.
+        """
+        origins = []
+        # Whether the next line read starts a line of the output.
+        state = {'line_start': True}
+
+        def walk(path):
+            directory = os.path.dirname(path)
+            lineno = 0
+            for kind, value in self.parse(path):
+                if kind == 'import':
+                    walk(self.resolve_import(theme, directory, value))
+                    lineno += 1
+                    continue
+                for line in self.line_re.findall(value):
+                    if state['line_start']:
+                        origins.append((path, lineno))
+                    state['line_start'] = line.endswith('\n')
+                    lineno += 1
+
+        walk(start_path)
+        return origins
+
     def tag_development(self, theme, url):
         """
         Return an HTML fragment to use a less CSS entry point in development.
+
+        If ``pyramid_frontend.serve_less`` is enabled, the stylesheet is
+        compiled on the server by ``less_view()``, otherwise it's compiled in
+        the browser by less.js.
         """
+        if asbool(theme.settings.get('pyramid_frontend.serve_less')):
+            return HTML.link(rel='stylesheet', type='text/css',
+                             href='/_pfe_less/%s%s' % (theme.key, url))
         return ''.join([
             HTML.link(rel='stylesheet/less', type='text/css', href=url),
             HTML.script(src=self.less_path),
         ])
 
-    def tag_production(self, theme, url):
+    def tag_production(self, theme, url, **attrs):
         """
         Return an HTML fragment to use a less CSS entry point in production.
+
+        If critical CSS was extracted for the entry point, it is inlined, and
+        the full stylesheet is loaded asynchronously.
         """
-        return HTML.link(rel='stylesheet', type='text/css', href=url)
+        link = HTML.link(rel='stylesheet', type='text/css', href=url, **attrs)
+        if not self.critical_templates:
+            return link
+        critical_path = self.critical_path(
+            os.path.join(theme.compiled_asset_dir, os.path.basename(url)))
+        if not os.path.exists(critical_path):
+            return link
+        with io.open(critical_path, encoding='utf8') as f:
+            critical = f.read()
+        return ''.join([
+            HTML.style(literal(critical.replace('</', '<\\/'))),
+            HTML.link(rel='preload', href=url,
+                      onload="this.onload=null;this.rel='stylesheet'",
+                      **dict(attrs, **{'as': 'style'})),
+            HTML.noscript(link),
+        ])
+
+
+def less_view(request):
+    """
+    Serve a LESS entry point of a theme, compiled on the server with
+    ``LessAsset.compile_development()``. Registered at
+    ``/_pfe_less/{theme}/*subpath`` when ``pyramid_frontend.serve_less`` is
+    enabled, where the subpath is the entry point's URL path.
+    """
+    themes = request.registry.settings['pyramid_frontend.theme_registry']
+    theme = themes.get(request.matchdict['theme'])
+    if theme is None:
+        raise HTTPNotFound()
+    url_path = '/' + '/'.join(request.matchdict['subpath'])
+    for asset in theme.stacked_assets.values():
+        if isinstance(asset, LessAsset) and asset.url_path == url_path:
+            break
+    else:
+        raise HTTPNotFound()
+
+    css = asset.compile_development(theme)
+    response = Response(body=css,
+                        content_type='text/css',
+                        charset='utf-8',
+                        conditional_response=True)
+    response.etag = sha1(css).hexdigest()
+    response.cache_control = 'no-cache'
+    return response
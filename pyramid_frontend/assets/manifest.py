@@ -0,0 +1,111 @@
+"""
+A single JSON manifest of the compiled assets of every theme, written by each
+build, so that compiled file names can be looked up without reading a map file
+per entry point. The manifest maps theme key to entry point key to a dict
+with::
+
+    file        the compiled file name, relative to the theme's compiled asset
+                directory
+    size        the size of the compiled file in bytes
+    integrity   a subresource integrity digest of the compiled file
+"""
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import io
+import json
+import base64
+import hashlib
+import threading
+
+import six
+
+from .builds import compiled_root
+
+log = logging.getLogger(__name__)
+
+
+def file_integrity(path, algorithm='sha384'):
+    """
+    Return a subresource integrity digest (e.g. ``sha384-<base64>``) of a
+    file's contents.
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return '%s-%s' % (algorithm, base64.b64encode(h.digest()).decode('ascii'))
+
+
+def manifest_path(settings):
+    return os.path.join(compiled_root(settings), 'manifest.json')
+
+
+def build_manifest(compiled):
+    """
+    Build a manifest from a dict mapping theme key to entry point key to the
+    path of the compiled file. Files which are shared between themes (by hard
+    link) are only hashed once.
+    """
+    manifest = {}
+    digests = {}
+    for theme_key, paths in compiled.items():
+        entries = manifest[theme_key] = {}
+        for key, file_path in paths.items():
+            st = os.stat(file_path)
+            memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+            if memo_key not in digests:
+                digests[memo_key] = file_integrity(file_path)
+            entries[key] = {
+                'file': os.path.basename(file_path),
+                'size': st.st_size,
+                'integrity': digests[memo_key],
+            }
+    return manifest
+
+
+def write_manifest(path, manifest):
+    """
+    Atomically write a manifest file, so that running processes never see a
+    partially written manifest.
+    """
+    dirpath = os.path.dirname(path)
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    encoded = json.dumps(manifest, indent=2, sort_keys=True)
+    with io.open(temp_path, 'w', encoding='utf8') as f:
+        f.write(six.text_type(encoded))
+    os.rename(temp_path, path)
+    with lock:
+        loaded_manifests.pop(path, None)
+
+
+# Parsed manifests, keyed by path. See load_manifest().
+loaded_manifests = {}
+lock = threading.Lock()
+
+
+def load_manifest(path):
+    """
+    Return the manifest at ``path``, or ``None`` if there isn't one. The
+    parsed manifest is cached for the life of the process, and shared by all
+    themes, unless the file is replaced.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (st.st_ino, st.st_size, st.st_mtime)
+    with lock:
+        entry = loaded_manifests.get(path)
+        if entry and entry[0] == stamp:
+            return entry[1]
+    log.debug('Loading asset manifest %s', path)
+    with io.open(path, encoding='utf8') as f:
+        manifest = json.load(f)
+    with lock:
+        loaded_manifests[path] = stamp, manifest
+    return manifest
@@ -3,26 +3,64 @@ from __future__ import absolute_import, print_function, division
 import logging
 
 import os
+import re
+import json
+import itertools
+import posixpath
 
 from webhelpers2.html.tags import HTML
 
-from .asset import Asset
+from .asset import Asset, tool_version, read_chunks
+from .sourcemap import strip_map_comment, offset_lines
 
 log = logging.getLogger(__name__)
 
 
-js_preamble = '''\
-<script>
+console_shim = '''\
   if (typeof console === 'undefined') {
     console = {
       log: function () {},
       debug: function () {}
     }
   }
-</script>
 '''
 
 
+js_preamble = '<script>\n' + console_shim + '</script>\n'
+
+
+define_re = re.compile(r'\b(?:define|require)\s*\(\s*'
+                       r'(?:[\'"][^\'"]*[\'"]\s*,\s*)?\[([^\]]*)\]')
+sugar_re = re.compile(r'\brequire\s*\(\s*[\'"]([^\'"]+)[\'"]\s*\)')
+string_re = re.compile(r'[\'"]([^\'"]+)[\'"]')
+
+special_modules = ('require', 'exports', 'module')
+
+# Module dependencies of scripts, keyed by path. See module_dependencies().
+parsed_modules = {}
+
+
+def module_dependencies(path):
+    """
+    Return the module IDs named in the dependency arrays of ``define()`` and
+    ``require()`` calls in a script, and in CommonJS-style ``require('...')``
+    calls. Results are cached by path, size and modification time.
+    """
+    st = os.stat(path)
+    stamp = (st.st_size, st.st_mtime)
+    entry = parsed_modules.get(path)
+    if entry and entry[0] == stamp:
+        return entry[1]
+    with open(path, 'rb') as f:
+        source = f.read().decode('utf-8', 'replace')
+    deps = []
+    for match in define_re.finditer(source):
+        deps.extend(string_re.findall(match.group(1)))
+    deps.extend(sugar_re.findall(source))
+    parsed_modules[path] = stamp, deps
+    return deps
+
+
 def render_js_paths(theme):
     """
     Return a script tag for use client-side which sets up require.js paths for
@@ -42,20 +80,150 @@ class RequireJSAsset(Asset):
     """
     Asset handler for javascript loaded by require.js.
 
+    If ``common`` is the key of a ``RequireJSCommonAsset`` in the same theme,
+    modules shared with the theme's other entry points are left out of the
+    compiled file, and loaded from the common bundle instead.
+
+    If ``source_map`` is set, minified builds are compiled with uglify2 and
+    a source map is written alongside the compiled file. r.js can't generate
+    source maps without minifying, so unminified builds don't have one.
+
     Currently assumes r.js is on $PATH.
     """
     extension = 'js'
+    preload_as = 'script'
+    source_map_comment = u'//# sourceMappingURL=%s'
 
     def __init__(self, url_path,
                  require_config_path='/_pfe/require_config.js',
                  require_path='/_pfe/require.js',
-                 require_base_url='/_pfe/'):
+                 require_base_url='/_pfe/',
+                 loading=None,
+                 common=None,
+                 source_map=False):
+        assert loading in (None, 'defer', 'async'), \
+            "loading must be None, 'defer' or 'async'"
+        if loading == 'async' and common:
+            # The common bundle (with the loader) must run before the entry
+            # point, which async scripts don't guarantee.
+            raise ValueError("loading='async' can't be used with common")
         self.url_path = url_path
         self.require_config_path = require_config_path
         self.require_path = require_path
         self.require_base_url = require_base_url
+        self.loading = loading
+        self.common = common
+        self.source_map = source_map
 
-    def compile(self, key, theme, output_dir, minify=True):
+    def dependencies(self, theme):
+        """
+        r.js doesn't report the modules it traced, so conservatively treat
+        every file under the base URL and the theme's module paths as an
+        input, including templates and data loaded by plugins. Modules
+        mapped elsewhere by the require.js config file aren't included.
+        """
+        deps = [
+            theme.static_url_to_filesystem_path(self.require_config_path),
+            theme.static_url_to_filesystem_path('/_pfe/almond.js'),
+        ]
+        if self.url_path:
+            deps.append(theme.static_url_to_filesystem_path(self.url_path))
+        base_url = theme.static_url_to_filesystem_path(self.require_base_url)
+        dirs = [base_url] + [dir for prefix, dir in self.module_paths(theme)]
+        for top in dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames[:] = sorted(name for name in dirnames
+                                     if not name.startswith('.'))
+                for filename in sorted(filenames):
+                    if not filename.startswith('.'):
+                        deps.append(os.path.join(dirpath, filename))
+        return deps
+
+    def theme_options(self, theme):
+        # Module paths are mapped by theme key, so they affect module
+        # resolution.
+        options = [(dir_ref, os.path.join(dir, 'js'))
+                   for dir_ref, dir in theme.keyed_static_dirs
+                   if os.path.isdir(os.path.join(dir, 'js'))]
+        options = [Asset.theme_options(self, theme), options,
+                   self.bundle_preamble()]
+        if self.common:
+            # Which modules are shared depends on the other entry points.
+            common = theme.stacked_assets[self.common]
+            options = [options, common.theme_options(theme)]
+        return options
+
+    def tool_versions(self):
+        return {'r.js': tool_version(['r.js', '-v'])}
+
+    def module_paths(self, theme):
+        """
+        Return a list of ``(prefix, directory)`` pairs of the module paths
+        configured for the theme.
+        """
+        return [(dir_ref, os.path.join(dir, 'js'))
+                for dir_ref, dir in theme.keyed_static_dirs]
+
+    def entry_module(self, theme):
+        """
+        Return the filesystem path of the base URL, and the module ID of the
+        entry point relative to it.
+        """
+        base_url = theme.static_url_to_filesystem_path(
+            self.require_base_url)
+        # Path to main module relative to baseUrl (can't be absolute)
+        main_js_file = theme.static_url_to_filesystem_path(self.url_path)
+        main = os.path.relpath(main_js_file, base_url)
+        main = os.path.splitext(main)[0]  # Strip .js
+        return base_url, main
+
+    def resolve_module(self, module_id, parent_id, base_url, paths):
+        """
+        Return a ``(module ID, path)`` pair for a dependency of the module
+        ``parent_id``, or ``None`` if it's a special or plugin module, or
+        can't be found. Only paths configured for the theme are used, not
+        those in the require.js config file.
+        """
+        if '!' in module_id or module_id in special_modules:
+            return None
+        if module_id.startswith('./') or module_id.startswith('../'):
+            module_id = posixpath.normpath(
+                posixpath.join(posixpath.dirname(parent_id), module_id))
+        prefix, _, rest = module_id.partition('/')
+        if prefix in paths and rest:
+            path = os.path.join(paths[prefix], rest + '.js')
+        else:
+            path = os.path.join(base_url, module_id + '.js')
+        if os.path.isfile(path):
+            return module_id, path
+
+    def module_graph(self, theme):
+        """
+        Return the set of IDs of the modules which this entry point depends
+        on, directly or indirectly, including itself, by scanning scripts for
+        dependencies.
+        """
+        base_url, main = self.entry_module(theme)
+        paths = dict(self.module_paths(theme))
+        graph = set()
+        stack = [(main, theme.static_url_to_filesystem_path(self.url_path))]
+        while stack:
+            module_id, path = stack.pop()
+            if module_id in graph:
+                continue
+            graph.add(module_id)
+            for dep in module_dependencies(path):
+                resolved = self.resolve_module(dep, module_id, base_url,
+                                               paths)
+                if resolved:
+                    stack.append(resolved)
+        return graph
+
+    def base_config(self, theme, minify=True):
+        """
+        Return the r.js build options which are common to all bundles for
+        ``theme``.
+        """
         main_config = theme.static_url_to_filesystem_path(
             self.require_config_path)
         base_url = theme.static_url_to_filesystem_path(
@@ -64,43 +232,151 @@ class RequireJSAsset(Asset):
         log.debug("base_url: %r", base_url)
         log.debug("main_config: %r", main_config)
 
-        # Path to main module relative to baseUrl (can't be absolute)
-        main_js_file = theme.static_url_to_filesystem_path(self.url_path)
-        main = os.path.relpath(main_js_file, base_url)
-        main = os.path.splitext(main)[0]  # Strip .js
-
         almond_path = \
             theme.static_url_to_filesystem_path('/_pfe/almond.js')
         almond_path = os.path.relpath(almond_path, base_url)
         almond_path = os.path.splitext(almond_path)[0]
 
-        log.debug("main: %r", main)
-
-        cmd = [
-            'r.js', '-o',
-            'baseUrl={0}'.format(base_url),
-            'mainConfigFile={0}'.format(main_config),
-            'name={0}'.format(main),
-            'paths.requireLib={0}'.format(almond_path),
-            'include=requireLib',
+        options = [
+            ('baseUrl', base_url),
+            ('mainConfigFile', main_config),
+            ('paths.requireLib', almond_path),
         ]
 
         if not minify:
-            cmd.append('optimize=none')
+            options.append(('optimize', 'none'))
+        elif self.source_map:
+            options.extend([
+                ('optimize', 'uglify2'),
+                ('generateSourceMaps', True),
+                ('preserveLicenseComments', False),
+            ])
 
         # Add RequireJS paths for theme
-        for dir_ref, dir in theme.keyed_static_dirs:
-            dir = os.path.join(dir, 'js')
-            log.debug("path _%s -> %s", key, dir)
-            cmd.append('paths.{}={}'.format(dir_ref, dir))
+        for dir_ref, dir in self.module_paths(theme):
+            log.debug("path _%s -> %s", dir_ref, dir)
+            options.append(('paths.{}'.format(dir_ref), dir))
+
+        return options
+
+    def build_config(self, key, theme, minify=True):
+        """
+        Return the r.js build options for this entry point, as a list of
+        ``(option, value)`` pairs, in the dotted form used on the r.js
+        command line. Values of ``include`` and ``exclude`` are lists.
+        """
+        base_url, main = self.entry_module(theme)
+        log.debug("main: %r", main)
+
+        options = self.base_config(theme, minify)
+        options.append(('name', main))
+        if self.common:
+            # The almond loader is in the common bundle.
+            common = theme.stacked_assets[self.common]
+            shared = common.shared_modules(theme)
+            if shared:
+                options.append(('exclude', shared))
+        else:
+            options.append(('include', ['requireLib']))
+        return options
+
+    def output_name(self):
+        """
+        Return the name which the compiled file name is based on.
+        """
+        return self.url_path
+
+    def compile(self, key, theme, output_dir, minify=True):
+        options = self.build_config(key, theme, minify)
+        source_map = bool(self.source_map and minify)
+        map_text = None
+
+        config = {}
+        for option, value in options:
+            if '.' in option:
+                group, name = option.split('.', 1)
+                config.setdefault(group, {})[name] = value
+            else:
+                config[option] = value
+        preamble = self.bundle_preamble()
+        compiled = self.run_compiler('requirejs', config=config,
+                                     sourceMap=source_map)
+        if compiled is not None:
+            if source_map:
+                map_text = compiled['map']
+                compiled = compiled['code']
+            compiled = compiled.encode('utf-8')
+            map_dir = config['baseUrl']
+        else:
+            cmd = ['r.js', '-o']
+            for option, value in options:
+                if isinstance(value, list):
+                    value = ','.join(value)
+                elif isinstance(value, bool):
+                    value = 'true' if value else 'false'
+                cmd.append('{0}={1}'.format(option, value))
+
+            with self.tempfile() as (f, temp_name):
+                cmd.append('out={0}'.format(temp_name))
+                self.run_command(cmd)
+                if not source_map:
+                    # Stream the bundle, which can be large, straight into
+                    # the compiled file.
+                    with open(temp_name, 'rb') as f:
+                        chunks = itertools.chain([preamble.encode('utf-8')],
+                                                 read_chunks(f))
+                        return self.write_stream(key, chunks,
+                                                 self.output_name(),
+                                                 output_dir)
+                with open(temp_name, 'rb') as f:
+                    compiled = f.read()
+                map_path = temp_name + '.map'
+                if os.path.exists(map_path):
+                    with open(map_path, 'rb') as f:
+                        map_text = f.read().decode('utf-8')
+                    os.remove(map_path)
+            map_dir = os.path.dirname(temp_name)
 
-        with self.tempfile() as (f, temp_name):
-            cmd.append('out={0}'.format(temp_name))
-            self.run_command(cmd)
-            file_path = self.write_from_file(key, temp_name, self.url_path,
-                                             output_dir)
+        smap = None
+        if source_map:
+            compiled = strip_map_comment(compiled)
+            if map_text:
+                smap = json.loads(map_text)
+                self.resolve_map_sources(theme, smap, map_dir)
+                offset_lines(smap, preamble.count('\n'))
+            else:
+                log.warn('No source map in compiled output for %s',
+                         self.output_name())
+        return self.write_bytes(key, preamble.encode('utf-8') + compiled,
+                                self.output_name(), output_dir,
+                                source_map=smap)
 
-        return file_path
+    def resolve_map_sources(self, theme, source_map, map_dir):
+        """
+        Rewrite the sources of a source map generated by r.js, which are
+        relative to ``map_dir``, as static URLs. Sources which aren't in the
+        theme's static dirs are left alone.
+        """
+        root = source_map.pop('sourceRoot', None) or ''
+        sources = []
+        for source in source_map.get('sources', []):
+            path = os.path.normpath(os.path.join(map_dir, root, source))
+            try:
+                sources.append(theme.filesystem_path_to_static_url(path))
+            except ValueError:
+                sources.append(source)
+        source_map['sources'] = sources
+
+    def bundle_preamble(self):
+        """
+        Return the script which is prepended to the compiled bundle, so that
+        it doesn't have to be inlined in every page. In development, it is
+        inlined by ``tag_development()`` instead. Entry points which use a
+        common bundle get it from there.
+        """
+        if self.common:
+            return ''
+        return console_shim.strip() + '\n'
 
     def tag_development(self, theme, url):
         """
@@ -114,13 +390,107 @@ class RequireJSAsset(Asset):
             HTML.script(src=url),
         ])
 
-    def tag_production(self, theme, url):
+    def tag_production(self, theme, url, **attrs):
         """
         Return an HTML fragment to use a require.js entry point in production.
+        If the entry point uses a common bundle, it is loaded first.
         """
-        # FIXME Include the js preamble in the minified file itself, so it
-        # doesn't have to be added to each tag fragment.
-        return ''.join([
-            js_preamble,
-            HTML.script(src=url),
-        ])
+        if self.loading:
+            attrs.setdefault(self.loading, self.loading)
+        if self.common and attrs.pop('async', None):
+            # Deferred scripts run in order, so the common bundle still runs
+            # first.
+            attrs.setdefault('defer', 'defer')
+        tag = HTML.script(src=url, **attrs)
+        if not self.common:
+            return tag
+
+        common_attrs = dict(attrs)
+        if 'integrity' in attrs:
+            del common_attrs['integrity']
+            entry = theme.manifest.get(self.common)
+            if entry and entry.get('integrity'):
+                common_attrs['integrity'] = entry['integrity']
+        common_url = '/compiled/%s/%s' % (
+            theme.key, theme.compiled_asset_path(self.common))
+        return ''.join([HTML.script(src=common_url, **common_attrs), tag])
+
+
+class RequireJSCommonAsset(RequireJSAsset):
+    """
+    A bundle of the almond loader and the modules which are shared by at
+    least ``min_entries`` of the ``RequireJSAsset`` entry points in the same
+    theme which reference this asset's key with ``common``. Those entry
+    points are compiled without the shared modules, and their production tags
+    load this bundle first, so the shared modules are only downloaded once
+    (and cached) across page types.
+
+    Dependencies are found by scanning scripts for ``define()`` and
+    ``require()`` calls, resolving module IDs with the theme's module paths
+    and the base URL. Modules mapped only in the require.js config file are
+    not detected, and stay in each entry point's bundle.
+    """
+    def __init__(self, name='common.js', min_entries=2,
+                 require_config_path='/_pfe/require_config.js',
+                 require_path='/_pfe/require.js',
+                 require_base_url='/_pfe/',
+                 loading=None,
+                 source_map=False):
+        RequireJSAsset.__init__(self, None,
+                                require_config_path=require_config_path,
+                                require_path=require_path,
+                                require_base_url=require_base_url,
+                                loading=loading,
+                                source_map=source_map)
+        self.name = name
+        self.min_entries = min_entries
+
+    def entry_points(self, theme):
+        """
+        Return the entry points of ``theme`` which use this common bundle.
+        """
+        return [asset for key, asset in sorted(theme.stacked_assets.items())
+                if getattr(asset, 'common', None) and
+                theme.stacked_assets.get(asset.common) is self]
+
+    def shared_modules(self, theme):
+        """
+        Return a sorted list of the IDs of modules which at least
+        ``min_entries`` of the entry points depend on.
+        """
+        counts = {}
+        for asset in self.entry_points(theme):
+            base_url, main = asset.entry_module(theme)
+            for module_id in asset.module_graph(theme):
+                if module_id != main:
+                    counts[module_id] = counts.get(module_id, 0) + 1
+        return sorted(module_id for module_id, count in counts.items()
+                      if count >= self.min_entries)
+
+    def theme_options(self, theme):
+        options = RequireJSAsset.theme_options(self, theme)
+        return [options, [asset.url_path
+                          for asset in self.entry_points(theme)]]
+
+    def build_config(self, key, theme, minify=True):
+        options = self.base_config(theme, minify)
+        options.append(('name', 'requireLib'))
+        shared = self.shared_modules(theme)
+        if shared:
+            options.append(('include', shared))
+        return options
+
+    def output_name(self):
+        return self.name
+
+    def bundle_preamble(self):
+        return console_shim.strip() + '\n'
+
+    def tag_development(self, theme, url):
+        # In development, modules are loaded individually by require.js.
+        return ''
+
+    def tag_production(self, theme, url, **attrs):
+        if self.loading:
+            attrs.setdefault(self.loading, self.loading)
+        return HTML.script(src=url, **attrs)
@@ -0,0 +1,172 @@
+"""
+Helpers for manipulating version 3 source maps produced by the compilers, so
+that they point at the original source files rather than at intermediate
+output, such as the concatenated LESS source piped to ``lessc``.
+"""
+from __future__ import absolute_import, print_function, division
+
+import io
+import re
+import json
+import base64
+
+import six
+
+base64_chars = ('ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                'abcdefghijklmnopqrstuvwxyz0123456789+/')
+base64_values = dict((c, ii) for ii, c in enumerate(base64_chars))
+
+inline_css_re = re.compile(
+    br'\s*/\*# sourceMappingURL=data:application/json;'
+    br'(?:charset=utf-8;)?base64,([A-Za-z0-9+/=]+) \*/\s*$')
+url_comment_re = re.compile(br'\s*(?://|/\*)# sourceMappingURL=[^\n]*\s*$')
+
+
+def vlq_decode(segment):
+    """
+    Decode a base64 VLQ encoded mapping segment to a list of integers.
+    """
+    values = []
+    value = shift = 0
+    for c in segment:
+        digit = base64_values[c]
+        value += (digit & 31) << shift
+        if digit & 32:
+            shift += 5
+        else:
+            values.append(-(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    return values
+
+
+def vlq_encode(values):
+    """
+    Encode a list of integers as a base64 VLQ mapping segment.
+    """
+    out = []
+    for value in values:
+        vlq = ((-value) << 1) | 1 if value < 0 else value << 1
+        while True:
+            digit = vlq & 31
+            vlq >>= 5
+            if vlq:
+                digit |= 32
+            out.append(base64_chars[digit])
+            if not vlq:
+                break
+    return ''.join(out)
+
+
+def decode_mappings(mappings):
+    """
+    Decode a ``mappings`` string to a list of generated lines, each a list of
+    segments with absolute values: ``[column]``, ``[column, source, line,
+    source column]``, or the same with a name index.
+    """
+    lines = []
+    state = [0, 0, 0, 0]
+    for line in mappings.split(';'):
+        segments = []
+        column = 0
+        for encoded in line.split(','):
+            if not encoded:
+                continue
+            values = vlq_decode(encoded)
+            column += values[0]
+            segment = [column]
+            for ii, delta in enumerate(values[1:]):
+                state[ii] += delta
+                segment.append(state[ii])
+            segments.append(segment)
+        lines.append(segments)
+    return lines
+
+
+def encode_mappings(lines):
+    """
+    Encode a list of generated lines as returned by ``decode_mappings()``.
+    """
+    out = []
+    state = [0, 0, 0, 0]
+    for segments in lines:
+        encoded = []
+        column = 0
+        for segment in segments:
+            values = [segment[0] - column]
+            column = segment[0]
+            for ii, value in enumerate(segment[1:]):
+                values.append(value - state[ii])
+                state[ii] = value
+            encoded.append(vlq_encode(values))
+        out.append(','.join(encoded))
+    return ';'.join(out)
+
+
+def extract_inline_map(data):
+    """
+    Remove an inline (data URI) source map comment from the end of compiled
+    CSS (a bytestring), and return the remaining CSS and the decoded map, or
+    ``None`` if there wasn't one.
+    """
+    match = inline_css_re.search(data)
+    if not match:
+        return data, None
+    source_map = json.loads(base64.b64decode(match.group(1)).decode('utf-8'))
+    return data[:match.start()], source_map
+
+
+def strip_map_comment(data):
+    """
+    Remove a ``sourceMappingURL`` comment from the end of compiled output.
+    """
+    return url_comment_re.sub(b'', data)
+
+
+def offset_lines(source_map, count):
+    """
+    Adjust a source map for ``count`` lines inserted at the start of the
+    generated file.
+    """
+    source_map['mappings'] = ';' * count + source_map['mappings']
+
+
+def remap_concatenated(source_map, origins, source_url):
+    """
+    Rewrite a source map whose single source was a concatenation of files, so
+    that it points at the original files. ``origins`` lists the ``(path,
+    line)`` of each line of the concatenation, and ``source_url`` is called
+    to turn paths into URLs for the map's ``sources``. The original files'
+    contents are embedded in the map.
+    """
+    lines = decode_mappings(source_map['mappings'])
+    paths = []
+    indexes = {}
+    for segments in lines:
+        for ii, segment in enumerate(segments):
+            if len(segment) < 4:
+                continue
+            if segment[2] >= len(origins):
+                segments[ii] = segment[:1]
+                continue
+            path, line = origins[segment[2]]
+            if path not in indexes:
+                indexes[path] = len(paths)
+                paths.append(path)
+            segment[1] = indexes[path]
+            segment[2] = line
+
+    contents = []
+    for path in paths:
+        with io.open(path, encoding='utf8') as f:
+            contents.append(f.read())
+    source_map['sources'] = [source_url(path) for path in paths]
+    source_map['sourcesContent'] = contents
+    source_map['mappings'] = encode_mappings(lines)
+    source_map.pop('sourceRoot', None)
+
+
+def encode_map(source_map):
+    encoded = json.dumps(source_map, sort_keys=True)
+    if isinstance(encoded, six.binary_type):
+        return encoded
+    return encoded.encode('utf-8')
@@ -0,0 +1,86 @@
+from __future__ import absolute_import, print_function, division
+
+import os.path
+import mimetypes
+
+from pyramid.response import FileResponse
+from pyramid.static import static_view
+
+
+def accepted_encodings(header):
+    """
+    Return the set of content codings accepted by an ``Accept-Encoding``
+    header value, excluding any with a quality of zero.
+    """
+    accepted = set()
+    for item in (header or '').split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+class PrecompressedStaticView(object):
+    """
+    A static view which serves the precompressed copy of a file written by
+    ``Asset.write_compressed()`` (e.g. ``main-<hash>.css.br`` or
+    ``main-<hash>.css.gz``) if the client accepts that encoding, and otherwise
+    falls back to Pyramid's ``static_view``. Responses for files which exist
+    have ``Vary: Accept-Encoding``.
+
+    Should be registered with a route which has a ``*subpath`` pattern.
+    """
+    # In order of preference.
+    encodings = [
+        ('br', '.br'),
+        ('gzip', '.gz'),
+    ]
+
+    def __init__(self, root_dir, cache_max_age=3600):
+        self.root_dir = root_dir
+        self.cache_max_age = cache_max_age
+        self.fallback = static_view(root_dir, cache_max_age=cache_max_age,
+                                    use_subpath=True)
+
+    def resolve(self, subpath):
+        """
+        Return the filesystem path of the requested file, or ``None`` if the
+        subpath is unsafe or the file does not exist.
+        """
+        for segment in subpath:
+            if (segment in ('', '.', '..') or os.sep in segment or
+                    (os.altsep and os.altsep in segment)):
+                return None
+        path = os.path.join(self.root_dir, *subpath)
+        if os.path.isfile(path):
+            return path
+
+    def __call__(self, context, request):
+        path = self.resolve(request.subpath)
+        if path is None:
+            return self.fallback(context, request)
+
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        for encoding, ext in self.encodings:
+            if encoding in accepted and os.path.isfile(path + ext):
+                content_type = mimetypes.guess_type(path)[0] or \
+                    'application/octet-stream'
+                response = FileResponse(path + ext,
+                                        request=request,
+                                        cache_max_age=self.cache_max_age,
+                                        content_type=content_type,
+                                        content_encoding=encoding)
+                break
+        else:
+            response = self.fallback(context, request)
+        response.vary = ('Accept-Encoding',)
+        return response
@@ -1,24 +1,334 @@
 from __future__ import absolute_import, print_function, division
 
+import logging
+
+import re
+from xml.dom import minidom, Node
+
 from webhelpers2.html.tags import HTML
 
 from .asset import Asset
 
+log = logging.getLogger(__name__)
+
+
+svg_ns = 'http://www.w3.org/2000/svg'
+xlink_ns = 'http://www.w3.org/1999/xlink'
+xmlns_ns = 'http://www.w3.org/2000/xmlns/'
+
+# Namespaces of metadata and editor-specific elements and attributes, which
+# don't affect rendering.
+editor_namespaces = frozenset([
+    'http://www.inkscape.org/namespaces/inkscape',
+    'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+    'http://www.bohemiancoding.com/sketch/ns',
+    'http://ns.adobe.com/AdobeIllustrator/10.0/',
+    'http://ns.adobe.com/AdobeSVGViewerExtensions/3.0/',
+    'http://ns.adobe.com/Extensibility/1.0/',
+    'http://ns.adobe.com/Flows/1.0/',
+    'http://ns.adobe.com/GenericCustomNamespace/1.0/',
+    'http://ns.adobe.com/Graphs/1.0/',
+    'http://ns.adobe.com/ImageReplacement/1.0/',
+    'http://ns.adobe.com/SaveForWeb/1.0/',
+    'http://ns.adobe.com/Variables/1.0/',
+    'http://ns.adobe.com/XPath/1.0/',
+    'http://purl.org/dc/elements/1.1/',
+    'http://creativecommons.org/ns#',
+    'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+])
+
+# Elements whose whitespace is significant.
+text_elements = frozenset(['text', 'tspan', 'textPath', 'style', 'script'])
+
+# Attributes whose coordinates are rounded to the asset's precision.
+coordinate_attributes = frozenset(['d', 'points'])
+
+number_re = re.compile(r'[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+separator_re = re.compile(r'[\s,]*')
+flag_re = re.compile(r'[01]')
+
+
+def format_number(value, precision):
+    s = '%.*f' % (precision, float(value))
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+    if s == '-0':
+        s = '0'
+    return s
+
+
+def round_coordinates(value, precision):
+    """
+    Round every number in an attribute value such as a path's ``d`` to at
+    most ``precision`` decimal places.
+
+    Path data is read command by command, so that the large-arc and sweep
+    flags of arcs, which may be packed together with the following number
+    (as in ``a5 5 0 0110 10``), are kept as they are. Values which can't be
+    parsed are returned unchanged.
+    """
+    out = []
+    pos = 0
+    command = None
+    index = 0
+    after_number = False
+    while True:
+        sep = separator_re.match(value, pos).group(0)
+        pos += len(sep)
+        if pos >= len(value):
+            break
+        out.append(sep)
+        if value[pos].isalpha():
+            command = value[pos]
+            out.append(command)
+            pos += 1
+            index = 0
+            after_number = False
+            continue
+        if command in ('A', 'a') and index % 7 in (3, 4):
+            m = flag_re.match(value, pos)
+            text = m and m.group(0)
+        else:
+            m = number_re.match(value, pos)
+            text = m and format_number(m.group(0), precision)
+        if not m:
+            return value
+        # Rounding can make packed numbers (like "1.5.5") run together.
+        if after_number and not sep and not text.startswith('-'):
+            out.append(' ')
+        out.append(text)
+        pos = m.end()
+        index += 1
+        after_number = command not in ('A', 'a') or index % 7 not in (4, 5)
+    return ''.join(out)
+
+
+def clean_node(node, precision):
+    """
+    Recursively remove comments, processing instructions, metadata, editor
+    namespaced elements and attributes, and insignificant whitespace from the
+    children of a DOM element, and round its coordinates.
+    """
+    for attr in list(node.attributes.values()):
+        if attr.namespaceURI in editor_namespaces or (
+                attr.namespaceURI == xmlns_ns and
+                attr.value in editor_namespaces):
+            node.removeAttributeNode(attr)
+        elif attr.localName in coordinate_attributes:
+            attr.value = round_coordinates(attr.value, precision)
+
+    keep_whitespace = node.localName in text_elements
+    for child in list(node.childNodes):
+        if child.nodeType in (Node.COMMENT_NODE,
+                              Node.PROCESSING_INSTRUCTION_NODE):
+            node.removeChild(child)
+        elif child.nodeType == Node.TEXT_NODE:
+            if not keep_whitespace and not child.data.strip():
+                node.removeChild(child)
+        elif child.nodeType == Node.ELEMENT_NODE:
+            if (child.namespaceURI in editor_namespaces or
+                    child.localName == 'metadata'):
+                node.removeChild(child)
+            else:
+                clean_node(child, precision)
+
+
+def optimize_svg(data, precision=3):
+    """
+    Return an optimized copy of an SVG document (a bytestring), without the
+    XML declaration, doctype, comments, metadata, editor namespaces or
+    whitespace between elements, and with path coordinates rounded to
+    ``precision`` decimal places.
+    """
+    doc = minidom.parseString(data)
+    try:
+        root = doc.documentElement
+        clean_node(root, precision)
+        return root.toxml().encode('utf-8')
+    finally:
+        doc.unlink()
+
+
+def prefix_ids(root, prefix):
+    """
+    Prefix every ``id`` in a DOM subtree, and references to them, so that
+    they don't collide with the IDs of other images in the same sprite.
+    """
+    ids = set()
+    elements = [root] + root.getElementsByTagName('*')
+    for el in elements:
+        if el.hasAttribute('id'):
+            ids.add(el.getAttribute('id'))
+    if not ids:
+        return
+
+    def replace_ref(match):
+        if match.group(1) in ids:
+            return 'url(#%s%s)' % (prefix, match.group(1))
+        return match.group(0)
+
+    for el in elements:
+        for attr in list(el.attributes.values()):
+            if attr.name == 'id':
+                attr.value = prefix + attr.value
+            elif (attr.localName == 'href' and attr.value.startswith('#') and
+                    attr.value[1:] in ids):
+                attr.value = '#' + prefix + attr.value[1:]
+            elif 'url(#' in attr.value:
+                attr.value = re.sub(r'url\(#([^)]+)\)', replace_ref,
+                                    attr.value)
+
+
+def build_sprite(images, precision=3):
+    """
+    Combine a list of ``(id, data)`` pairs of SVG documents into a single SVG
+    document of ``<symbol>`` elements, which can be referenced by
+    ``<use href="sprite.svg#id">``. Each image's ``viewBox`` (or its width
+    and height) is kept on its symbol.
+    """
+    impl = minidom.getDOMImplementation()
+    sprite = impl.createDocument(svg_ns, 'svg', None)
+    root = sprite.documentElement
+    root.setAttribute('xmlns', svg_ns)
+    root.setAttribute('xmlns:xlink', xlink_ns)
+    try:
+        for symbol_id, data in images:
+            doc = minidom.parseString(optimize_svg(data, precision))
+            svg = doc.documentElement
+            prefix_ids(svg, symbol_id + '-')
+            symbol = sprite.createElementNS(svg_ns, 'symbol')
+            symbol.setAttribute('id', symbol_id)
+            view_box = svg.getAttribute('viewBox')
+            if not view_box:
+                width = svg.getAttribute('width')
+                height = svg.getAttribute('height')
+                if number_re.match(width) and number_re.match(height):
+                    view_box = '0 0 %s %s' % (
+                        number_re.match(width).group(0),
+                        number_re.match(height).group(0))
+            if view_box:
+                symbol.setAttribute('viewBox', view_box)
+            if svg.hasAttribute('preserveAspectRatio'):
+                symbol.setAttribute('preserveAspectRatio',
+                                    svg.getAttribute('preserveAspectRatio'))
+            for child in list(svg.childNodes):
+                symbol.appendChild(sprite.importNode(child, True))
+            root.appendChild(symbol)
+            doc.unlink()
+        return root.toxml().encode('utf-8')
+    finally:
+        sprite.unlink()
+
 
 class SVGAsset(Asset):
     """
-    Asset handler for SVG files.
+    Asset handler for SVG files. When minifying, metadata, comments, editor
+    namespaces and whitespace are stripped, and path coordinates are rounded
+    to ``precision`` decimal places.
+
+    If ``sprite`` is the key of an ``SVGSpriteAsset`` in the same theme, the
+    image is also included in that sprite sheet, and in production is
+    rendered as an inline ``<svg>`` which ``<use>``s its symbol, so that all
+    of a page's icons are loaded with a single request.
     """
     extension = 'svg'
+    preload_as = 'image'
+
+    def __init__(self, url_path, precision=3, sprite=None):
+        self.url_path = url_path
+        self.precision = precision
+        self.sprite = sprite
 
     def compile(self, key, theme, output_dir, minify=True):
         """
         Compile an SVG entry point.
         """
         entry_point = theme.static_url_to_filesystem_path(self.url_path)
-        file_path = self.write_from_file(key, entry_point, self.url_path,
-                                         output_dir)
-        return file_path
+        if not minify:
+            return self.write_from_file(key, entry_point, self.url_path,
+                                        output_dir)
+        with open(entry_point, 'rb') as f:
+            data = optimize_svg(f.read(), self.precision)
+        return self.write_bytes(key, data, self.url_path, output_dir)
+
+    def tag(self, theme, url, production=True, **attrs):
+        attrs.setdefault('alt', '')
+        if production and self.sprite:
+            return self.tag_sprite(theme, attrs)
+        return HTML.img(src=url, **attrs)
+
+    def tag_sprite(self, theme, attrs):
+        """
+        Return an inline ``<svg>`` which uses this image's symbol in the
+        compiled sprite sheet.
+        """
+        symbol_id = theme.stacked_assets[self.sprite].symbol_id(theme, self)
+        sprite_url = '/compiled/%s/%s#%s' % (
+            theme.key, theme.compiled_asset_path(self.sprite), symbol_id)
+        attrs.pop('integrity', None)
+        attrs.pop('crossorigin', None)
+        alt = attrs.pop('alt')
+        if alt:
+            attrs.setdefault('role', 'img')
+            attrs.setdefault('aria-label', alt)
+        else:
+            attrs.setdefault('aria-hidden', 'true')
+        use = HTML.use(**{'href': sprite_url, 'xlink:href': sprite_url})
+        return HTML.svg(use, **attrs)
+
+
+class SVGSpriteAsset(SVGAsset):
+    """
+    A sprite sheet of the ``SVGAsset`` entry points in the same theme which
+    reference this asset's key with ``sprite``. Each image becomes a
+    ``<symbol>`` with the entry point's key as its ID, and IDs within the
+    image are prefixed with the key so that they don't collide.
+
+    The sprite itself doesn't render a tag: pages reference it through the
+    ``<use>`` tags of its images, and can preload it with
+    ``request.asset_preload()``.
+    """
+    def __init__(self, name='sprite.svg', precision=3):
+        SVGAsset.__init__(self, None, precision=precision)
+        self.name = name
+
+    def entry_points(self, theme):
+        """
+        Return a sorted list of the ``(key, asset)`` pairs of the entry
+        points of ``theme`` which are included in this sprite.
+        """
+        return [(key, asset)
+                for key, asset in sorted(theme.stacked_assets.items())
+                if getattr(asset, 'sprite', None) and
+                theme.stacked_assets.get(asset.sprite) is self]
+
+    def symbol_id(self, theme, asset):
+        for key, other in self.entry_points(theme):
+            if other is asset:
+                return key
+        raise KeyError('%r is not in this sprite' % asset.url_path)
+
+    def dependencies(self, theme):
+        return [theme.static_url_to_filesystem_path(asset.url_path)
+                for key, asset in self.entry_points(theme)]
+
+    def theme_options(self, theme):
+        return [SVGAsset.theme_options(self, theme),
+                [(key, asset.url_path)
+                 for key, asset in self.entry_points(theme)]]
+
+    def compile(self, key, theme, output_dir, minify=True):
+        """
+        Compile the sprite sheet.
+        """
+        images = []
+        for symbol_id, asset in self.entry_points(theme):
+            path = theme.static_url_to_filesystem_path(asset.url_path)
+            with open(path, 'rb') as f:
+                images.append((symbol_id, f.read()))
+        log.debug('Combining %d images into %s ...', len(images), self.name)
+        data = build_sprite(images, self.precision)
+        return self.write_bytes(key, data, self.name, output_dir)
 
-    def tag(self, theme, url, **kw):
-        return HTML.img(src=url, alt=kw.get('alt', ''), **kw)
+    def tag(self, theme, url, production=True, **attrs):
+        return ''
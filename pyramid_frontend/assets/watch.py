@@ -0,0 +1,179 @@
+"""
+Filesystem watching for ``pcompile --watch``: watchers which report changed
+files in a set of directory trees, and an index of which entry points each
+input file affects.
+
+Changes are detected with inotify if the ``inotify_simple`` package is
+installed (on Linux), and otherwise by periodically scanning the directories.
+"""
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+log = logging.getLogger(__name__)
+
+
+class PollingWatcher(object):
+    """
+    Detects changes by scanning directory trees for files which have been
+    added, removed, or have a different size or modification time, every
+    ``interval`` seconds.
+    """
+
+    def __init__(self, dirs, interval=1.0):
+        self.dirs = list(dirs)
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for top in self.dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def poll(self):
+        """
+        Return the set of paths which have changed since the last call.
+        """
+        snapshot = self.scan()
+        changed = set(path for path, stamp in snapshot.items()
+                      if self.snapshot.get(path) != stamp)
+        changed.update(set(self.snapshot) - set(snapshot))
+        self.snapshot = snapshot
+        return changed
+
+    def wait(self):
+        """
+        Block until files have changed, and return the set of their paths.
+        """
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Detects changes with inotify. Events which arrive within ``settle``
+    seconds of each other are reported together, since editors often write
+    a file in several steps.
+    """
+
+    def __init__(self, dirs, settle=0.1):
+        flags = inotify_simple.flags
+        self.mask = (flags.CREATE | flags.CLOSE_WRITE | flags.DELETE |
+                     flags.MOVED_FROM | flags.MOVED_TO)
+        self.settle = settle
+        self.inotify = inotify_simple.INotify()
+        self.watches = {}
+        for top in dirs:
+            self.add_tree(top)
+
+    def add_tree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = self.inotify.add_watch(dirpath, self.mask)
+            self.watches[wd] = dirpath
+
+    def wait(self):
+        changed = set()
+        events = self.inotify.read()
+        while events:
+            for event in events:
+                dirpath = self.watches.get(event.wd)
+                if dirpath is None or not event.name:
+                    continue
+                path = os.path.join(dirpath, event.name)
+                if event.mask & inotify_simple.flags.ISDIR:
+                    if event.mask & (inotify_simple.flags.CREATE |
+                                     inotify_simple.flags.MOVED_TO):
+                        self.add_tree(path)
+                    continue
+                changed.add(path)
+            events = self.inotify.read(timeout=int(self.settle * 1000))
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def make_watcher(dirs, interval=1.0):
+    """
+    Return an ``InotifyWatcher`` for ``dirs`` if possible, otherwise a
+    ``PollingWatcher``.
+    """
+    if inotify_simple:
+        try:
+            return InotifyWatcher(dirs)
+        except OSError as e:
+            # e.g. the limit on the number of watches has been reached.
+            log.warn('Could not use inotify (%s), polling instead.', e)
+    return PollingWatcher(dirs, interval=interval)
+
+
+class DependencyIndex(object):
+    """
+    Maps input files to the ``(theme key, entry point key)`` pairs which
+    depend on them, according to each asset's ``dependencies()``, which
+    follow the LESS import graph and the RequireJS module directories.
+    """
+
+    def __init__(self, themes):
+        self.themes = dict((theme.key, theme) for theme in themes)
+        self.deps = {}
+        self.refresh()
+
+    def refresh(self, entries=None):
+        """
+        Recompute the dependencies of ``entries`` (or of every entry point),
+        since edits can add or remove imports.
+        """
+        if entries is None:
+            entries = [(theme_key, key)
+                       for theme_key, theme in self.themes.items()
+                       for key in theme.stacked_assets]
+        for theme_key, key in entries:
+            theme = self.themes[theme_key]
+            try:
+                paths = theme.stacked_assets[key].dependencies(theme)
+            except Exception as e:
+                # e.g. an import of a file which doesn't exist yet. Keep the
+                # previous dependencies, so fixing it triggers a rebuild.
+                log.debug('Could not find dependencies of %s/%s: %s',
+                          theme_key, key, e)
+                continue
+            self.deps[(theme_key, key)] = set(
+                os.path.abspath(path) for path in paths)
+
+    def affected(self, paths):
+        """
+        Return the set of ``(theme key, entry point key)`` pairs which depend
+        on any of ``paths``. If some of the paths aren't known inputs, such as
+        new files, dependencies are recomputed first.
+        """
+        paths = set(os.path.abspath(path) for path in paths)
+        known = set()
+        for deps in self.deps.values():
+            known.update(deps)
+        if not paths <= known:
+            self.refresh()
+        return set(entry for entry, deps in self.deps.items()
+                   if deps & paths)
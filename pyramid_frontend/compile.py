@@ -3,23 +3,324 @@ from __future__ import absolute_import, print_function, division
 import logging
 
 import argparse
+import os.path
 import sys
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
 
+import six
 from pyramid.paster import bootstrap
 
+from .assets.cache import BuildCache
+from .assets.daemon import CompilerPool, set_compiler
+from .assets.manifest import (build_manifest, write_manifest,
+                              manifest_path, load_manifest)
+from .assets.watch import DependencyIndex, make_watcher
+from .assets.builds import (versioned_builds, keep_builds, compiled_root,
+                            start_build, seed_build, activate_build,
+                            prune_builds, rollback)
 
-def compile(registry, minify=True):
+
+class CompileError(Exception):
+    """
+    Raised when one or more assets failed to compile, and compilation was
+    allowed to continue past the first failure. ``failures`` is a list of
+    ``(theme_key, asset_key, exc_info)`` tuples.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        Exception.__init__(self, 'failed to compile %s' % ', '.join(
+            '%s/%s' % (theme_key, key) for theme_key, key, exc_info in
+            failures))
+
+
+class JobLogBuffer(logging.Filter):
+    """
+    A logging filter which, on threads that have called ``start()``, captures
+    log records instead of letting handlers emit them. This is used to keep
+    the log output of concurrent compile jobs from being interleaved: each
+    job's records are replayed together once it has finished.
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def start(self):
+        self.local.records = []
+
+    def stop(self):
+        records = getattr(self.local, 'records', None) or []
+        self.local.records = None
+        return records
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        # The same record is passed through the filter of each handler.
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
+
+    def handlers(self, logger):
+        while logger:
+            for handler in logger.handlers:
+                yield handler
+            if not logger.propagate:
+                break
+            logger = logger.parent
+
+    def install(self, logger):
+        for handler in self.handlers(logger):
+            handler.addFilter(self)
+
+    def uninstall(self, logger):
+        for handler in self.handlers(logger):
+            handler.removeFilter(self)
+
+    def replay(self, records):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+def compile_job(job, log_buffer=None, cache=None):
+    """
+    Compile a single ``(theme, key, minify, fingerprint)`` job, returning a
+    tuple of the job's buffered log records, the compiled file path, and
+    exception info (or ``None`` on success).
+    """
+    theme, key, minify, fingerprint = job
+    if log_buffer:
+        log_buffer.start()
+    file_path = exc_info = None
+    try:
+        file_path = theme.compile_asset(key, minify=minify, cache=cache,
+                                        fingerprint=fingerprint)
+    except Exception:
+        exc_info = sys.exc_info()
+    records = log_buffer.stop() if log_buffer else []
+    return records, file_path, exc_info
+
+
+def compile(registry, minify=True, jobs=1, keep_going=False, force=False,
+            daemon=False, node_path='node', only=None):
     """
     Compile static assets for all themes which are registered in ``registry``.
+
+    A build cache is kept in ``pyramid_frontend.compiled_asset_dir``, and
+    assets whose inputs have not changed since the last build are skipped,
+    unless ``force`` is true. Entry points which are inherited by several
+    themes and have identical inputs in each are only compiled once: the
+    compiled file is hard-linked into the other themes' directories.
+
+    When every asset compiles successfully, a manifest of all compiled files
+    is written to ``pyramid_frontend.compiled_asset_dir``, and the compiled
+    themes are updated to use it.
+
+    If ``daemon`` is true, LESS and RequireJS assets are compiled by a pool of
+    long-lived Node workers (see ``pyramid_frontend.assets.daemon``), rather
+    than by starting ``lessc`` and ``r.js`` for each entry point. If the
+    workers can't be started, the command line tools are used instead.
+
+    Up to ``jobs`` assets are compiled concurrently. The log output of each
+    asset is buffered while it compiles and emitted in order.
+
+    By default, the first failure is re-raised and no further assets are
+    compiled. If ``keep_going`` is true, all remaining assets are compiled, and
+    a ``CompileError`` listing all failures is raised at the end.
+
+    If ``only`` is supplied, only the entry points in that set of ``(theme
+    key, entry point key)`` pairs are compiled, and their entries in the
+    existing manifest are updated.
+
+    If the ``pyramid_frontend.versioned_builds`` setting is enabled, assets
+    are compiled into a new build directory, which unchanged files are
+    hard-linked into from the current build, and the ``current`` symlink is
+    switched to it once every asset has compiled (see
+    ``pyramid_frontend.assets.builds``). Builds which fail are discarded.
     """
     log = logging.getLogger('pyramid_frontend')
     settings = registry.settings
     theme_registry = settings['pyramid_frontend.theme_registry']
-    themes = theme_registry.values()
+    themes = list(theme_registry.values())
     count = len(themes)
-    for ii, theme in enumerate(themes):
-        log.warn("%d / %d - Compiling theme: %s", ii + 1, count, theme.key)
-        theme.compile(minify=minify)
+
+    root = settings['pyramid_frontend.compiled_asset_dir']
+    cache = BuildCache(os.path.join(root, 'build-cache.json'))
+    if force:
+        cache.clear()
+
+    build_dir = None
+    if versioned_builds(settings):
+        build_dir = start_build(root)
+        seed_build(compiled_root(settings), build_dir,
+                   load_manifest(manifest_path(settings)),
+                   dict((theme.key, theme) for theme in themes))
+        for theme in themes:
+            theme.build_dir = build_dir
+
+    # Only the first job with a given fingerprint is actually compiled.
+    queue = []
+    to_compile = []
+    seen = set()
+    for theme in themes:
+        for key in sorted(theme.stacked_assets):
+            if only is not None and (theme.key, key) not in only:
+                continue
+            asset = theme.stacked_assets[key]
+            try:
+                fingerprint = cache.fingerprint(theme, asset, minify)
+            except Exception:
+                # Let the error surface when the asset is compiled.
+                fingerprint = None
+            job = (theme, key, minify, fingerprint)
+            queue.append(job)
+            if fingerprint is None or fingerprint not in seen:
+                to_compile.append(job)
+                seen.add(fingerprint)
+
+    if daemon:
+        compiler = CompilerPool(size=max(jobs, 1), node_path=node_path)
+        set_compiler(compiler)
+    else:
+        compiler = None
+
+    if jobs > 1:
+        log_buffer = JobLogBuffer()
+        log_buffer.install(log)
+        pool = ThreadPool(jobs)
+        results = pool.imap(
+            lambda job: compile_job(job, log_buffer, cache), to_compile)
+    else:
+        log_buffer = pool = None
+        results = six.moves.map(
+            lambda job: compile_job(job, cache=cache), to_compile)
+
+    compiled = {}
+    outputs = {}
+    failures = []
+    current_theme = None
+    finished = False
+    try:
+        for theme, key, minify, fingerprint in queue:
+            if theme is not current_theme:
+                current_theme = theme
+                log.warn("%d / %d - Compiling theme: %s",
+                         themes.index(theme) + 1, count, theme.key)
+
+            if fingerprint in compiled:
+                source_path, exc_info = compiled[fingerprint]
+                if not exc_info:
+                    log.info('Identical to %s, linking: %s/%s',
+                             source_path, theme.key, key)
+                    try:
+                        file_path = theme.link_compiled_asset(key,
+                                                              source_path)
+                        cache.record(theme, key, fingerprint, file_path)
+                    except Exception:
+                        exc_info = sys.exc_info()
+            else:
+                records, file_path, exc_info = next(results)
+                if log_buffer:
+                    log_buffer.replay(records)
+                if fingerprint is not None:
+                    compiled[fingerprint] = file_path, exc_info
+
+            if exc_info:
+                if not keep_going:
+                    six.reraise(*exc_info)
+                log.error('Failed to compile %s/%s', theme.key, key,
+                          exc_info=exc_info)
+                failures.append((theme.key, key, exc_info))
+            else:
+                outputs.setdefault(theme.key, {})[key] = file_path
+        finished = True
+    finally:
+        if pool:
+            pool.terminate()
+            log_buffer.uninstall(log)
+        if compiler:
+            set_compiler(None)
+            compiler.close()
+        cache.save()
+        if build_dir and (failures or not finished):
+            log.warn('Discarding build %s', os.path.basename(build_dir))
+            shutil.rmtree(build_dir, ignore_errors=True)
+            for theme in themes:
+                theme.build_dir = None
+
+    if failures:
+        raise CompileError(failures)
+
+    manifest = build_manifest(outputs)
+    if only is not None:
+        # The loaded manifest is shared, so update a copy.
+        existing = dict(load_manifest(manifest_path(settings)) or {})
+        for theme_key, entries in manifest.items():
+            existing[theme_key] = dict(existing.get(theme_key, {}),
+                                       **entries)
+        manifest = existing
+    if build_dir:
+        write_manifest(os.path.join(build_dir, 'manifest.json'), manifest)
+        activate_build(root, build_dir)
+        prune_builds(root, keep_builds(settings))
+        for theme in themes:
+            theme.build_dir = None
+    else:
+        write_manifest(manifest_path(settings), manifest)
+    for theme in themes:
+        theme.use_manifest(manifest)
+
+
+def watch(registry, minify=True, interval=1.0, watcher=None, **kwargs):
+    """
+    Compile static assets for all themes which are registered in
+    ``registry``, then watch the themes' static directories, and recompile
+    the entry points affected by each change, until interrupted. Other
+    keyword arguments are passed to ``compile()``. Failures are logged
+    rather than raised, and rebuilt once their inputs change again.
+
+    ``interval`` is the time in seconds between scans of the directories, if
+    inotify isn't available.
+    """
+    log = logging.getLogger('pyramid_frontend')
+    settings = registry.settings
+    themes = list(settings['pyramid_frontend.theme_registry'].values())
+    kwargs['keep_going'] = True
+
+    try:
+        compile(registry, minify=minify, **kwargs)
+    except CompileError as e:
+        log.error(str(e))
+    kwargs.pop('force', None)
+
+    if watcher is None:
+        dirs = []
+        for theme in themes:
+            for key, dir in theme.keyed_static_dirs:
+                dir = os.path.abspath(dir)
+                if dir not in dirs and os.path.isdir(dir):
+                    dirs.append(dir)
+        watcher = make_watcher(dirs, interval=interval)
+    index = DependencyIndex(themes)
+
+    log.warn('Watching for changes ...')
+    try:
+        while True:
+            affected = index.affected(watcher.wait())
+            if not affected:
+                continue
+            log.warn('Recompiling %s', ', '.join(
+                '%s/%s' % entry for entry in sorted(affected)))
+            try:
+                compile(registry, minify=minify, only=affected, **kwargs)
+            except CompileError as e:
+                log.error(str(e))
+            index.refresh(affected)
+    finally:
+        watcher.close()
 
 
 class ConsoleHandler(logging.StreamHandler):
@@ -78,6 +379,28 @@ def main(args=sys.argv):
     """
     parser = argparse.ArgumentParser(description='Compile static assets.')
     parser.add_argument('--no-minify', action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of assets to compile concurrently.')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        default=False,
+                        help='Continue compiling after an asset fails.')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Recompile all assets, ignoring the build '
+                        'cache.')
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help='Compile LESS and RequireJS assets with '
+                        'persistent Node workers.')
+    parser.add_argument('--node', default='node',
+                        help='Path to the node executable used by --daemon.')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Keep running, and recompile assets when their '
+                        'inputs change.')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Seconds between scans for changes with --watch, '
+                        'when inotify is not available.')
+    parser.add_argument('--rollback', action='store_true', default=False,
+                        help='Serve the previous versioned build, instead of '
+                        'compiling.')
     parser.add_argument('-v', '--verbose', action='count', default=2)
     parser.add_argument('config_uri')
 
@@ -86,5 +409,41 @@ def main(args=sys.argv):
     env = bootstrap(options.config_uri)
     configure_logging(options.verbose)
     registry = env['registry']
-    compile(registry, minify=(not options.no_minify))
+    log = logging.getLogger('pyramid_frontend')
+    if options.rollback:
+        settings = registry.settings
+        if not versioned_builds(settings):
+            log.error('--rollback requires pyramid_frontend.versioned_builds')
+            return 1
+        root = settings['pyramid_frontend.compiled_asset_dir']
+        try:
+            build_id = rollback(root)
+        except ValueError as e:
+            log.error(str(e))
+            return 1
+        log.warn('Rolled back to build %s', build_id)
+        return 0
+    if options.watch:
+        try:
+            watch(registry,
+                  minify=(not options.no_minify),
+                  interval=options.interval,
+                  jobs=options.jobs,
+                  force=options.force,
+                  daemon=options.daemon,
+                  node_path=options.node)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    try:
+        compile(registry,
+                minify=(not options.no_minify),
+                jobs=options.jobs,
+                keep_going=options.keep_going,
+                force=options.force,
+                daemon=options.daemon,
+                node_path=options.node)
+    except CompileError as e:
+        log.error(str(e))
+        return 1
     return 0
@@ -6,6 +6,7 @@ from .files import (prefix_for_name, get_url_prefix, original_path,
                     save_image, save_to_error_dir, check, filter_sep)
 from .view import ImageView, MissingOriginal
 from .chain import PassThroughFilterChain, FilterChain
+from .stats import AccessLog
 
 __all__ = ['FilterChain', 'MissingOriginal',
            'save_image', 'save_to_error_dir', 'check', 'filter_sep']
@@ -114,7 +115,15 @@ def includeme(config):
     config.add_request_method(image_tag, 'image_tag')
     config.add_request_method(image_original_path, 'image_original_path')
 
-    url_prefix = get_url_prefix(config.registry.settings)
+    settings = config.registry.settings
+    access_log_path = settings.get('pyramid_frontend.image_access_log')
+    if access_log_path:
+        config.registry.image_access_log = AccessLog(
+            access_log_path,
+            sample_rate=float(settings.get(
+                'pyramid_frontend.image_access_sample_rate', 1)))
+
+    url_prefix = get_url_prefix(settings)
     config.add_route('pyramid_frontend:images',
                      '%s/{prefix}/{name:.+\.\w+}' % url_prefix)
     config.add_view(ImageView, route_name='pyramid_frontend:images')
@@ -0,0 +1,146 @@
+"""
+An asyncio-based (ASGI) entry point for serving processed images. Requires
+Python 3.7 or later, and is left out of installs on older versions.
+"""
+from __future__ import absolute_import, print_function, division
+
+import asyncio
+import mimetypes
+import os.path
+
+from pyramid.httpexceptions import HTTPNotFound
+
+from .files import get_url_prefix, processed_path
+from .view import resolve_image, process_image, MissingOriginal
+
+
+class AsyncImageService(object):
+    """
+    An ASGI application which serves processed images, resolving URLs the same
+    way as ``ImageView``.
+
+    Image processing runs in ``executor`` (the event loop's default executor if
+    ``None``), so the event loop is never blocked on PIL, external tools, or
+    the processing lock file. Concurrent requests for the same uncached variant
+    wait on a single in-process future, rather than each queueing a processing
+    job. Files are streamed in chunks of ``chunk_size`` bytes.
+
+    Construct it with the registry of a configured Pyramid application, and
+    mount it under ``pyramid_frontend.image_url_prefix`` with an ASGI server.
+    """
+
+    def __init__(self, registry, executor=None, chunk_size=65536):
+        self.registry = registry
+        self.settings = registry.settings
+        self.url_prefix = get_url_prefix(self.settings)
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.inflight = {}
+
+    async def process(self, name, original_ext, chain):
+        """
+        Return the path to the processed image, processing it first if
+        necessary.
+        """
+        proc_path = processed_path(self.settings, name, original_ext, chain)
+        if os.path.exists(proc_path):
+            return proc_path
+
+        future = self.inflight.get(proc_path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, process_image,
+                                          self.settings, name, original_ext,
+                                          chain)
+            self.inflight[proc_path] = future
+            future.add_done_callback(
+                lambda f: self.inflight.pop(proc_path, None))
+        # Shield the shared future, so that one client disconnecting doesn't
+        # cancel processing for everyone else waiting on it.
+        return await asyncio.shield(future)
+
+    async def respond_error(self, send, status, message):
+        body = message.encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain'),
+                        (b'content-length', str(len(body)).encode('ascii'))],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def stream_file(self, send, path, head=False):
+        loop = asyncio.get_running_loop()
+        content_type = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        f = await loop.run_in_executor(self.executor, open, path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', content_type.encode('ascii')),
+                    (b'content-length', str(size).encode('ascii')),
+                ],
+            })
+            if head:
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            while True:
+                chunk = await loop.run_in_executor(self.executor, f.read,
+                                                   self.chunk_size)
+                more = len(chunk) == self.chunk_size
+                await send({'type': 'http.response.body',
+                            'body': chunk,
+                            'more_body': more})
+                if not more:
+                    return
+        finally:
+            f.close()
+
+    async def lifespan(self, receive, send):
+        """
+        Acknowledge the server's startup and shutdown events: there's nothing
+        to set up or tear down.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('unsupported ASGI scope type: %r' %
+                             scope['type'])
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond_error(send, 405, 'Method Not Allowed')
+            return
+
+        path = scope['path']
+        if not path.startswith(self.url_prefix + '/'):
+            await self.respond_error(send, 404, 'Not Found')
+            return
+        parts = path[len(self.url_prefix) + 1:].split('/', 1)
+
+        try:
+            if len(parts) != 2:
+                raise HTTPNotFound()
+            name, original_ext, chain = resolve_image(self.registry, *parts)
+            proc_path = await self.process(name, original_ext, chain)
+        except (HTTPNotFound, MissingOriginal):
+            await self.respond_error(send, 404, 'Not Found')
+            return
+
+        access_log = getattr(self.registry, 'image_access_log', None)
+        if access_log:
+            access_log.record(name, original_ext, chain.suffix)
+
+        await self.stream_file(send, proc_path,
+                               head=(scope['method'] == 'HEAD'))
@@ -0,0 +1,189 @@
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import argparse
+import os
+import sys
+
+from pyramid.paster import bootstrap
+
+from ..compile import configure_logging
+from .files import iter_stored_images, original_path
+from .index import get_image_index
+from .stats import load_access_stats, compact_access_log, evict, warm_top
+from .view import get_image_filter
+from .warmer import Warmer
+
+log = logging.getLogger('pyramid_frontend')
+
+
+size_units = {
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+}
+
+
+def parse_size(s):
+    """
+    Parse a size in bytes, optionally with a K, M, G or T suffix.
+    """
+    s = s.strip().lower().rstrip('b')
+    multiplier = size_units.get(s[-1:], 1)
+    if multiplier != 1:
+        s = s[:-1]
+    try:
+        return int(float(s) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: %r' % s)
+
+
+def load_stats(settings):
+    path = settings.get('pyramid_frontend.image_access_log')
+    if not path:
+        log.warning('pyramid_frontend.image_access_log is not configured, '
+                    'no access statistics are available.')
+        return {}
+    return load_access_stats(path)
+
+
+def require_index(settings):
+    index = get_image_index(settings)
+    if not index:
+        log.error('pyramid_frontend.image_index is not configured.')
+        sys.exit(1)
+    return index
+
+
+def list_command(registry, options):
+    index = require_index(registry.settings)
+    if options.originals:
+        rows = index.iter_originals()
+    else:
+        rows = index.iter_variants()
+    for path, name, original_ext, suffix, size, mtime in rows:
+        print(path)
+
+
+def reindex_command(registry, options):
+    index = require_index(registry.settings)
+    count = 0
+    for kind, path, name, original_ext, suffix in \
+            iter_stored_images(registry.settings):
+        if kind == 'original':
+            index.add_original(path, name, original_ext)
+        else:
+            index.add_variant(path, name, original_ext, suffix)
+        count += 1
+    log.warning('Indexed %d images.', count)
+
+
+def gc_command(registry, options):
+    settings = registry.settings
+    index = require_index(settings)
+    removed = 0
+    for path, name, original_ext, suffix, size, mtime in index.iter_orphans():
+        if os.path.exists(original_path(settings, name, original_ext)):
+            continue
+        log.debug('Removing orphaned %s ...', path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        index.remove(path)
+        removed += 1
+    log.warning('Removed %d orphaned processed images.', removed)
+
+
+def evict_command(registry, options):
+    stats = load_stats(registry.settings)
+    removed, freed = evict(registry, options.max_size, stats)
+    log.warning('Evicted %d processed images, freeing %d bytes.',
+                removed, freed)
+    path = registry.settings.get('pyramid_frontend.image_access_log')
+    if path:
+        count = compact_access_log(path)
+        log.warning('Compacted access log to %d variants.', count)
+
+
+def warm_command(registry, options):
+    warmer = Warmer(registry.settings,
+                    concurrency=options.jobs,
+                    tool_concurrency=options.tool_jobs,
+                    max_load=options.max_load)
+    if options.chain:
+        index = require_index(registry.settings)
+        chain = get_image_filter(registry, options.chain)
+        count = 0
+        for path, name, original_ext, suffix, size, mtime in \
+                index.iter_originals():
+            warmer.add(name, original_ext, chain, priority=mtime,
+                       overwrite=options.overwrite)
+            count += 1
+    else:
+        stats = load_stats(registry.settings)
+        count = warm_top(registry, stats, warmer, options.top,
+                         overwrite=options.overwrite)
+    log.warning('Warming %d processed images ...', count)
+    processed, failed = warmer.run()
+    log.warning('Processed %d images, %d failed.', processed, failed)
+
+
+def main(args=sys.argv):
+    """
+    Main entry point for the executable which manages processed images.
+    """
+    parser = argparse.ArgumentParser(description='Manage processed images.')
+    parser.add_argument('-v', '--verbose', action='count', default=2)
+    subparsers = parser.add_subparsers(dest='command')
+
+    evict_parser = subparsers.add_parser(
+        'evict', help='Remove least-recently-used processed images.')
+    evict_parser.add_argument('--max-size', type=parse_size, required=True,
+                              help='Disk budget for processed images, '
+                              'e.g. 20G.')
+    evict_parser.add_argument('config_uri')
+    evict_parser.set_defaults(func=evict_command)
+
+    warm_parser = subparsers.add_parser(
+        'warm', help='Process the most frequently requested images.')
+    warm_parser.add_argument('--top', type=int, default=1000)
+    warm_parser.add_argument('--chain', default=None,
+                             help='Process all indexed originals with this '
+                             'filter chain, instead of the most frequently '
+                             'requested variants.')
+    warm_parser.add_argument('--overwrite', action='store_true',
+                             default=False)
+    warm_parser.add_argument('-j', '--jobs', type=int, default=None)
+    warm_parser.add_argument('--tool-jobs', type=int, default=None)
+    warm_parser.add_argument('--max-load', type=float, default=None)
+    warm_parser.add_argument('config_uri')
+    warm_parser.set_defaults(func=warm_command)
+
+    list_parser = subparsers.add_parser(
+        'list', help='List indexed processed images.')
+    list_parser.add_argument('--originals', action='store_true',
+                             default=False)
+    list_parser.add_argument('config_uri')
+    list_parser.set_defaults(func=list_command)
+
+    reindex_parser = subparsers.add_parser(
+        'reindex', help='Rebuild the image index from the filesystem.')
+    reindex_parser.add_argument('config_uri')
+    reindex_parser.set_defaults(func=reindex_command)
+
+    gc_parser = subparsers.add_parser(
+        'gc', help='Remove processed images whose original is missing.')
+    gc_parser.add_argument('config_uri')
+    gc_parser.set_defaults(func=gc_command)
+
+    options = parser.parse_args(args[1:])
+    if not getattr(options, 'func', None):
+        parser.error('a command is required')
+
+    env = bootstrap(options.config_uri)
+    configure_logging(options.verbose)
+    options.func(env['registry'], options)
+    return 0
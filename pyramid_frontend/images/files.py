@@ -8,6 +8,8 @@ from datetime import datetime
 
 from PIL import Image
 
+from .index import get_image_index
+
 
 filter_sep = '_'
 
@@ -28,7 +30,12 @@ def get_url_prefix(settings):
 def save_image(settings, name, original_ext, f):
     prefix = prefix_for_name(name)
     ensure_dirs(settings, prefix)
-    save_locally(original_path(settings, name, original_ext), f)
+    path = original_path(settings, name, original_ext)
+    save_locally(path, f)
+
+    index = get_image_index(settings)
+    if index:
+        index.add_original(path, name, original_ext)
 
 
 def save_locally(path, f):
@@ -85,6 +92,32 @@ def processed_path(settings, name, original_ext, chain):
         chain.basename(name, original_ext))
 
 
+def iter_stored_images(settings):
+    """
+    Walk the original and processed image directories, yielding a ``(kind,
+    path, name, original_ext, suffix)`` tuple for each stored image, where
+    ``kind`` is either ``'original'`` or ``'variant'``. Pass-through variants
+    have a ``suffix`` of ``None``.
+    """
+    dirs = [
+        ('original', settings['pyramid_frontend.original_image_dir']),
+        ('variant', settings['pyramid_frontend.processed_image_dir']),
+    ]
+    for kind, base_dir in dirs:
+        for dirpath, dirnames, filenames in os.walk(base_dir):
+            for filename in filenames:
+                if filename.endswith('.lock') or '.' not in filename:
+                    continue
+                base, ext = filename.rsplit('.', 1)
+                parts = base.split(filter_sep, 2)
+                if kind == 'variant' and len(parts) == 3:
+                    name, original_ext, suffix = parts
+                else:
+                    name, original_ext, suffix = base, ext, None
+                yield (kind, os.path.join(dirpath, filename),
+                       name, original_ext, suffix)
+
+
 def check_and_save_image(settings, name, f):
     """
     Save an image to the local ``pyramid_frontend`` image originals directory,
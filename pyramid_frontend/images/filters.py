@@ -3,7 +3,9 @@ from __future__ import absolute_import, print_function, division
 import shutil
 import tempfile
 import subprocess
+import threading
 import math
+from contextlib import contextmanager
 from six import BytesIO
 from six.moves import xrange
 
@@ -13,6 +15,56 @@ from .utils import (pad_image, flatten_alpha, crop_entropy,
                     is_white_background, is_larger, bounding_box, sharpen)
 
 
+# Semaphore bounding the number of external tool processes (pngcrush, optipng,
+# jpegoptim, convert) which may run at once in this process. ``None`` means
+# unlimited.
+shell_semaphore = None
+
+# Per-thread semaphores set by ``shell_limit``, which take precedence over
+# ``shell_semaphore``.
+shell_local = threading.local()
+
+
+def limit_shell_concurrency(limit):
+    """
+    Limit the number of concurrently running external tool processes in this
+    process to ``limit``. Pass ``None`` to remove the limit. Returns the
+    previous semaphore, so that callers can restore it.
+    """
+    global shell_semaphore
+    previous = shell_semaphore
+    shell_semaphore = threading.BoundedSemaphore(limit) if limit else None
+    return previous
+
+
+@contextmanager
+def shell_limit(semaphore):
+    """
+    A context manager under which external tool processes started by the
+    current thread are bounded by ``semaphore``, instead of the process-wide
+    limit. Passing ``None`` leaves the process-wide limit in effect.
+    """
+    previous = getattr(shell_local, 'semaphore', None)
+    shell_local.semaphore = semaphore
+    try:
+        yield
+    finally:
+        shell_local.semaphore = previous
+
+
+@contextmanager
+def shell_slot():
+    """
+    A context manager which holds one external tool slot for its duration.
+    """
+    semaphore = getattr(shell_local, 'semaphore', None) or shell_semaphore
+    if semaphore is None:
+        yield
+    else:
+        with semaphore:
+            yield
+
+
 class Filter(object):
     """
     Filter stage superclass. Instances are called with some input data and
@@ -69,10 +121,11 @@ class Filter(object):
                 arg = out.name
             processed_args.append(arg)
 
-        subprocess.check_call(processed_args,
-                              stdout=null,
-                              stderr=null,
-                              close_fds=True)
+        with shell_slot():
+            subprocess.check_call(processed_args,
+                                  stdout=null,
+                                  stderr=null,
+                                  close_fds=True)
         out.seek(0)
         return out
 
@@ -0,0 +1,163 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+import sqlite3
+import threading
+
+
+schema = '''\
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    original_ext TEXT NOT NULL,
+    suffix TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_kind_mtime ON images (kind, mtime);
+CREATE INDEX IF NOT EXISTS images_name ON images (name, original_ext);
+'''
+
+
+class ImageIndex(object):
+    """
+    A SQLite index of stored original images and processed variants, so that
+    bulk operations (listing, warming, eviction) don't need to walk the image
+    directories.
+
+    The index is safe to share between threads and processes: each thread uses
+    its own connection, and the database is opened in WAL mode.
+    """
+
+    batch_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            dirpath = os.path.dirname(self.path)
+            if dirpath and not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(schema)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _add(self, path, kind, name, original_ext, suffix):
+        try:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = 0, time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO images '
+                         '(path, kind, name, original_ext, suffix, size, '
+                         'mtime) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (path, kind, name, original_ext, suffix, size,
+                          mtime))
+
+    def add_original(self, path, name, original_ext):
+        """
+        Record a stored original image.
+        """
+        self._add(path, 'original', name, original_ext, None)
+
+    def add_variant(self, path, name, original_ext, suffix):
+        """
+        Record a processed variant of an image.
+        """
+        self._add(path, 'variant', name, original_ext, suffix)
+
+    def remove(self, path):
+        conn = self.connection()
+        with conn:
+            conn.execute('DELETE FROM images WHERE path = ?', (path,))
+
+    def _stream(self, sql, params):
+        # Rows are read in batches over a dedicated connection, so that large
+        # indexes aren't loaded into memory at once, and callers can remove
+        # rows while iterating: in WAL mode the reader keeps a consistent
+        # snapshot while writes go through the thread's own connection.
+        self.connection()
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            conn.close()
+
+    def _iter(self, kind, name=None, original_ext=None):
+        sql = ('SELECT path, name, original_ext, suffix, size, mtime '
+               'FROM images WHERE kind = ?')
+        params = [kind]
+        if name is not None:
+            sql += ' AND name = ? AND original_ext = ?'
+            params.extend([name, original_ext])
+        sql += ' ORDER BY mtime'
+        return self._stream(sql, params)
+
+    def iter_originals(self):
+        """
+        Yield a ``(path, name, original_ext, suffix, size, mtime)`` tuple for
+        each indexed original, oldest first. ``suffix`` is always ``None``.
+        """
+        return self._iter('original')
+
+    def iter_variants(self, name=None, original_ext=None):
+        """
+        Yield a ``(path, name, original_ext, suffix, size, mtime)`` tuple for
+        each indexed processed variant, oldest first. If ``name`` and
+        ``original_ext`` are given, only variants of that image are returned.
+        """
+        return self._iter('variant', name, original_ext)
+
+    def iter_orphans(self):
+        """
+        Yield a ``(path, name, original_ext, suffix, size, mtime)`` tuple for
+        each indexed processed variant whose original is not indexed.
+        """
+        return self._stream(
+            'SELECT v.path, v.name, v.original_ext, v.suffix, v.size, '
+            'v.mtime FROM images v LEFT JOIN images o '
+            'ON o.kind = ? AND o.name = v.name '
+            'AND o.original_ext = v.original_ext '
+            'WHERE v.kind = ? AND o.path IS NULL',
+            ('original', 'variant'))
+
+    def total_size(self, kind='variant'):
+        row = self.connection().execute(
+            'SELECT COALESCE(SUM(size), 0) FROM images WHERE kind = ?',
+            (kind,)).fetchone()
+        return row[0]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_image_index(settings):
+    """
+    Return the ``ImageIndex`` configured by the
+    ``pyramid_frontend.image_index`` setting, or ``None`` if no index is
+    configured.
+    """
+    path = settings.get('pyramid_frontend.image_index')
+    if not path:
+        return None
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = ImageIndex(path)
+        return _indexes[path]
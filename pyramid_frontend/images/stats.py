@@ -0,0 +1,264 @@
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import io
+import errno
+import time
+import heapq
+import atexit
+import random
+import weakref
+import threading
+
+from .files import processed_path
+from .index import get_image_index
+from .view import get_image_filter
+
+log = logging.getLogger(__name__)
+
+
+# AccessLog instances which are still in use, to flush at exit.
+live_logs = weakref.WeakSet()
+
+
+@atexit.register
+def flush_all():
+    """
+    Flush every live ``AccessLog``.
+    """
+    for access_log in list(live_logs):
+        access_log.flush()
+
+
+class AccessLog(object):
+    """
+    Records how often, and how recently, each processed image variant is
+    requested.
+
+    Accesses are sampled at ``sample_rate`` and counted in memory, then
+    appended to the log file at ``path`` once ``flush_size`` accesses have been
+    buffered or ``flush_interval`` seconds have passed. Each line of the log
+    file is a tab-separated record of ``last_access``, ``count``, ``name``,
+    ``original_ext`` and ``suffix``. Multiple processes may append to the same
+    file.
+    """
+
+    def __init__(self, path, sample_rate=1.0, flush_interval=60,
+                 flush_size=1000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.lock = threading.Lock()
+        self.buffer = {}
+        self.pending = 0
+        self.last_flush = time.time()
+        live_logs.add(self)
+
+    def record(self, name, original_ext, suffix):
+        """
+        Record an access of the variant of image ``name`` processed by the
+        filter chain with ``suffix``.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        now = time.time()
+        key = (name, original_ext, suffix or '')
+        with self.lock:
+            count, last_access = self.buffer.get(key, (0, now))
+            self.buffer[key] = (count + 1, now)
+            self.pending += 1
+            should_flush = (self.pending >= self.flush_size or
+                            now - self.last_flush >= self.flush_interval)
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Append all buffered counts to the log file.
+        """
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = {}
+            self.pending = 0
+            self.last_flush = time.time()
+        if not buffer:
+            return
+        lines = [format_record(key, count, last_access)
+                 for key, (count, last_access) in buffer.items()]
+        log.debug('Flushing %d access records to %s', len(lines), self.path)
+        with io.open(self.path, 'a', encoding='utf8') as f:
+            f.write(u''.join(lines))
+
+
+def load_access_stats(path):
+    """
+    Read an access log file written by ``AccessLog``, and return a dict mapping
+    ``(name, original_ext, suffix)`` to a ``(count, last_access)`` tuple.
+    """
+    stats = {}
+    if not os.path.exists(path):
+        return stats
+    with io.open(path, encoding='utf8') as f:
+        for line in f:
+            try:
+                last_access, count, name, original_ext, suffix = \
+                    line.rstrip(u'\n').split(u'\t')
+            except ValueError:
+                # Tolerate a partially-written trailing line.
+                continue
+            key = (name, original_ext, suffix or None)
+            prev_count, prev_last_access = stats.get(key, (0, 0))
+            stats[key] = (prev_count + int(count),
+                          max(prev_last_access, int(last_access)))
+    return stats
+
+
+def format_record(key, count, last_access):
+    name, original_ext, suffix = key
+    return u'%d\t%d\t%s\t%s\t%s\n' % (
+        last_access, count, name, original_ext, suffix or '')
+
+
+def compact_access_log(path):
+    """
+    Rewrite an access log file with a single aggregated line per variant, so
+    that it doesn't grow without bound. The file is first renamed aside, so
+    that records appended by running processes while it is being compacted
+    go to a new file, which the aggregated lines are then appended to.
+    Returns the number of variants.
+    """
+    old_path = '%s.%d.compacting' % (path, os.getpid())
+    try:
+        os.rename(path, old_path)
+    except OSError:
+        return 0
+    stats = load_access_stats(old_path)
+    lines = [format_record(key, count, last_access)
+             for key, (count, last_access) in sorted(stats.items())]
+    log.debug('Compacting %s to %d records', path, len(lines))
+    with io.open(path, 'a', encoding='utf8') as f:
+        f.write(u''.join(lines))
+    os.remove(old_path)
+    return len(lines)
+
+
+def iter_stat_paths(registry, stats):
+    """
+    Yield a ``(path, name, original_ext, chain, count, last_access)`` tuple for
+    each variant in ``stats`` whose filter chain is still registered.
+    """
+    settings = registry.settings
+    for (name, original_ext, suffix), (count, last_access) in stats.items():
+        try:
+            chain = get_image_filter(registry, suffix)
+        except KeyError:
+            continue
+        path = processed_path(settings, name, original_ext, chain)
+        yield path, name, original_ext, chain, count, last_access
+
+
+def iter_processed_files(settings):
+    """
+    Yield a ``(path, size, mtime)`` tuple for each processed image file. If an
+    image index is configured it is used, instead of walking the processed
+    image directory, and files are yielded oldest first.
+    """
+    index = get_image_index(settings)
+    if index:
+        for path, name, original_ext, suffix, size, mtime in \
+                index.iter_variants():
+            yield path, size, mtime
+        return
+
+    processed_dir = settings['pyramid_frontend.processed_image_dir']
+    for dirpath, dirnames, filenames in os.walk(processed_dir):
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_size, st.st_mtime
+
+
+def iter_least_recently_used(files, last_accesses):
+    """
+    Yield a ``(last_used, size, path)`` tuple for each of ``files``, a sequence
+    of ``(path, size, mtime)`` tuples ordered by ``mtime``, least recently used
+    first. The last use of a file is the later of its modification time and
+    its last access time in ``last_accesses``.
+
+    Only files which were accessed since they were last modified are held in
+    memory, everything else is passed through in order.
+    """
+    accessed = []
+    for path, size, mtime in files:
+        last_used = max(mtime, last_accesses.get(path, 0))
+        if last_used > mtime:
+            heapq.heappush(accessed, (last_used, size, path))
+            continue
+        while accessed and accessed[0] < (mtime, size, path):
+            yield heapq.heappop(accessed)
+        yield mtime, size, path
+    while accessed:
+        yield heapq.heappop(accessed)
+
+
+def evict(registry, max_bytes, stats):
+    """
+    Remove the least-recently-used processed images until the total size of
+    the processed image directory is at most ``max_bytes``. The last access
+    time of a file is taken from ``stats`` where available, falling back to its
+    modification time. Returns a ``(removed, freed_bytes)`` tuple.
+    """
+    last_accesses = {}
+    for path, name, original_ext, chain, count, last_access in \
+            iter_stat_paths(registry, stats):
+        last_accesses[path] = last_access
+
+    index = get_image_index(registry.settings)
+    files = iter_processed_files(registry.settings)
+    if index:
+        # The index yields files oldest first, so they can be streamed.
+        total = index.total_size()
+    else:
+        files = sorted(files, key=lambda el: el[2])
+        total = sum(size for path, size, mtime in files)
+
+    removed = freed = 0
+    for last_used, size, path in \
+            iter_least_recently_used(files, last_accesses):
+        if total <= max_bytes:
+            break
+        log.debug('Evicting %s ...', path)
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.warn('Could not evict %s: %s', path, e)
+                continue
+        if index:
+            index.remove(path)
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+def warm_top(registry, stats, warmer, top, overwrite=False):
+    """
+    Queue the ``top`` most frequently requested variants in ``stats`` for
+    processing by ``warmer``, prioritized by request count. Returns the number
+    of jobs queued.
+    """
+    ranked = sorted(iter_stat_paths(registry, stats),
+                    key=lambda el: el[4], reverse=True)
+    for path, name, original_ext, chain, count, last_access in ranked[:top]:
+        warmer.add(name, original_ext, chain, priority=count,
+                   overwrite=overwrite)
+    return min(top, len(ranked))
@@ -1,9 +1,13 @@
 from __future__ import absolute_import, print_function, division
 
 import os.path
+import sys
 import mimetypes
+import threading
 import pkg_resources
 
+import six
+
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.response import Response
 from pyramid.static import FileResponse
@@ -11,6 +15,7 @@ from pyramid.settings import asbool
 from lockfile import FileLock
 
 from .files import filter_sep, prefix_for_name, processed_path, original_path
+from .index import get_image_index
 
 
 plausible_extensions = set([
@@ -40,23 +45,119 @@ class MissingOriginal(Exception):
         Exception.__init__(self, 'Missing file %s' % path)
 
 
+def resolve_image(registry, url_prefix, filename):
+    """
+    Given the hash prefix and file name components of a processed image URL,
+    return a ``(name, original_ext, chain)`` tuple identifying the image and
+    the filter chain to process it with. Raises ``HTTPNotFound`` if the URL
+    does not refer to a plausible processed image.
+    """
+    if '.' not in filename:
+        raise HTTPNotFound()
+    name, ext = filename.rsplit('.', 1)
+
+    if filter_sep in name:
+        parts = name.split(filter_sep, 2)
+        if len(parts) == 3:
+            name, original_ext, chain_name = parts
+        else:
+            raise HTTPNotFound()
+    else:
+        original_ext = ext
+        chain_name = None
+
+    try:
+        chain = get_image_filter(registry, chain_name)
+    except KeyError:
+        raise HTTPNotFound()
+
+    if ((chain.extension and chain.extension != ext) or
+            prefix_for_name(name) != url_prefix):
+        raise HTTPNotFound()
+
+    if original_ext not in plausible_extensions:
+        raise HTTPNotFound()
+
+    return name, original_ext, chain
+
+
+class SingleFlight(object):
+    """
+    Ensures that a function is only running once at a time for a given key
+    within this process. Threads which call ``do()`` with a key that is already
+    in flight wait for the running call to finish, and share its result or
+    exception. If the running call is interrupted by a ``BaseException`` which
+    isn't an ``Exception`` (such as ``SystemExit``), the waiting threads make
+    the call again themselves.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'event': threading.Event()}
+
+        if not leader:
+            call['event'].wait()
+            if 'exc_info' in call:
+                six.reraise(*call['exc_info'])
+            if 'result' not in call:
+                return self.do(key, func, *args, **kwargs)
+            return call['result']
+
+        try:
+            call['result'] = func(*args, **kwargs)
+            return call['result']
+        except Exception:
+            call['exc_info'] = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['event'].set()
+
+
+# In-process coalescing of image processing, keyed by processed path and
+# whether it is being overwritten. This avoids polling the lock file when
+# several threads request the same image.
+processing_flight = SingleFlight()
+
+
+def _process_image_locked(settings, name, original_ext, chain, proc_path,
+                          overwrite):
+    dest_dir = os.path.dirname(proc_path)
+    try:
+        os.makedirs(dest_dir)
+    except OSError:
+        pass
+
+    lock = FileLock(proc_path + '.lock')
+    with lock:
+        if overwrite or (not os.path.exists(proc_path)):
+            orig_path = original_path(settings, name, original_ext)
+            if not os.path.exists(orig_path):
+                raise MissingOriginal(path=orig_path, chain=chain)
+            image_data = open(orig_path, 'rb')
+            chain.run(proc_path, image_data)
+
+            index = get_image_index(settings)
+            if index:
+                index.add_variant(proc_path, name, original_ext,
+                                  chain.suffix)
+
+
 def process_image(settings, name, original_ext, chain, overwrite=False):
     proc_path = processed_path(settings, name, original_ext, chain)
     if overwrite or (not os.path.exists(proc_path)):
-        dest_dir = os.path.dirname(proc_path)
-        try:
-            os.makedirs(dest_dir)
-        except OSError:
-            pass
-
-        lock = FileLock(proc_path + '.lock')
-        with lock:
-            if overwrite or (not os.path.exists(proc_path)):
-                orig_path = original_path(settings, name, original_ext)
-                if not os.path.exists(orig_path):
-                    raise MissingOriginal(path=orig_path, chain=chain)
-                image_data = open(orig_path, 'rb')
-                chain.run(proc_path, image_data)
+        processing_flight.do((proc_path, bool(overwrite)),
+                             _process_image_locked,
+                             settings, name, original_ext, chain, proc_path,
+                             overwrite)
     return proc_path
 
 
@@ -81,31 +182,10 @@ class ImageView(object):
         request = self.request
         settings = request.registry.settings
 
-        url_prefix = self.request.matchdict['prefix']
-        name = self.request.matchdict['name']
-        name, ext = name.rsplit('.', 1)
-
-        if filter_sep in name:
-            parts = name.split(filter_sep, 2)
-            if len(parts) == 3:
-                name, original_ext, chain_name = parts
-            else:
-                raise HTTPNotFound()
-        else:
-            original_ext = ext
-            chain_name = None
-
-        try:
-            chain = get_image_filter(request.registry, chain_name)
-        except KeyError:
-            raise HTTPNotFound()
-
-        if ((chain.extension and chain.extension != ext) or
-                prefix_for_name(name) != url_prefix):
-            raise HTTPNotFound()
-
-        if original_ext not in plausible_extensions:
-            raise HTTPNotFound()
+        name, original_ext, chain = resolve_image(
+            request.registry,
+            request.matchdict['prefix'],
+            request.matchdict['name'])
 
         debug = asbool(settings.get('pyramid_frontend.debug'))
         overwrite = debug and request.params.get('overwrite')
@@ -118,4 +198,9 @@ class ImageView(object):
                 return self.placeholder(chain)
             else:
                 raise
+
+        access_log = getattr(request.registry, 'image_access_log', None)
+        if access_log:
+            access_log.record(name, original_ext, chain.suffix)
+
         return FileResponse(proc_path, self.request)
@@ -0,0 +1,128 @@
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import os
+import time
+import heapq
+import itertools
+import threading
+import multiprocessing
+
+from . import filters
+from .files import original_path
+from .view import process_image, MissingOriginal
+
+log = logging.getLogger(__name__)
+
+
+class Warmer(object):
+    """
+    Process a batch of images through filter chains in the background, while
+    keeping the load it generates within configurable limits.
+
+    Jobs are run by ``concurrency`` worker threads (defaulting to the number of
+    CPUs): PIL releases the GIL while resizing and encoding, and the external
+    optimization tools run in their own processes. The number of external tool
+    processes running at once is separately bounded by ``tool_concurrency``.
+
+    If ``max_load`` is set, workers will pause before starting each job for as
+    long as the 1-minute load average of the machine exceeds it, re-checking
+    every ``pause_interval`` seconds.
+    """
+
+    def __init__(self, settings, concurrency=None, tool_concurrency=None,
+                 max_load=None, pause_interval=5):
+        self.settings = settings
+        self.concurrency = concurrency or multiprocessing.cpu_count()
+        self.tool_concurrency = tool_concurrency
+        self.max_load = max_load
+        self.pause_interval = pause_interval
+        self.queue = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, name, original_ext, chain, priority=None, overwrite=False):
+        """
+        Queue an image to be processed by ``chain``. Jobs with a higher
+        ``priority`` are run first (for example, a request count). If no
+        priority is given, the modification time of the original is used, so
+        that the most recently uploaded images are processed first.
+        """
+        if priority is None:
+            try:
+                priority = os.path.getmtime(
+                    original_path(self.settings, name, original_ext))
+            except OSError:
+                priority = 0
+        job = (name, original_ext, chain, overwrite)
+        with self.lock:
+            heapq.heappush(self.queue, (-priority, next(self.counter), job))
+
+    def next_job(self):
+        with self.lock:
+            if self.queue:
+                return heapq.heappop(self.queue)[-1]
+
+    def wait_for_load(self):
+        """
+        Block for as long as the system load is above ``max_load``.
+        """
+        if self.max_load is None:
+            return
+        while True:
+            load = os.getloadavg()[0]
+            if load <= self.max_load:
+                return
+            log.info('Load average %0.2f exceeds %0.2f, pausing for %s '
+                     'seconds.', load, self.max_load, self.pause_interval)
+            time.sleep(self.pause_interval)
+
+    def run_job(self, name, original_ext, chain, overwrite):
+        log.debug('Processing %s.%s with %r ...', name, original_ext, chain)
+        try:
+            process_image(self.settings, name, original_ext, chain,
+                          overwrite=overwrite)
+        except MissingOriginal as e:
+            log.warning('Missing original: %s', e.path)
+            return False
+        except Exception:
+            log.exception('Failed to process %s.%s with %r', name,
+                          original_ext, chain)
+            return False
+        return True
+
+    def work(self, tool_semaphore=None):
+        with filters.shell_limit(tool_semaphore):
+            while True:
+                job = self.next_job()
+                if job is None:
+                    return
+                self.wait_for_load()
+                success = self.run_job(*job)
+                with self.lock:
+                    if success:
+                        self.processed += 1
+                    else:
+                        self.failed += 1
+
+    def run(self):
+        """
+        Process all queued jobs, blocking until they are complete. Returns a
+        ``(processed, failed)`` tuple of job counts.
+        """
+        tool_semaphore = None
+        if self.tool_concurrency:
+            tool_semaphore = threading.BoundedSemaphore(self.tool_concurrency)
+        threads = [threading.Thread(target=self.work, args=(tool_semaphore,))
+                   for ii in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.processed, self.failed
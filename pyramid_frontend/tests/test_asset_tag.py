@@ -0,0 +1,125 @@
+from __future__ import absolute_import, print_function, division
+
+import os.path
+from unittest import TestCase
+
+from pyramid import testing
+
+from ..assets import asset_tag, asset_preload
+from ..assets.manifest import write_manifest
+
+from . import utils
+from .example import foo
+
+
+compiled_dir = os.path.join(utils.work_dir, 'asset-tag-tests')
+
+
+class AssetTagTestCase(TestCase):
+    compile = True
+
+    def setUp(self):
+        write_manifest(os.path.join(compiled_dir, 'manifest.json'), {
+            'foo': {
+                'main-less': {'file': 'main.css', 'size': 1,
+                              'integrity': 'sha384-css'},
+                'main-js': {'file': 'main.js', 'size': 1,
+                            'integrity': 'sha384-js'},
+                'logo-svg': {'file': 'logo.svg', 'size': 1,
+                             'integrity': 'sha384-svg'},
+            },
+        })
+        settings = dict(utils.default_settings)
+        settings['pyramid_frontend.compiled_asset_dir'] = compiled_dir
+        settings['pyramid_frontend.compile'] = self.compile
+        self.config = testing.setUp(settings=settings)
+        self.config.include('pyramid_frontend')
+        self.config.add_theme(foo.FooTheme)
+        self.config.commit()
+        self.request = testing.DummyRequest()
+        self.request.registry = self.config.registry
+        themes = self.config.registry.settings[
+            'pyramid_frontend.theme_registry']
+        self.request.theme = themes['foo']
+
+    def tearDown(self):
+        testing.tearDown()
+
+
+class TestIntegrity(AssetTagTestCase):
+    def test_integrity(self):
+        tag = asset_tag(self.request, 'main-less', integrity=True)
+        self.assertIn('integrity="sha384-css"', tag)
+        self.assertIn('crossorigin="anonymous"', tag)
+        tag = asset_tag(self.request, 'main-js', integrity=True,
+                        crossorigin='use-credentials')
+        self.assertIn('integrity="sha384-js"', tag)
+        self.assertIn('crossorigin="use-credentials"', tag)
+
+    def test_no_integrity(self):
+        tag = asset_tag(self.request, 'main-less')
+        self.assertIn('href="/compiled/foo/main.css"', tag)
+        self.assertNotIn('integrity', tag)
+        self.assertNotIn('crossorigin', tag)
+
+    def test_crossorigin_without_digest(self):
+        del self.request.theme.manifest['main-js']['integrity']
+        tag = asset_tag(self.request, 'main-js', integrity=True,
+                        crossorigin='use-credentials')
+        self.assertNotIn('integrity', tag)
+        self.assertIn('crossorigin="use-credentials"', tag)
+        tags = asset_preload(self.request, 'main-js', integrity=True,
+                             crossorigin='use-credentials')
+        self.assertIn('crossorigin="use-credentials"', tags)
+        self.assertIn('crossorigin=use-credentials',
+                      self.request.response.headers['Link'])
+
+    def test_preload(self):
+        tags = asset_preload(self.request, 'main-less', 'main-js',
+                             integrity=True)
+        self.assertIn('<link as="style" crossorigin="anonymous" '
+                      'href="/compiled/foo/main.css" '
+                      'integrity="sha384-css" rel="preload" />', tags)
+        self.assertIn('as="script"', tags)
+        self.assertEqual(
+            self.request.response.headers['Link'],
+            '</compiled/foo/main.css>; rel=preload; as=style; '
+            'crossorigin=anonymous, '
+            '</compiled/foo/main.js>; rel=preload; as=script; '
+            'crossorigin=anonymous')
+
+    def test_preload_no_header(self):
+        tags = asset_preload(self.request, 'main-less', header=False)
+        self.assertIn('rel="preload"', tags)
+        self.assertNotIn('Link', self.request.response.headers)
+
+
+class TestMemoize(AssetTagTestCase):
+    def test_memoize_without_attributes(self):
+        theme = self.request.theme
+        tag = asset_tag(self.request, 'main-js', integrity=True)
+        self.assertIs(asset_tag(self.request, 'main-js', integrity=True),
+                      tag)
+        self.assertEqual(list(theme._asset_tag_cache),
+                         [('main-js', True, None)])
+
+    def test_attributes_not_memoized(self):
+        theme = self.request.theme
+        for n in range(3):
+            tag = asset_tag(self.request, 'logo-svg', alt='Logo %d' % n)
+            self.assertIn('alt="Logo %d"' % n, tag)
+        # Unhashable values work too.
+        tag = asset_tag(self.request, 'logo-svg', data_x=['a'])
+        self.assertEqual(theme._asset_tag_cache, {})
+
+
+class TestDevelopment(AssetTagTestCase):
+    compile = False
+
+    def test_no_integrity(self):
+        tag = asset_tag(self.request, 'main-less', integrity=True)
+        self.assertNotIn('integrity', tag)
+
+    def test_no_preload(self):
+        self.assertEqual(asset_preload(self.request, 'main-less'), '')
+        self.assertNotIn('Link', self.request.response.headers)
@@ -1,21 +1,40 @@
 from __future__ import absolute_import, print_function, division
 
+import io
+import base64
+import hashlib
+import gzip
 import os.path
+import shutil
+import logging
 import subprocess
+import time
 from mock import patch
 from unittest import TestCase
+from hashlib import sha1
 from six import StringIO
+from webtest import TestApp
 
 from .. import compile
-from ..assets.asset import Asset
-from ..assets.less import LessAsset
+from ..theme import Theme
+from ..assets.asset import Asset, gzip_compress, read_chunks
+from ..assets.manifest import (load_manifest, manifest_path,
+                               write_manifest)
+from ..assets import less
+from ..assets.less import LessAsset, ImportCycleError
 from ..assets.requirejs import RequireJSAsset
 from ..assets.svg import SVGAsset
+from ..assets.watch import PollingWatcher, DependencyIndex
+from ..assets import builds
 
 from . import utils
 from .example import foo
 
 
+def gzip_decompress(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
 class TestCompileCommand(TestCase):
 
     def test_pcompile_usage(self):
@@ -42,6 +61,485 @@ class TestCompileCommand(TestCase):
         # XXX Try to assett hat this makes longer assets or something.
 
 
+class FakeAsset(Asset):
+    extension = 'txt'
+
+    def __init__(self, url_path, delay=0, fail=False, deps=()):
+        self.url_path = url_path
+        self.delay = delay
+        self.fail = fail
+        self.deps = list(deps)
+        self._compile_count = 0
+
+    def dependencies(self, theme):
+        return self.deps
+
+    def compile(self, key, theme, output_dir, minify=True):
+        self._compile_count += 1
+        log = logging.getLogger('pyramid_frontend.tests')
+        log.warn('start %s/%s', theme.key, key)
+        time.sleep(self.delay)
+        if self.fail:
+            raise ValueError('failed to compile %s' % key)
+        log.warn('end %s/%s', theme.key, key)
+        return self.write(key, u'compiled ' + self.url_path, self.url_path,
+                          output_dir)
+
+
+class DummyRegistry(object):
+    compiled_asset_dir = os.path.join(utils.work_dir, 'fake-compile-tests')
+
+    def __init__(self, themes):
+        self.settings = {
+            'pyramid_frontend.compiled_asset_dir': self.compiled_asset_dir,
+        }
+        self.settings['pyramid_frontend.theme_registry'] = dict(
+            (cls.key, cls(self.settings)) for cls in themes)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestParallelCompile(TestCase):
+    def setUp(self):
+        class OneTheme(Theme):
+            key = 'one'
+            assets = {
+                'a': FakeAsset('/_one/a.txt', delay=0.2),
+                'b': FakeAsset('/_one/b.txt', delay=0.1),
+                'c': FakeAsset('/_one/c.txt'),
+            }
+
+        class TwoTheme(OneTheme):
+            key = 'two'
+            assets = {
+                'd': FakeAsset('/_two/d.txt', fail=True),
+            }
+
+        self.OneTheme = OneTheme
+        self.TwoTheme = TwoTheme
+        if os.path.exists(DummyRegistry.compiled_asset_dir):
+            shutil.rmtree(DummyRegistry.compiled_asset_dir)
+        self.handler = RecordingHandler()
+        self.log = logging.getLogger('pyramid_frontend')
+        self.log.addHandler(self.handler)
+        self.log.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+
+    def test_parallel_ordered_logging(self):
+        registry = DummyRegistry([self.OneTheme])
+        compile.compile(registry, jobs=3)
+        messages = [msg for msg in self.handler.messages
+                    if msg.startswith(('start', 'end'))]
+        self.assertEqual(messages, ['start one/a', 'end one/a',
+                                    'start one/b', 'end one/b',
+                                    'start one/c', 'end one/c'])
+        theme = registry.settings['pyramid_frontend.theme_registry']['one']
+        for key in ('a', 'b', 'c'):
+            self.assertTrue(theme.compiled_asset_path(key).startswith(key))
+
+    def test_fail_fast(self):
+        registry = DummyRegistry([self.TwoTheme])
+        with self.assertRaises(ValueError):
+            compile.compile(registry, jobs=2)
+
+    def test_keep_going(self):
+        registry = DummyRegistry([self.OneTheme, self.TwoTheme])
+        with self.assertRaises(compile.CompileError) as cm:
+            compile.compile(registry, jobs=2, keep_going=True)
+        failures = [(theme_key, key) for theme_key, key, exc_info in
+                    cm.exception.failures]
+        self.assertEqual(failures, [('two', 'd')])
+        theme = registry.settings['pyramid_frontend.theme_registry']['two']
+        self.assertTrue(theme.compiled_asset_path('c').startswith('c'))
+
+    def test_keep_going_serial(self):
+        registry = DummyRegistry([self.TwoTheme])
+        with self.assertRaises(compile.CompileError):
+            compile.compile(registry, keep_going=True)
+
+
+class TestBuildCache(TestCase):
+    def setUp(self):
+        if os.path.exists(DummyRegistry.compiled_asset_dir):
+            shutil.rmtree(DummyRegistry.compiled_asset_dir)
+        os.makedirs(DummyRegistry.compiled_asset_dir)
+        self.input_path = os.path.join(DummyRegistry.compiled_asset_dir,
+                                       'input.txt')
+        self.write_input(b'one')
+        self.asset = FakeAsset('/_cached/a.txt', deps=[self.input_path])
+
+        class CachedTheme(Theme):
+            key = 'cached'
+            assets = {'a': self.asset}
+
+        self.registry = DummyRegistry([CachedTheme])
+        self.theme = \
+            self.registry.settings['pyramid_frontend.theme_registry']['cached']
+
+    def write_input(self, contents):
+        with open(self.input_path, 'wb') as f:
+            f.write(contents)
+
+    def test_skip_unchanged(self):
+        compile.compile(self.registry)
+        self.assertEqual(self.asset._compile_count, 1)
+        first = self.theme.compiled_asset_path('a')
+        # Remove the map file, to check that it's rewritten.
+        os.remove(os.path.join(self.theme.compiled_asset_dir, 'a.map'))
+
+        compile.compile(self.registry)
+        self.assertEqual(self.asset._compile_count, 1)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.theme.compiled_asset_dir, 'a.map')))
+        self.theme._compiled_asset_cache.clear()
+        self.assertEqual(self.theme.compiled_asset_path('a'), first)
+
+    def test_rebuild_changed_input(self):
+        compile.compile(self.registry)
+        self.write_input(b'two')
+        # Ensure the modification time changes.
+        os.utime(self.input_path, (0, 0))
+        compile.compile(self.registry)
+        self.assertEqual(self.asset._compile_count, 2)
+
+    def test_rebuild_minify_changed(self):
+        compile.compile(self.registry)
+        compile.compile(self.registry, minify=False)
+        self.assertEqual(self.asset._compile_count, 2)
+
+    def test_rebuild_output_settings_changed(self):
+        compile.compile(self.registry)
+        with patch.object(FakeAsset, 'hash_length', 8):
+            compile.compile(self.registry)
+        self.assertEqual(self.asset._compile_count, 2)
+
+    def test_rebuild_output_missing(self):
+        path = self.theme.compile_asset('a')
+        compile.compile(self.registry)
+        os.remove(path)
+        compile.compile(self.registry)
+        self.assertEqual(self.asset._compile_count, 3)
+
+    def test_force(self):
+        compile.compile(self.registry)
+        compile.compile(self.registry, force=True)
+        self.assertEqual(self.asset._compile_count, 2)
+
+
+class TestDeduplicate(TestCase):
+    def setUp(self):
+        if os.path.exists(DummyRegistry.compiled_asset_dir):
+            shutil.rmtree(DummyRegistry.compiled_asset_dir)
+        self.shared = FakeAsset('/_parent/shared.txt')
+        self.own = FakeAsset('/_parent/own.txt')
+
+        class ParentTheme(Theme):
+            key = 'parent'
+            assets = {'shared': self.shared}
+
+        class ChildTheme(ParentTheme):
+            key = 'child'
+            assets = {}
+
+        class OtherChildTheme(ParentTheme):
+            key = 'other-child'
+            assets = {'own': self.own}
+
+        self.registry = DummyRegistry([ParentTheme, ChildTheme,
+                                       OtherChildTheme])
+        self.themes = self.registry.settings['pyramid_frontend.theme_registry']
+
+    def test_compile_once(self):
+        compile.compile(self.registry, jobs=2)
+        self.assertEqual(self.shared._compile_count, 1)
+        self.assertEqual(self.own._compile_count, 1)
+
+        paths = []
+        for theme in self.themes.values():
+            file_name = theme.compiled_asset_path('shared')
+            paths.append(os.path.join(theme.compiled_asset_dir, file_name))
+        self.assertEqual(len(set(os.path.basename(p) for p in paths)), 1)
+        inodes = set(os.stat(path).st_ino for path in paths)
+        self.assertEqual(len(inodes), 1)
+
+    def test_failure_shared(self):
+        self.shared.fail = True
+        with self.assertRaises(compile.CompileError) as cm:
+            compile.compile(self.registry, keep_going=True)
+        failures = sorted(theme_key for theme_key, key, exc_info in
+                          cm.exception.failures)
+        self.assertEqual(failures, ['child', 'other-child', 'parent'])
+        self.assertEqual(self.shared._compile_count, 1)
+
+
+class TestManifest(TestCase):
+    def setUp(self):
+        if os.path.exists(DummyRegistry.compiled_asset_dir):
+            shutil.rmtree(DummyRegistry.compiled_asset_dir)
+
+        class ParentTheme(Theme):
+            key = 'parent'
+            assets = {'a': FakeAsset('/_parent/a.txt')}
+
+        class ChildTheme(ParentTheme):
+            key = 'child'
+            assets = {'b': FakeAsset('/_child/b.txt')}
+
+        self.registry = DummyRegistry([ParentTheme, ChildTheme])
+        self.settings = self.registry.settings
+        self.themes = self.settings['pyramid_frontend.theme_registry']
+
+    def test_write_manifest(self):
+        compile.compile(self.registry)
+        manifest = load_manifest(manifest_path(self.settings))
+        self.assertEqual(sorted(manifest), ['child', 'parent'])
+        self.assertEqual(sorted(manifest['child']), ['a', 'b'])
+        self.assertEqual(sorted(manifest['parent']), ['a'])
+
+        entry = manifest['child']['b']
+        path = os.path.join(self.themes['child'].compiled_asset_dir,
+                            entry['file'])
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(entry['size'], len(data))
+        self.assertEqual(entry['integrity'], 'sha384-' + base64.b64encode(
+            hashlib.sha384(data).digest()).decode('ascii'))
+
+    def test_themes_use_manifest(self):
+        compile.compile(self.registry)
+        theme = self.themes['child']
+        # Lookups no longer need the map files.
+        for key in ('a', 'b'):
+            os.remove(os.path.join(theme.compiled_asset_dir, key + '.map'))
+            self.assertTrue(theme.compiled_asset_path(key).startswith(key))
+
+    def test_no_manifest_on_failure(self):
+        class BrokenTheme(Theme):
+            key = 'broken'
+            assets = {'d': FakeAsset('/_broken/d.txt', fail=True)}
+
+        registry = DummyRegistry([BrokenTheme])
+        with self.assertRaises(compile.CompileError):
+            compile.compile(registry, keep_going=True)
+        self.assertIsNone(load_manifest(manifest_path(registry.settings)))
+
+    def test_load_at_add_theme(self):
+        compiled_dir = os.path.join(utils.work_dir, 'manifest-tests')
+        settings = {
+            'pyramid_frontend.compile': True,
+            'pyramid_frontend.compiled_asset_dir': compiled_dir,
+        }
+        write_manifest(os.path.join(compiled_dir, 'manifest.json'), {
+            'foo': {'logo-svg': {'file': 'logo-manifest.svg',
+                                 'size': 0,
+                                 'integrity': None}},
+        })
+        app = TestApp(utils.make_app(settings))
+        resp = app.get('/svg-tag')
+        resp.mustcontain('/compiled/foo/logo-manifest.svg')
+
+
+class StopWatching(Exception):
+    pass
+
+
+class FakeWatcher(object):
+    """
+    Calls each of a list of functions in turn, reporting the set of paths it
+    returns as changed, then stops the watch loop.
+    """
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.closed = False
+
+    def wait(self):
+        if not self.changes:
+            raise StopWatching
+        return self.changes.pop(0)()
+
+    def close(self):
+        self.closed = True
+
+
+class TestWatch(TestCase):
+    def setUp(self):
+        compiled_dir = DummyRegistry.compiled_asset_dir
+        if os.path.exists(compiled_dir):
+            shutil.rmtree(compiled_dir)
+        self.input_dir = os.path.join(compiled_dir, 'inputs')
+        os.makedirs(self.input_dir)
+        self.shared_path = self.write_input('shared.less', b'shared')
+        self.a_path = self.write_input('a.less', b'a')
+        self.a = FakeAsset('/_watched/a.txt',
+                           deps=[self.a_path, self.shared_path])
+        self.b = FakeAsset('/_watched/b.txt', deps=[self.shared_path])
+
+        class WatchedTheme(Theme):
+            key = 'watched'
+            assets = {'a': self.a, 'b': self.b}
+
+        self.registry = DummyRegistry([WatchedTheme])
+        themes = self.registry.settings['pyramid_frontend.theme_registry']
+        self.theme = themes['watched']
+
+    def write_input(self, name, contents):
+        path = os.path.join(self.input_dir, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return path
+
+    def test_polling_watcher(self):
+        watcher = PollingWatcher([self.input_dir], interval=0)
+        self.assertEqual(watcher.poll(), set())
+        self.write_input('a.less', b'changed')
+        os.utime(self.a_path, (0, 0))
+        new_path = self.write_input('new.less', b'new')
+        os.remove(self.shared_path)
+        self.assertEqual(watcher.poll(),
+                         set([self.a_path, new_path, self.shared_path]))
+        self.assertEqual(watcher.poll(), set())
+
+    def test_dependency_index(self):
+        index = DependencyIndex([self.theme])
+        self.assertEqual(index.affected([self.a_path]),
+                         set([('watched', 'a')]))
+        self.assertEqual(index.affected([self.shared_path]),
+                         set([('watched', 'a'), ('watched', 'b')]))
+
+        # New inputs are found when an unknown file changes.
+        new_path = self.write_input('new.less', b'new')
+        self.assertEqual(index.affected([new_path]), set())
+        self.b.deps.append(new_path)
+        self.assertEqual(index.affected([new_path]),
+                         set([('watched', 'b')]))
+
+    def test_compile_only(self):
+        compile.compile(self.registry)
+        first = load_manifest(manifest_path(self.registry.settings))
+        self.a.url_path = '/_watched/a2.txt'
+        compile.compile(self.registry, only=set([('watched', 'a')]))
+        self.assertEqual(self.a._compile_count, 2)
+        self.assertEqual(self.b._compile_count, 1)
+        manifest = load_manifest(manifest_path(self.registry.settings))
+        self.assertEqual(manifest['watched']['b'], first['watched']['b'])
+        self.assertNotEqual(manifest['watched']['a'], first['watched']['a'])
+
+    def test_watch(self):
+        def change_a():
+            self.write_input('a.less', b'changed')
+            os.utime(self.a_path, (0, 0))
+            return set([self.a_path])
+
+        watcher = FakeWatcher([
+            lambda: set([self.write_input('unrelated.txt', b'')]),
+            change_a,
+        ])
+        with self.assertRaises(StopWatching):
+            compile.watch(self.registry, watcher=watcher)
+        self.assertTrue(watcher.closed)
+        self.assertEqual(self.a._compile_count, 2)
+        self.assertEqual(self.b._compile_count, 1)
+
+
+class TestVersionedBuilds(TestCase):
+    def setUp(self):
+        self.root = DummyRegistry.compiled_asset_dir
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        self.a = FakeAsset('/_versioned/a.txt')
+        self.b = FakeAsset('/_versioned/b.txt')
+
+        class VersionedTheme(Theme):
+            key = 'versioned'
+            assets = {'a': self.a, 'b': self.b}
+
+        self.registry = DummyRegistry([VersionedTheme])
+        self.settings = self.registry.settings
+        self.settings['pyramid_frontend.versioned_builds'] = True
+        self.theme = self.settings['pyramid_frontend.theme_registry'][
+            'versioned']
+
+    def current_path(self, key):
+        entry = load_manifest(manifest_path(self.settings))['versioned'][key]
+        return os.path.join(self.root, 'current', 'versioned', entry['file'])
+
+    def test_activate(self):
+        compile.compile(self.registry)
+        build_ids = builds.list_builds(self.root)
+        self.assertEqual(len(build_ids), 1)
+        self.assertEqual(builds.current_build(self.root), build_ids[0])
+        self.assertTrue(os.path.islink(os.path.join(self.root, 'current')))
+        self.assertTrue(os.path.exists(self.current_path('a')))
+        self.assertEqual(self.theme.compiled_asset_dir,
+                         os.path.join(self.root, 'current', 'versioned'))
+
+    def test_seed_unchanged(self):
+        compile.compile(self.registry)
+        first = os.stat(self.current_path('a')).st_ino
+        # A file which isn't in the manifest isn't carried over.
+        stale = os.path.join(self.root, 'current', 'versioned', 'stale.txt')
+        with open(stale, 'wb') as f:
+            f.write(b'stale')
+
+        compile.compile(self.registry)
+        self.assertEqual(len(builds.list_builds(self.root)), 2)
+        self.assertEqual(self.a._compile_count, 1)
+        self.assertEqual(os.stat(self.current_path('a')).st_ino, first)
+        self.assertFalse(os.path.exists(stale))
+
+    def test_prune(self):
+        self.settings['pyramid_frontend.keep_builds'] = 2
+        for n in range(3):
+            compile.compile(self.registry)
+        build_ids = builds.list_builds(self.root)
+        self.assertEqual(len(build_ids), 2)
+        self.assertEqual(builds.current_build(self.root), build_ids[-1])
+
+    def test_rollback(self):
+        compile.compile(self.registry)
+        compile.compile(self.registry)
+        first, second = builds.list_builds(self.root)
+        self.assertEqual(builds.rollback(self.root), first)
+        self.assertEqual(builds.current_build(self.root), first)
+        with self.assertRaises(ValueError):
+            builds.rollback(self.root)
+
+    def test_discard_failed_build(self):
+        compile.compile(self.registry)
+        build_ids = builds.list_builds(self.root)
+        self.b.fail = True
+        with self.assertRaises(compile.CompileError):
+            compile.compile(self.registry, keep_going=True)
+        self.assertEqual(builds.list_builds(self.root), build_ids)
+        self.assertEqual(builds.current_build(self.root), build_ids[0])
+        self.assertIsNone(self.theme.build_dir)
+
+    def test_linked_files_replaced(self):
+        compile.compile(self.registry)
+        old_map = os.path.join(self.root, 'current', 'versioned', 'a.map')
+        with open(old_map, 'rb') as f:
+            old_contents = f.read()
+        self.a.url_path = '/_versioned/renamed.txt'
+        compile.compile(self.registry, force=True)
+        # The new build's map file was rewritten, without modifying the
+        # previous build's copy, which it was hard-linked to.
+        previous = builds.list_builds(self.root)[0]
+        with open(os.path.join(builds.builds_dir(self.root), previous,
+                               'versioned', 'a.map'), 'rb') as f:
+            self.assertEqual(f.read(), old_contents)
+        with open(old_map, 'rb') as f:
+            self.assertNotEqual(f.read(), old_contents)
+
+
 class TestAsset(TestCase):
     def setUp(self):
         self.theme = foo.FooTheme({})
@@ -59,6 +557,92 @@ class TestAsset(TestCase):
         # XXX Try to test that this actually prints the stdout output of a
         # failed comamnd.
 
+    def test_pipeline(self):
+        asset = Asset(None)
+        output = asset.run_pipeline([['tr', 'a-z', 'A-Z'], ['rev']],
+                                    b'abc\nxyz\n')
+        self.assertEqual(output, b'CBA\nZYX\n')
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            asset.run_pipeline([['cat'], ['false']], b'abc')
+
+    def test_write_bytes(self):
+        asset = SVGAsset('/_foo/images/logo.svg')
+        data = u'<svg>\u2603</svg>'.encode('utf-8')
+        path = asset.write_bytes('snowman', data, 'snowman.svg',
+                                 self.output_dir)
+        self.assertEqual(os.path.basename(path),
+                         'snowman.svg-%s.svg' % sha1(data).hexdigest())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_write_compressed(self):
+        asset = SVGAsset('/_foo/images/logo.svg')
+        data = b'<svg></svg>' * 100
+        path = asset.write_bytes('logo', data, 'logo.svg', self.output_dir)
+        with open(path + '.gz', 'rb') as f:
+            compressed = f.read()
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(gzip_decompress(compressed), data)
+        # Compression is reproducible.
+        self.assertEqual(compressed, gzip_compress(data))
+
+        os.remove(path + '.gz')
+        asset.write_compressed(path)
+        self.assertTrue(os.path.exists(path + '.gz'))
+
+    def test_hash_algorithm(self):
+        class ShortHashAsset(SVGAsset):
+            hash_algorithm = 'sha256'
+            hash_length = 16
+
+        data = b'<svg></svg>'
+        path = ShortHashAsset(None).write_bytes('short', data, 'short.svg',
+                                                self.output_dir)
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        self.assertEqual(os.path.basename(path),
+                         'short.svg-%s.svg' % digest)
+
+    def test_write_stream(self):
+        asset = SVGAsset(None)
+        chunks = [b'<svg>', b'</svg>']
+        path = asset.write_stream('stream', iter(chunks), 'stream.svg',
+                                  self.output_dir)
+        self.assertEqual(path, asset.write_bytes('stream', b''.join(chunks),
+                                                 'stream.svg',
+                                                 self.output_dir))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'<svg></svg>')
+        self.assertEqual([name for name in os.listdir(self.output_dir)
+                          if name.endswith('.tmp')], [])
+
+    def test_skip_unchanged_write(self):
+        asset = SVGAsset(None)
+        path = asset.write_bytes('same', b'<svg/>', 'same.svg',
+                                 self.output_dir)
+        inode = os.stat(path).st_ino
+        asset.write_bytes('same', b'<svg/>', 'same.svg', self.output_dir)
+        with open(path, 'rb') as f:
+            asset.write_stream('same', read_chunks(f), 'same.svg',
+                               self.output_dir)
+        # Rewriting would have renamed a new file into place.
+        self.assertEqual(os.stat(path).st_ino, inode)
+
+    def test_less_stages(self):
+        # With pass-through tools, the output is the concatenated source.
+        asset = LessAsset('/_foo/css/main.less',
+                          lessc_path='cat',
+                          autoprefixer_path='cat')
+        path = asset.compile(key='main-less',
+                             theme=self.theme,
+                             output_dir=self.output_dir,
+                             minify=False)
+        entry_point = self.theme.static_url_to_filesystem_path(
+            asset.url_path)
+        expected = asset.concatenate(self.theme, entry_point)
+        with io.open(path, encoding='utf8') as f:
+            self.assertEqual(f.read(), expected)
+
     def test_less_compile(self):
         asset = LessAsset('/_foo/css/main.less')
         path = asset.compile(key='main-less',
@@ -99,6 +683,16 @@ class TestAsset(TestCase):
 
         self.assertLess(len(buf_minified), len(buf_unminified))
 
+    def test_requirejs_tag_production(self):
+        asset = RequireJSAsset('/_foo/js/main.js')
+        tag = asset.tag_production(self.theme, '/compiled/foo/main.js')
+        self.assertEqual(tag, '<script src="/compiled/foo/main.js"></script>')
+
+        asset = RequireJSAsset('/_foo/js/main.js', loading='defer')
+        tag = asset.tag_production(self.theme, '/compiled/foo/main.js')
+        self.assertEqual(tag, '<script defer="defer" '
+                         'src="/compiled/foo/main.js"></script>')
+
     def test_svg_compile(self):
         asset = SVGAsset('/_foo/images/logo.svg')
         path = asset.compile(key='logo-svg',
@@ -108,3 +702,78 @@ class TestAsset(TestCase):
         buf = f.read()
         self.assertGreater(len(buf), 0)
         self.assertIn('svg', buf)
+
+
+class TestLessConcatenate(TestCase):
+    def setUp(self):
+        self.theme = foo.FooTheme({})
+        self.dir = os.path.join(utils.work_dir, 'less-tests')
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.makedirs(self.dir)
+
+    def write(self, name, contents):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_dependencies(self):
+        asset = LessAsset('/_foo/css/main.less')
+        deps = asset.dependencies(self.theme)
+        self.assertEqual(len(deps), 3)
+        self.assertTrue(deps[0].endswith('foo/static/css/main.less'))
+
+    def test_parse_cached(self):
+        asset = LessAsset(None)
+        path = self.write('a.less', '@a: 1;\n@import "b";\n.a { x: @a; }\n')
+        chunks = asset.parse(path)
+        self.assertEqual(chunks, [('text', u'@a: 1;\n'),
+                                  ('import', u'b'),
+                                  ('text', u'.a { x: @a; }\n')])
+        self.assertIs(asset.parse(path), chunks)
+
+        # Changing the file invalidates the cached parse.
+        self.write('a.less', '.a { x: 2; }\n.b { y: 3; }\n')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(asset.parse(path),
+                         [('text', u'.a { x: 2; }\n.b { y: 3; }\n')])
+
+    def test_parse_cache_bounded(self):
+        asset = LessAsset(None)
+        paths = [self.write('%s.less' % name, '.%s {}\n' % name)
+                 for name in 'abc']
+        with patch.object(less, 'max_parsed_files', 2):
+            for path in paths:
+                asset.parse(path)
+        keys = [key[0] for key in less.parsed_files]
+        self.assertNotIn(paths[0], keys)
+        self.assertEqual(keys[-2:], paths[1:])
+
+        # Files which no longer exist are dropped.
+        os.remove(paths[2])
+        with self.assertRaises(OSError):
+            asset.parse(paths[2])
+        self.assertNotIn(paths[2], [key[0] for key in less.parsed_files])
+
+    def test_shared_partial(self):
+        asset = LessAsset(None)
+        self.write('vars.less', '@c: red;\n')
+        self.write('b.less', '@import "vars";\n.b { color: @c; }\n')
+        path = self.write('a.less', '@import "vars";\n@import "b";\n')
+        deps = []
+        contents = asset.concatenate(self.theme, path, deps)
+        self.assertEqual(contents,
+                         u'@c: red;\n@c: red;\n.b { color: @c; }\n')
+        self.assertEqual([os.path.basename(dep) for dep in deps],
+                         ['a.less', 'vars.less', 'b.less', 'vars.less'])
+
+    def test_import_cycle(self):
+        asset = LessAsset(None)
+        self.write('b.less', '@import "c";\n')
+        self.write('c.less', '@import "../less-tests/b";\n')
+        path = self.write('a.less', '@import "b";\n')
+        with self.assertRaises(ImportCycleError) as cm:
+            asset.concatenate(self.theme, path)
+        self.assertIn('b.less -> ', str(cm.exception))
+        self.assertIn('c.less -> ', str(cm.exception))
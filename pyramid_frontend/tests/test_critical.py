@@ -0,0 +1,125 @@
+from __future__ import absolute_import, print_function, division
+
+import io
+import os.path
+import shutil
+from unittest import TestCase
+
+from ..assets.critical import extract_critical, split_blocks
+from ..assets.less import LessAsset
+
+from . import utils
+from .example import foo
+
+
+page = u'''
+<html>
+<head><title class="ignored">Page</title></head>
+<body>
+  <div id="header" class="banner wide">
+    <a class="logo" href="/">Logo</a>
+  </div>
+  <p class="intro">Hello</p>
+  <div class="footer"></div>
+</body>
+</html>
+'''
+
+
+class TestExtractCritical(TestCase):
+    def test_split_blocks(self):
+        css = (u'@charset "utf-8";/* a { } */a{color:red}'
+               u'@media print{b{x:"}"}}')
+        self.assertEqual(split_blocks(css), [
+            (u'@charset "utf-8"', None),
+            (u'a', u'color:red'),
+            (u'@media print', u'b{x:"}"}'),
+        ])
+
+    def test_extract(self):
+        css = (u'body{margin:0}'
+               u'#header .logo:hover,.sidebar a{color:red}'
+               u'div.banner.wide>a[href]{x:1}'
+               u'.banner.narrow{x:2}'
+               u'title.ignored{x:3}'
+               u'@media (min-width:100px){p.intro{x:4}table{x:5}}'
+               u'@media print{table{x:6}}'
+               u'@font-face{font-family:x}'
+               u'.footer{x:7}')
+        self.assertEqual(extract_critical(css, [page]),
+                         u'body{margin:0}'
+                         u'#header .logo:hover{color:red}'
+                         u'div.banner.wide>a[href]{x:1}'
+                         u'@media (min-width:100px){p.intro{x:4}}'
+                         u'.footer{x:7}')
+
+    def test_above_the_fold(self):
+        css = u'.logo{x:1}.footer{x:2}'
+        self.assertEqual(extract_critical(css, [page], max_elements=2),
+                         u'.logo{x:1}')
+
+    def test_multiple_documents(self):
+        css = u'.logo{x:1}.other{x:2}.missing{x:3}'
+        self.assertEqual(
+            extract_critical(css, [page, u'<p class="other"></p>']),
+            u'.logo{x:1}.other{x:2}')
+
+
+class TestCriticalLessAsset(TestCase):
+    def setUp(self):
+        self.theme = foo.FooTheme({
+            'pyramid_frontend.compiled_asset_dir':
+                os.path.join(utils.work_dir, 'critical-tests'),
+        })
+        if os.path.exists(self.theme.compiled_asset_dir):
+            shutil.rmtree(self.theme.compiled_asset_dir)
+        os.makedirs(self.theme.compiled_asset_dir)
+        self.asset = LessAsset('/_foo/css/main.less',
+                               critical_templates=['index.html'])
+
+    def test_inline_critical(self):
+        css = u'body{margin:0}table{x:1}'
+        file_path = self.asset.write('main-less', css, 'main.less',
+                                     self.theme.compiled_asset_dir)
+        self.asset.write_critical(self.theme, file_path,
+                                  css.encode('utf-8'))
+        with io.open(self.asset.critical_path(file_path),
+                     encoding='utf8') as f:
+            self.assertEqual(f.read(), u'body{margin:0}')
+
+        url = '/compiled/foo/' + os.path.basename(file_path)
+        tag = self.asset.tag_production(self.theme, url)
+        self.assertIn('<style>body{margin:0}</style>', tag)
+        self.assertIn('rel="preload"', tag)
+        self.assertIn('<noscript><link href="%s" rel="stylesheet"' % url,
+                      tag)
+
+    def test_linked_into_theme(self):
+        # Deduplication links the critical CSS into the other theme too.
+        class CopyTheme(foo.FooTheme):
+            key = 'foo-copy'
+            assets = {'main-less': self.asset}
+
+        css = u'body{margin:0}table{x:1}'
+        file_path = self.asset.write('main-less', css, 'main.less',
+                                     self.theme.compiled_asset_dir)
+        self.asset.write_critical(self.theme, file_path,
+                                  css.encode('utf-8'))
+        other = CopyTheme(self.theme.settings)
+        shutil.rmtree(other.compiled_asset_dir, ignore_errors=True)
+        linked_path = other.link_compiled_asset('main-less', file_path)
+        self.assertTrue(os.path.exists(self.asset.critical_path(linked_path)))
+
+        url = '/compiled/foo-copy/' + os.path.basename(linked_path)
+        tag = self.asset.tag_production(other, url)
+        self.assertIn('<style>body{margin:0}</style>', tag)
+
+    def test_no_critical_file(self):
+        tag = self.asset.tag_production(self.theme, '/compiled/foo/x.css')
+        self.assertNotIn('<style>', tag)
+        self.assertIn('rel="stylesheet"', tag)
+
+    def test_dependencies(self):
+        deps = self.asset.dependencies(self.theme)
+        self.assertTrue(any(dep.endswith('templates/index.html')
+                            for dep in deps))
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, print_function, division
+
+import io
+import os
+import os.path
+import sys
+import json
+from unittest import TestCase
+
+from ..assets import daemon
+from ..assets.daemon import (CompilerDaemon, CompilerPool,
+                             CompilerUnavailable, CompilerDaemonError)
+from ..assets.less import LessAsset
+from ..assets.requirejs import RequireJSAsset
+
+from . import utils
+from .example import foo
+
+
+# A stand-in for compiler.js, speaking the same protocol: 'less' requests
+# echo the source back, and 'requirejs' requests echo the config.
+stub_worker = '''
+import sys
+import json
+
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    request = json.loads(line)
+    response = {'id': request['id'], 'ok': True}
+    if request['type'] == 'ping':
+        response['output'] = 'pong'
+    elif request['type'] == 'less':
+        response['output'] = '/* stub */' + request['source']
+    elif request['type'] == 'requirejs':
+        response['output'] = json.dumps(request['config'], sort_keys=True)
+    else:
+        response = {'id': request['id'], 'ok': False, 'error': 'no'}
+    sys.stdout.write(json.dumps(response) + '\\n')
+    sys.stdout.flush()
+'''
+
+
+class DaemonTestCase(TestCase):
+    def setUp(self):
+        if not os.path.isdir(utils.work_dir):
+            os.makedirs(utils.work_dir)
+        self.script_path = os.path.join(utils.work_dir, 'stub_worker.py')
+        with io.open(self.script_path, 'w') as f:
+            f.write(stub_worker)
+        self.pool = CompilerPool(size=2,
+                                 node_path=sys.executable,
+                                 script_path=self.script_path)
+
+    def tearDown(self):
+        self.pool.close()
+        daemon.set_compiler(None)
+
+
+class TestCompilerDaemon(DaemonTestCase):
+    def test_request(self):
+        worker = CompilerDaemon(node_path=sys.executable,
+                                script_path=self.script_path)
+        worker.start()
+        try:
+            self.assertEqual(worker.request('less', source=u'a {}'),
+                             u'/* stub */a {}')
+            with self.assertRaises(CompilerDaemonError):
+                worker.request('bogus')
+            # The worker is still usable after a failed request.
+            self.assertEqual(worker.request('ping'), u'pong')
+        finally:
+            worker.close()
+
+    def test_missing_node(self):
+        worker = CompilerDaemon(node_path='/nonexistent/node')
+        with self.assertRaises(CompilerUnavailable):
+            worker.start()
+
+    def test_pool_reuses_workers(self):
+        for ii in range(3):
+            self.pool.request('ping')
+        self.assertEqual(self.pool.started, 1)
+
+    def test_pool_unavailable(self):
+        pool = CompilerPool(node_path='/nonexistent/node')
+        with self.assertRaises(CompilerUnavailable):
+            pool.request('ping')
+        self.assertFalse(pool.available)
+        with self.assertRaises(CompilerUnavailable):
+            pool.request('ping')
+
+
+class TestDaemonAssets(DaemonTestCase):
+    def setUp(self):
+        DaemonTestCase.setUp(self)
+        self.theme = foo.FooTheme({})
+        self.output_dir = os.path.join(utils.work_dir, 'daemon-tests')
+
+    def test_less_compile(self):
+        daemon.set_compiler(self.pool)
+        asset = LessAsset('/_foo/css/main.less')
+        path = asset.compile(key='main-less',
+                             theme=self.theme,
+                             output_dir=self.output_dir)
+        with io.open(path, encoding='utf8') as f:
+            self.assertTrue(f.read().startswith(u'/* stub */'))
+
+    def test_less_custom_tools(self):
+        daemon.set_compiler(self.pool)
+        asset = LessAsset('/_foo/css/main.less', lessc_path='/bin/false')
+        with self.assertRaises(Exception):
+            asset.compile(key='main-less',
+                          theme=self.theme,
+                          output_dir=self.output_dir)
+        self.assertEqual(self.pool.started, 0)
+
+    def test_requirejs_config(self):
+        daemon.set_compiler(self.pool)
+        asset = RequireJSAsset('/_foo/js/main.js')
+        path = asset.compile(key='main-js',
+                             theme=self.theme,
+                             output_dir=self.output_dir,
+                             minify=False)
+        with io.open(path, encoding='utf8') as f:
+            contents = f.read()
+        # The preamble is bundled in front of the compiled modules.
+        preamble = asset.bundle_preamble()
+        self.assertTrue(contents.startswith(preamble))
+        config = json.loads(contents[len(preamble):])
+        self.assertTrue(config['name'].endswith('js/main'))
+        self.assertEqual(config['include'], ['requireLib'])
+        self.assertEqual(config['optimize'], 'none')
+        self.assertIn('requireLib', config['paths'])
+        self.assertIn('foo', config['paths'])
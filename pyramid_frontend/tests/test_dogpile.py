@@ -3,13 +3,18 @@ Test dogpile protection by using two reader processes to try to process the
 same image chain. Ensure that the image chain is only processed once.
 """
 
+import os
+import time
 from unittest import TestCase
-from threading import Thread
+from threading import Thread, Event
 from six.moves import queue
+from mock import patch
 
 from pyramid import testing
 
-from ..images.chain import FilterChain
+from ..images import view
+from ..images.chain import FilterChain, PassThroughFilterChain
+from ..images.files import processed_path
 from ..images.filters import Filter
 from ..images.view import process_image
 
@@ -62,3 +67,116 @@ class TestImageDogpileProtection(TestCase):
             t.join()
         # Make sure that the RecordingFilter was run exactly twice.
         self.assertEqual(q.qsize(), 2)
+
+
+class SlowFilter(Filter):
+    def __call__(self, input):
+        q.put(1)
+        time.sleep(0.1)
+        return input
+
+
+class TestInProcessCoalescing(TestCase):
+
+    def setUp(self):
+        utils.load_images()
+        while not q.empty():
+            q.get()
+
+    def test_lock_file_taken_once(self):
+        chain = PassThroughFilterChain('test-coalesce',
+                                       filters=[SlowFilter()])
+        results = queue.Queue()
+
+        def run():
+            results.put(process_image(utils.default_settings,
+                                      'smiley-gif-alpha', 'gif', chain))
+
+        with patch.object(view, 'FileLock', wraps=view.FileLock) as lock:
+            threads = [Thread(target=run) for ii in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(lock.call_count, 1)
+        paths = set(results.get() for ii in range(5))
+        self.assertEqual(len(paths), 1)
+
+    def test_exception_shared(self):
+        flight = view.SingleFlight()
+        event = Event()
+        errors = queue.Queue()
+
+        def fail():
+            event.wait()
+            raise ValueError('boom')
+
+        def run():
+            try:
+                flight.do('key', fail)
+            except ValueError as e:
+                errors.put(e)
+
+        threads = [Thread(target=run) for ii in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        event.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors.qsize(), 3)
+        self.assertEqual(flight.calls, {})
+
+    def test_interrupted_leader(self):
+        flight = view.SingleFlight()
+        event = Event()
+        results = queue.Queue()
+        calls = []
+
+        class Interrupted(BaseException):
+            pass
+
+        def func():
+            calls.append(1)
+            if len(calls) == 1:
+                event.wait()
+                raise Interrupted()
+            return 'done'
+
+        def lead():
+            try:
+                flight.do('key', func)
+            except Interrupted:
+                pass
+
+        def follow():
+            results.put(flight.do('key', func))
+
+        leader = Thread(target=lead)
+        leader.start()
+        time.sleep(0.05)
+        follower = Thread(target=follow)
+        follower.start()
+        time.sleep(0.05)
+        event.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results.get_nowait(), 'done')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.calls, {})
+
+    def test_overwrite_not_coalesced(self):
+        chain = PassThroughFilterChain()
+        proc_path = processed_path(utils.default_settings,
+                                   'smiley-gif-alpha', 'gif', chain)
+        if os.path.exists(proc_path):
+            os.remove(proc_path)
+        with patch.object(view.processing_flight, 'do') as do:
+            process_image(utils.default_settings, 'smiley-gif-alpha', 'gif',
+                          chain, overwrite=True)
+            process_image(utils.default_settings, 'smiley-gif-alpha', 'gif',
+                          chain, overwrite=False)
+        keys = [call[0][0] for call in do.call_args_list]
+        self.assertEqual(len(keys), 2)
+        self.assertNotEqual(keys[0], keys[1])
@@ -1,13 +1,21 @@
 from __future__ import absolute_import, print_function, division
 
+import os.path
 import re
+import gzip
 from unittest import TestCase
 from six import BytesIO
+from mock import patch
 
+from webob import Request
 from webtest import TestApp
 
 from PIL import Image
 
+from ..assets import less
+from ..assets.less import LessAsset
+from ..assets.manifest import write_manifest
+from ..assets.svg import SVGAsset
 from ..images import files
 from ..images.view import MissingOriginal
 from ..templating.renderer import MakoRenderingException
@@ -81,6 +89,57 @@ class TestAssetsFunctional(Functional):
         resp.mustcontain('img')
 
 
+class TestServeLessFunctional(Functional):
+    settings = {
+        'pyramid_frontend.serve_less': True,
+    }
+
+    def setUp(self):
+        Functional.setUp(self)
+        less.compiled_css.clear()
+        # Stand in for lessc and autoprefixer.
+        patcher = patch.object(LessAsset, 'stages',
+                               lambda self, minify: [['cat']])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_css_tag(self):
+        resp = self.app.get('/css-tag')
+        resp.mustcontain('/_pfe_less/foo/_foo/css/main.less')
+        self.assertNotIn('less.js', resp.text)
+
+    def test_compile(self):
+        with patch.object(LessAsset, 'run_pipeline',
+                          autospec=True,
+                          side_effect=LessAsset.run_pipeline) as mock:
+            resp = self.app.get('/_pfe_less/foo/_foo/css/main.less')
+            self.assertEqual(resp.content_type, 'text/css')
+            resp.mustcontain('.article', 'font-family: "PT Sans"')
+            self.assertEqual(mock.call_count, 1)
+
+            # Served from the cache, and revalidated by ETag.
+            self.app.get('/_pfe_less/foo/_foo/css/main.less',
+                         headers={'If-None-Match': resp.etag},
+                         status=304)
+            self.assertEqual(mock.call_count, 1)
+
+            # Recompiled when a file in the import graph changes.
+            theme = self.app.app.registry.settings[
+                'pyramid_frontend.theme_registry']['foo']
+            path = theme.static_url_to_filesystem_path(
+                '/_base/css/layout.less')
+            st = os.stat(path)
+            self.addCleanup(os.utime, path, (st.st_atime, st.st_mtime))
+            os.utime(path, (st.st_atime, st.st_mtime + 10))
+            self.app.get('/_pfe_less/foo/_foo/css/main.less')
+            self.assertEqual(mock.call_count, 2)
+
+    def test_not_found(self):
+        self.app.get('/_pfe_less/foo/_foo/css/article.less', status=404)
+        self.app.get('/_pfe_less/nonexistent/_foo/css/main.less',
+                     status=404)
+
+
 class TestCompiledFunctional(Functional):
     settings = {
         'pyramid_frontend.compile': True,
@@ -128,6 +187,114 @@ class TestCompiledFunctional(Functional):
         # FIXME Check for minification and stuff, loading file path.
 
 
+class TestPrecompressedFunctional(Functional):
+    settings = {
+        'pyramid_frontend.compile': True,
+        'pyramid_frontend.serve_precompressed': True,
+    }
+
+    def setUp(self):
+        Functional.setUp(self)
+        theme = utils.foo.FooTheme(utils.default_settings)
+        file_path = theme.compile_asset('logo-svg')
+        self.url = '/compiled/foo/' + os.path.basename(file_path)
+        with open(file_path, 'rb') as f:
+            self.data = f.read()
+
+    def test_gzip(self):
+        # WebTest transparently decodes gzipped responses, so call the app
+        # directly.
+        req = Request.blank(self.url, headers={'Accept-Encoding': 'gzip'})
+        resp = req.get_response(self.app.app)
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(resp.content_type, 'image/svg+xml')
+        self.assertEqual(resp.vary, ('Accept-Encoding',))
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(resp.body)).read(),
+                         self.data)
+
+    def test_identity(self):
+        for accept in (None, 'identity', 'gzip;q=0'):
+            headers = {'Accept-Encoding': accept} if accept else {}
+            resp = self.app.get(self.url, headers=headers)
+            self.assertIsNone(resp.content_encoding)
+            self.assertEqual(resp.vary, ('Accept-Encoding',))
+            self.assertEqual(resp.body, self.data)
+
+    def test_not_found(self):
+        self.app.get('/compiled/foo/nonexistent.svg', status=404)
+        self.app.get('/compiled/foo/../foo/logo.svg', status=404)
+
+
+class TestAssetTagMemoized(Functional):
+    settings = {
+        'pyramid_frontend.compile': True,
+        'pyramid_frontend.compiled_asset_dir':
+            os.path.join(utils.work_dir, 'tag-tests'),
+    }
+
+    def setUp(self):
+        write_manifest(
+            os.path.join(self.settings['pyramid_frontend.compiled_asset_dir'],
+                         'manifest.json'),
+            {'foo': {'logo-svg': {'file': 'logo-1.svg',
+                                  'size': 0,
+                                  'integrity': None}}})
+        Functional.setUp(self)
+
+    def test_render_once(self):
+        orig_tag = SVGAsset.tag
+        with patch.object(SVGAsset, 'tag', autospec=True,
+                          side_effect=orig_tag) as tag:
+            body1 = self.app.get('/svg-tag').body
+            body2 = self.app.get('/svg-tag').body
+        self.assertEqual(body1, body2)
+        self.assertIn(b'/compiled/foo/logo-1.svg', body1)
+        self.assertEqual(tag.call_count, 1)
+
+
+class TestPreloadAssetsFunctional(Functional):
+    # Freezing is opt-in.
+    freeze_calls = 0
+    settings = {
+        'pyramid_frontend.compile': True,
+        'pyramid_frontend.preload_assets': True,
+        'pyramid_frontend.compiled_asset_dir':
+            os.path.join(utils.work_dir, 'preload-tests'),
+    }
+
+    def setUp(self):
+        write_manifest(
+            os.path.join(self.settings['pyramid_frontend.compiled_asset_dir'],
+                         'manifest.json'),
+            {'foo': {'logo-svg': {'file': 'logo-1.svg',
+                                  'size': 0,
+                                  'integrity': None}}})
+        # Don't freeze the test process's objects.
+        with patch('gc.freeze', create=True) as freeze:
+            Functional.setUp(self)
+        self.assertEqual(freeze.call_count, self.freeze_calls)
+
+    def test_preloaded(self):
+        themes = self.app.app.registry.settings[
+            'pyramid_frontend.theme_registry']
+        cache = themes['foo']._asset_tag_cache
+        self.assertIn(('logo-svg', False, None), cache)
+        # Entry points which haven't been compiled are skipped.
+        self.assertNotIn(('main-less', False, None), cache)
+
+        with patch.object(SVGAsset, 'tag', autospec=True) as tag:
+            resp = self.app.get('/svg-tag')
+        resp.mustcontain('/compiled/foo/logo-1.svg')
+        self.assertEqual(tag.call_count, 0)
+
+
+class TestPreloadFreezeFunctional(TestPreloadAssetsFunctional):
+    settings = dict(TestPreloadAssetsFunctional.settings, **{
+        'pyramid_frontend.gc_freeze': True,
+    })
+    freeze_calls = 1
+
+
 class TestImagesFunctional(Functional):
     def setUp(self):
         self.app = TestApp(utils.make_app())
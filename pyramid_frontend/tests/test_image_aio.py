@@ -0,0 +1,138 @@
+from __future__ import absolute_import, print_function, division
+
+import sys
+import time
+import threading
+from unittest import TestCase, skipIf
+from mock import patch
+
+from pyramid import testing
+
+from ..images.files import prefix_for_name
+from ..images import view
+
+from . import utils
+
+
+@skipIf(sys.version_info < (3, 7), 'requires Python 3.7+')
+class TestAsyncImageService(TestCase):
+    def setUp(self):
+        import asyncio
+        from ..images.aio import AsyncImageService
+        self.asyncio = asyncio
+        utils.load_images()
+        self.config = testing.setUp(settings=utils.default_settings)
+        self.config.include('pyramid_frontend')
+        self.config.commit()
+        self.app = AsyncImageService(self.config.registry, chunk_size=1024)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def request(self, path, method='GET'):
+        messages = []
+        loop = self.asyncio.get_event_loop()
+
+        def send(message):
+            messages.append(message)
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        scope = {'type': 'http', 'method': method, 'path': path}
+        return scope, send, messages
+
+    def run_requests(self, *paths):
+        loop = self.asyncio.new_event_loop()
+        self.asyncio.set_event_loop(loop)
+        try:
+            results = []
+            calls = []
+            for path in paths:
+                scope, send, messages = self.request(path)
+                calls.append(self.app(scope, None, send))
+                results.append(messages)
+            loop.run_until_complete(self.asyncio.gather(*calls))
+            return results
+        finally:
+            loop.close()
+
+    def image_path(self, name='smiley-gif-alpha', ext='gif'):
+        return '/img/%s/%s.%s' % (prefix_for_name(name), name, ext)
+
+    def test_serve_image(self):
+        messages, = self.run_requests(self.image_path())
+        start = messages[0]
+        self.assertEqual(start['status'], 200)
+        headers = dict(start['headers'])
+        self.assertEqual(headers[b'content-type'], b'image/gif')
+        body = b''.join(m['body'] for m in messages[1:])
+        self.assertEqual(len(body), int(headers[b'content-length']))
+        self.assertTrue(body.startswith(b'GIF'))
+        self.assertFalse(messages[-1]['more_body'])
+
+    def test_not_found(self):
+        paths = [
+            '/img/0000/smiley-gif-alpha.gif',
+            self.image_path('nonexistent'),
+            '/elsewhere/foo.gif',
+            '/img/nothing',
+        ]
+        for messages in self.run_requests(*paths):
+            self.assertEqual(messages[0]['status'], 404)
+
+    def test_coalesce_concurrent_requests(self):
+        calls = []
+        lock = threading.Lock()
+        orig_process_image = view.process_image
+
+        def slow_process_image(*args, **kwargs):
+            with lock:
+                calls.append(args)
+            time.sleep(0.1)
+            return orig_process_image(*args, **kwargs)
+
+        from ..images import aio
+        with patch.object(aio, 'process_image', slow_process_image):
+            results = self.run_requests(*([self.image_path()] * 5))
+        self.assertEqual(len(calls), 1)
+        for messages in results:
+            self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(self.app.inflight, {})
+
+    def test_lifespan(self):
+        loop = self.asyncio.new_event_loop()
+        self.asyncio.set_event_loop(loop)
+        events = [{'type': 'lifespan.startup'},
+                  {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        def resolved(value=None):
+            future = loop.create_future()
+            future.set_result(value)
+            return future
+
+        def receive():
+            return resolved(events.pop(0))
+
+        def send(message):
+            sent.append(message['type'])
+            return resolved()
+
+        try:
+            loop.run_until_complete(
+                self.app({'type': 'lifespan'}, receive, send))
+        finally:
+            loop.close()
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+
+    def test_unsupported_scope(self):
+        loop = self.asyncio.new_event_loop()
+        self.asyncio.set_event_loop(loop)
+        try:
+            with self.assertRaises(ValueError):
+                loop.run_until_complete(
+                    self.app({'type': 'websocket'}, None, None))
+        finally:
+            loop.close()
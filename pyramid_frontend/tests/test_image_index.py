@@ -0,0 +1,98 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+from unittest import TestCase
+
+from ..images.chain import PassThroughFilterChain
+from ..images.files import (original_path, processed_path,
+                            iter_stored_images)
+from ..images.index import ImageIndex, get_image_index
+from ..images.view import process_image
+
+from . import utils
+
+
+class TestImageIndex(TestCase):
+    def setUp(self):
+        self.settings = utils.default_settings.copy()
+        self.settings['pyramid_frontend.image_index'] = \
+            os.path.join(utils.work_dir, 'index-%s.db' % self._testMethodName)
+        if os.path.exists(self.settings['pyramid_frontend.image_index']):
+            os.remove(self.settings['pyramid_frontend.image_index'])
+        utils.load_images(self.settings)
+        self.index = get_image_index(self.settings)
+
+    def test_no_index_configured(self):
+        self.assertIsNone(get_image_index(utils.default_settings))
+
+    def test_get_image_index_shared(self):
+        self.assertIs(get_image_index(self.settings), self.index)
+
+    def test_save_image_indexed(self):
+        originals = list(self.index.iter_originals())
+        names = sorted(set(row[1] for row in originals))
+        self.assertEqual(names, ['smiley-gif-alpha',
+                                 'smiley-jpeg-cmyk',
+                                 'smiley-jpeg-rgb',
+                                 'smiley-png24-alpha'])
+        path = original_path(self.settings, 'smiley-gif-alpha', 'gif')
+        self.assertIn(path, [row[0] for row in originals])
+        self.assertGreater(self.index.total_size('original'), 0)
+
+    def test_process_image_indexed(self):
+        chain = PassThroughFilterChain()
+        proc_path = process_image(self.settings, 'smiley-gif-alpha', 'gif',
+                                  chain)
+        variants = list(self.index.iter_variants('smiley-gif-alpha', 'gif'))
+        self.assertEqual(len(variants), 1)
+        path, name, original_ext, suffix, size, mtime = variants[0]
+        self.assertEqual(path, proc_path)
+        self.assertEqual(size, os.path.getsize(proc_path))
+
+    def test_orphans_and_remove(self):
+        index = ImageIndex(os.path.join(utils.work_dir, 'orphans.db'))
+        index.remove('/nowhere/a.gif')
+        index.add_original('/orig/a.gif', 'a', 'gif')
+        index.add_variant('/proc/a_gif_thumb.png', 'a', 'gif', 'thumb')
+        index.add_variant('/proc/b_gif_thumb.png', 'b', 'gif', 'thumb')
+        orphans = [row[0] for row in index.iter_orphans()]
+        self.assertEqual(orphans, ['/proc/b_gif_thumb.png'])
+        index.remove('/proc/b_gif_thumb.png')
+        self.assertEqual(list(index.iter_orphans()), [])
+
+    def test_remove_while_iterating(self):
+        index = ImageIndex(os.path.join(utils.work_dir, 'streaming.db'))
+        index.batch_size = 2
+        for n in range(5):
+            index.remove('/proc/%d.png' % n)
+            index.add_variant('/proc/%d.png' % n, str(n), 'gif', None)
+        seen = []
+        for row in index.iter_orphans():
+            seen.append(row[0])
+            index.remove(row[0])
+        self.assertEqual(sorted(seen),
+                         ['/proc/%d.png' % n for n in range(5)])
+        self.assertEqual(list(index.iter_variants()), [])
+
+
+class TestIterStoredImages(TestCase):
+    def test_iter_stored_images(self):
+        utils.load_images()
+        settings = utils.default_settings
+        chain = PassThroughFilterChain()
+        process_image(settings, 'smiley-gif-alpha', 'gif', chain)
+        thumb_path = processed_path(
+            settings, 'smiley-gif-alpha', 'gif',
+            PassThroughFilterChain('thumb'))
+        thumb_path = thumb_path.replace('smiley-gif-alpha.gif',
+                                        'smiley-gif-alpha_gif_thumb.png')
+        open(thumb_path, 'wb').close()
+
+        stored = [(kind, name, original_ext, suffix)
+                  for kind, path, name, original_ext, suffix in
+                  iter_stored_images(settings)]
+        self.assertIn(('original', 'smiley-jpeg-rgb', 'jpg', None), stored)
+        self.assertIn(('variant', 'smiley-gif-alpha', 'gif', None), stored)
+        self.assertIn(('variant', 'smiley-gif-alpha', 'gif', 'thumb'),
+                      stored)
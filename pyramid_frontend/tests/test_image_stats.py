@@ -0,0 +1,209 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import gc
+import io
+import time
+import errno
+from unittest import TestCase
+from mock import patch
+
+from pyramid import testing
+
+from ..images.chain import PassThroughFilterChain
+from ..images.files import processed_path
+from ..images.index import get_image_index
+from ..images.stats import (AccessLog, load_access_stats, compact_access_log,
+                            evict, warm_top, live_logs, flush_all,
+                            iter_least_recently_used)
+from ..images.commands import parse_size
+
+from . import utils
+
+
+class TestAccessLog(TestCase):
+    def setUp(self):
+        self.path = os.path.join(utils.work_dir, 'access.log')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_record_and_load(self):
+        access_log = AccessLog(self.path)
+        access_log.record('foo', 'jpg', 'thumb')
+        access_log.record('foo', 'jpg', 'thumb')
+        access_log.record('bar', 'png', None)
+        access_log.flush()
+        access_log.record('foo', 'jpg', 'thumb')
+        access_log.flush()
+
+        stats = load_access_stats(self.path)
+        self.assertEqual(stats[('foo', 'jpg', 'thumb')][0], 3)
+        self.assertEqual(stats[('bar', 'png', None)][0], 1)
+
+    def test_flush_size(self):
+        access_log = AccessLog(self.path, flush_size=2)
+        access_log.record('foo', 'jpg', 'thumb')
+        self.assertFalse(os.path.exists(self.path))
+        access_log.record('foo', 'jpg', 'thumb')
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_flush_all(self):
+        access_log = AccessLog(self.path)
+        access_log.record('foo', 'jpg', 'thumb')
+        flush_all()
+        stats = load_access_stats(self.path)
+        self.assertEqual(stats[('foo', 'jpg', 'thumb')][0], 1)
+        # Logs which are no longer in use aren't kept alive for the exit
+        # handler.
+        del access_log
+        gc.collect()
+        self.assertFalse(any(other.path == self.path for other in live_logs))
+
+    def test_compact(self):
+        access_log = AccessLog(self.path)
+        for n in range(3):
+            access_log.record('foo', 'jpg', 'thumb')
+            access_log.record('bar', 'png', None)
+            access_log.flush()
+        stats = load_access_stats(self.path)
+
+        self.assertEqual(compact_access_log(self.path), 2)
+        with io.open(self.path, encoding='utf8') as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(load_access_stats(self.path), stats)
+
+    def test_sample_rate_zero(self):
+        access_log = AccessLog(self.path, sample_rate=0)
+        access_log.record('foo', 'jpg', 'thumb')
+        access_log.flush()
+        self.assertEqual(load_access_stats(self.path), {})
+
+
+class TestEviction(TestCase):
+    def setUp(self):
+        utils.load_images()
+        self.config = testing.setUp(settings=utils.default_settings)
+        self.config.include('pyramid_frontend')
+        self.config.commit()
+        self.registry = self.config.registry
+        self.chain = PassThroughFilterChain()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _make_processed(self, name, ext, mtime):
+        path = processed_path(utils.default_settings, name, ext, self.chain)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_evict_lru(self):
+        now = time.time()
+        old = self._make_processed('old', 'gif', now - 300)
+        hot = self._make_processed('hot', 'gif', now - 200)
+        new = self._make_processed('new', 'gif', now - 100)
+        # 'hot' was requested recently, so it should be kept.
+        stats = {('hot', 'gif', None): (10, now)}
+
+        removed, freed = evict(self.registry, 200, stats)
+        self.assertEqual((removed, freed), (1, 100))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(hot))
+        self.assertTrue(os.path.exists(new))
+
+        removed, freed = evict(self.registry, 100, stats)
+        self.assertEqual(removed, 1)
+        self.assertFalse(os.path.exists(new))
+        self.assertTrue(os.path.exists(hot))
+
+    def test_evict_keeps_index_on_failure(self):
+        now = time.time()
+        locked = self._make_processed('locked', 'gif', now - 300)
+        gone = self._make_processed('gone', 'gif', now - 200)
+        os.remove(gone)
+        removed_from_index = []
+
+        class DummyIndex(object):
+            def iter_variants(self):
+                for path in (locked, gone):
+                    yield path, None, None, None, 100, now - 300
+
+            def total_size(self):
+                return 200
+
+            def remove(self, path):
+                removed_from_index.append(path)
+
+        orig_remove = os.remove
+
+        def remove(path):
+            if path == locked:
+                raise OSError(errno.EACCES, 'Permission denied')
+            orig_remove(path)
+
+        with patch('pyramid_frontend.images.stats.get_image_index',
+                   return_value=DummyIndex()):
+            with patch('os.remove', remove):
+                evict(self.registry, 0, {})
+        # The file which couldn't be removed is still indexed, but the one
+        # which was already gone isn't.
+        self.assertEqual(removed_from_index, [gone])
+        os.remove(locked)
+
+    def test_evict_lru_indexed(self):
+        now = time.time()
+        settings = dict(utils.default_settings)
+        settings['pyramid_frontend.image_index'] = \
+            os.path.join(utils.work_dir, 'evict-index.db')
+        if os.path.exists(settings['pyramid_frontend.image_index']):
+            os.remove(settings['pyramid_frontend.image_index'])
+        self.registry.settings = settings
+        index = get_image_index(settings)
+        paths = {}
+        for name, age in (('old', 300), ('hot', 200), ('new', 100)):
+            paths[name] = self._make_processed(name, 'gif', now - age)
+            index.add_variant(paths[name], name, 'gif', None)
+        stats = {('hot', 'gif', None): (10, now)}
+
+        removed, freed = evict(self.registry, 100, stats)
+        self.assertEqual((removed, freed), (2, 200))
+        self.assertTrue(os.path.exists(paths['hot']))
+        self.assertEqual([row[0] for row in index.iter_variants()],
+                         [paths['hot']])
+
+    def test_iter_least_recently_used(self):
+        files = [('a', 1, 10), ('b', 1, 20), ('c', 1, 30), ('d', 1, 40)]
+        last_accesses = {'a': 35, 'c': 50}
+        self.assertEqual(
+            [path for last_used, size, path in
+             iter_least_recently_used(iter(files), last_accesses)],
+            ['b', 'a', 'd', 'c'])
+
+    def test_warm_top(self):
+        added = []
+
+        class DummyWarmer(object):
+            def add(self, name, original_ext, chain, priority=None,
+                    overwrite=False):
+                added.append((name, priority))
+
+        stats = {
+            ('a', 'gif', None): (5, 0),
+            ('b', 'gif', None): (50, 0),
+            ('c', 'gif', 'unregistered'): (500, 0),
+            ('d', 'gif', None): (1, 0),
+        }
+        count = warm_top(self.registry, stats, DummyWarmer(), 2)
+        self.assertEqual(count, 2)
+        self.assertEqual(added, [('b', 50), ('a', 5)])
+
+
+class TestParseSize(TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5G'), 1536 * 1024 * 1024)
@@ -0,0 +1,139 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import shutil
+from unittest import TestCase
+
+from ..theme import Theme
+from ..assets.requirejs import (RequireJSAsset, RequireJSCommonAsset,
+                                module_dependencies)
+
+from . import utils
+
+
+js_dir = os.path.join(utils.work_dir, 'requirejs-tests', 'static', 'js')
+
+scripts = {
+    'page1.js': "require(['app/util', 'app/only1'], function () {});",
+    'page2.js': "require(['app/util', 'app/only2', 'text!x.html'],\n"
+                "        function () {});",
+    'page3.js': "define(['require', 'app/only2'], function (require) {\n"
+                "  var missing = require('app/missing');\n"
+                "});",
+    'util.js': "define('app/util', ['./shared', 'exports'],\n"
+               "       function (shared, exports) {});",
+    'shared.js': "define([], function () {});",
+    'only1.js': "define(function () {});",
+    'only2.js': "define(function () {});",
+}
+
+
+class SplitTheme(Theme):
+    key = 'app'
+    static_dir = os.path.dirname(js_dir)
+    assets = {
+        'common-js': RequireJSCommonAsset(),
+        'page1-js': RequireJSAsset('/_app/js/page1.js', common='common-js'),
+        'page2-js': RequireJSAsset('/_app/js/page2.js', common='common-js'),
+        'page3-js': RequireJSAsset('/_app/js/page3.js', common='common-js'),
+        'standalone-js': RequireJSAsset('/_app/js/page1.js'),
+    }
+
+
+class TestCommonBundle(TestCase):
+    def setUp(self):
+        if os.path.exists(js_dir):
+            shutil.rmtree(js_dir)
+        os.makedirs(js_dir)
+        for name, source in scripts.items():
+            with open(os.path.join(js_dir, name), 'w') as f:
+                f.write(source)
+        self.theme = SplitTheme({})
+        self.assets = self.theme.stacked_assets
+
+    def test_module_dependencies(self):
+        self.assertEqual(
+            module_dependencies(os.path.join(js_dir, 'page3.js')),
+            ['require', 'app/only2', 'app/missing'])
+        self.assertEqual(
+            module_dependencies(os.path.join(js_dir, 'util.js')),
+            ['./shared', 'exports'])
+
+    def test_module_graph(self):
+        asset = self.assets['page2-js']
+        base_url, main = asset.entry_module(self.theme)
+        self.assertEqual(asset.module_graph(self.theme),
+                         set([main, 'app/util', 'app/shared', 'app/only2']))
+
+    def test_shared_modules(self):
+        common = self.assets['common-js']
+        self.assertEqual(common.shared_modules(self.theme),
+                         ['app/only2', 'app/shared', 'app/util'])
+        common.min_entries = 3
+        self.assertEqual(common.shared_modules(self.theme), [])
+
+    def test_build_config(self):
+        options = dict(self.assets['common-js'].build_config(
+            'common-js', self.theme))
+        self.assertEqual(options['name'], 'requireLib')
+        self.assertEqual(options['include'],
+                         ['app/only2', 'app/shared', 'app/util'])
+
+        options = dict(self.assets['page1-js'].build_config(
+            'page1-js', self.theme))
+        self.assertNotIn('include', options)
+        self.assertEqual(options['exclude'],
+                         ['app/only2', 'app/shared', 'app/util'])
+
+        options = dict(self.assets['standalone-js'].build_config(
+            'standalone-js', self.theme))
+        self.assertEqual(options['include'], ['requireLib'])
+        self.assertNotIn('exclude', options)
+
+    def test_tags(self):
+        self.theme.use_manifest({'app': {
+            'common-js': {'file': 'common.js', 'integrity': 'sha384-c'},
+            'page1-js': {'file': 'page1.js', 'integrity': 'sha384-p'},
+        }})
+        tag = self.assets['page1-js'].tag_production(
+            self.theme, '/compiled/app/page1.js', integrity='sha384-p')
+        self.assertEqual(
+            tag,
+            '<script integrity="sha384-c" src="/compiled/app/common.js">'
+            '</script>'
+            '<script integrity="sha384-p" src="/compiled/app/page1.js">'
+            '</script>')
+        self.assertEqual(
+            self.assets['common-js'].tag_development(self.theme, None), '')
+
+    def test_async_with_common(self):
+        with self.assertRaises(ValueError):
+            RequireJSAsset('/_app/js/page1.js', common='common-js',
+                           loading='async')
+
+        self.theme.use_manifest({'app': {
+            'common-js': {'file': 'common.js'},
+            'page1-js': {'file': 'page1.js'},
+        }})
+        # An async attribute passed to the tag is turned into defer on both
+        # tags, so that the common bundle still runs first.
+        tag = self.assets['page1-js'].tag_production(
+            self.theme, '/compiled/app/page1.js', **{'async': 'async'})
+        self.assertEqual(
+            tag,
+            '<script defer="defer" src="/compiled/app/common.js"></script>'
+            '<script defer="defer" src="/compiled/app/page1.js"></script>')
+
+    def test_dependencies(self):
+        # Templates loaded with the text plugin are inputs too.
+        template = os.path.join(js_dir, 'x.html')
+        with open(template, 'w') as f:
+            f.write('<p></p>')
+        deps = self.assets['page2-js'].dependencies(self.theme)
+        self.assertIn(template, deps)
+        self.assertIn(os.path.join(js_dir, 'only1.js'), deps)
+
+    def test_preamble(self):
+        self.assertEqual(self.assets['page1-js'].bundle_preamble(), '')
+        self.assertIn('console', self.assets['common-js'].bundle_preamble())
@@ -0,0 +1,188 @@
+from __future__ import absolute_import, print_function, division
+
+import io
+import os.path
+import sys
+import json
+import base64
+import shutil
+from unittest import TestCase
+
+from ..assets import sourcemap
+from ..assets.asset import Asset
+from ..assets.less import LessAsset
+from ..assets.requirejs import RequireJSAsset
+
+from . import utils
+from .example import foo
+
+
+# A stand-in for lessc and autoprefixer which passes the source through, with
+# an inline source map mapping each line to the same line of the input.
+identity_compiler = '''
+import sys
+import json
+import base64
+
+data = sys.stdin.read()
+lines = data.count('\\n') + 1
+smap = {
+    'version': 3,
+    'sources': ['input'],
+    'names': [],
+    'mappings': ';'.join(['AAAA'] + ['AACA'] * (lines - 1)),
+}
+encoded = base64.b64encode(json.dumps(smap).encode('utf-8')).decode('ascii')
+sys.stdout.write(data)
+sys.stdout.write('\\n/*# sourceMappingURL=data:application/json;'
+                 'charset=utf-8;base64,%s */' % encoded)
+'''
+
+
+class TestSourceMap(TestCase):
+    def test_vlq_round_trip(self):
+        values = [0, 1, -1, 15, 16, -16, 1000, -123456]
+        encoded = sourcemap.vlq_encode(values)
+        self.assertEqual(sourcemap.vlq_decode(encoded), values)
+        self.assertEqual(sourcemap.vlq_encode([0, 0, 1, 0]), 'AACA')
+
+    def test_mappings_round_trip(self):
+        mappings = 'AAAA,IAAI;;AACA,EAAE,CCAC;G'
+        lines = sourcemap.decode_mappings(mappings)
+        self.assertEqual(lines[0], [[0, 0, 0, 0], [4, 0, 0, 4]])
+        self.assertEqual(lines[1], [])
+        self.assertEqual(lines[2], [[0, 0, 1, 4], [2, 0, 1, 6],
+                                    [3, 1, 1, 7]])
+        self.assertEqual(lines[3], [[3]])
+        self.assertEqual(sourcemap.encode_mappings(lines), mappings)
+
+    def test_extract_inline_map(self):
+        smap = {'version': 3, 'mappings': 'AAAA'}
+        encoded = base64.b64encode(json.dumps(smap).encode('utf-8'))
+        data = (b'a{color:red}\n/*# sourceMappingURL=data:application/json;'
+                b'base64,' + encoded + b' */\n')
+        css, extracted = sourcemap.extract_inline_map(data)
+        self.assertEqual(css, b'a{color:red}')
+        self.assertEqual(extracted, smap)
+
+        css, extracted = sourcemap.extract_inline_map(b'a{color:red}')
+        self.assertEqual(css, b'a{color:red}')
+        self.assertIsNone(extracted)
+
+    def test_strip_map_comment(self):
+        self.assertEqual(
+            sourcemap.strip_map_comment(b'x();\n//# sourceMappingURL=x.map\n'),
+            b'x();')
+
+    def test_remap_concatenated(self):
+        theme = foo.FooTheme({})
+        layout = theme.static_url_to_filesystem_path('/_base/css/layout.less')
+        article = theme.static_url_to_filesystem_path('/_foo/css/article.less')
+        smap = {
+            'version': 3,
+            'sources': ['input'],
+            'sourceRoot': '/',
+            'names': [],
+            'mappings': 'AAAA;AACA;AACA',
+        }
+        origins = [(layout, 0), (article, 3), (layout, 1)]
+        sourcemap.remap_concatenated(smap, origins,
+                                     theme.filesystem_path_to_static_url)
+        self.assertEqual(smap['sources'], ['/_base/css/layout.less',
+                                           '/_foo/css/article.less'])
+        self.assertNotIn('sourceRoot', smap)
+        with io.open(article, encoding='utf8') as f:
+            self.assertEqual(smap['sourcesContent'][1], f.read())
+        self.assertEqual(sourcemap.decode_mappings(smap['mappings']),
+                         [[[0, 0, 0, 0]], [[0, 1, 3, 0]], [[0, 0, 1, 0]]])
+
+
+class TestSourceMapOutput(TestCase):
+    def setUp(self):
+        self.theme = foo.FooTheme({})
+        self.output_dir = os.path.join(utils.work_dir, 'sourcemap-tests')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def test_write_bytes(self):
+        asset = Asset('/_foo/css/main.less')
+        asset.extension = 'css'
+        smap = {'version': 3, 'sources': [], 'names': [], 'mappings': ''}
+        file_path = asset.write_bytes('main-less', b'a{color:red}\n',
+                                      'main', self.output_dir,
+                                      source_map=smap)
+        file_name = os.path.basename(file_path)
+        with io.open(file_path, 'rb') as f:
+            self.assertEqual(f.read(), (
+                b'a{color:red}\n/*# sourceMappingURL=' +
+                file_name.encode('ascii') + b'.map */'))
+        with io.open(file_path + '.map', encoding='utf8') as f:
+            self.assertEqual(json.load(f)['file'], file_name)
+
+        # A different map gets a different file name.
+        smap = {'version': 3, 'sources': ['x'], 'names': [], 'mappings': ''}
+        other_path = asset.write_bytes('main-less', b'a{color:red}\n',
+                                       'main', self.output_dir,
+                                       source_map=smap)
+        self.assertNotEqual(other_path, file_path)
+
+    def test_filesystem_path_to_static_url(self):
+        path = self.theme.static_url_to_filesystem_path('/_foo/css/main.less')
+        self.assertEqual(self.theme.filesystem_path_to_static_url(path),
+                         '/_foo/css/main.less')
+        with self.assertRaises(ValueError):
+            self.theme.filesystem_path_to_static_url('/etc/passwd')
+
+    def test_less_source_map(self):
+        asset = LessAsset('/_foo/css/main.less', lessc_path='identity',
+                          source_map=True)
+        asset.stages = lambda minify: [[sys.executable, '-c',
+                                        identity_compiler]]
+        file_path = asset.compile(key='main-less',
+                                  theme=self.theme,
+                                  output_dir=self.output_dir)
+        with io.open(file_path, encoding='utf8') as f:
+            lines = f.read().split('\n')
+        self.assertEqual(
+            lines[-1],
+            '/*# sourceMappingURL=%s.map */' % os.path.basename(file_path))
+        with io.open(file_path + '.map', encoding='utf8') as f:
+            smap = json.load(f)
+        self.assertEqual(sorted(smap['sources']),
+                         ['/_base/css/layout.less',
+                          '/_foo/css/article.less',
+                          '/_foo/css/main.less'])
+
+        # Every line of the output maps back to the line it came from.
+        mappings = sourcemap.decode_mappings(smap['mappings'])
+        for line, segments in zip(lines[:-1], mappings):
+            source, source_line = segments[0][1:3]
+            path = self.theme.static_url_to_filesystem_path(
+                smap['sources'][source])
+            with io.open(path, encoding='utf8') as f:
+                self.assertEqual(f.read().split('\n')[source_line], line)
+        article_line = lines.index(u'.article {')
+        segment = mappings[article_line][0]
+        self.assertEqual(smap['sources'][segment[1]],
+                         '/_foo/css/article.less')
+        self.assertEqual(segment[2], 0)
+
+    def test_requirejs_map_sources(self):
+        asset = RequireJSAsset('/_foo/js/main.js')
+        js_dir = self.theme.static_url_to_filesystem_path('/_foo/js')
+        smap = {'sources': ['main.js', '../../../../../outside.js'],
+                'sourceRoot': ''}
+        asset.resolve_map_sources(self.theme, smap, js_dir)
+        self.assertEqual(smap['sources'],
+                         ['/_foo/js/main.js', '../../../../../outside.js'])
+        self.assertNotIn('sourceRoot', smap)
+
+    def test_requirejs_options(self):
+        asset = RequireJSAsset('/_foo/js/main.js', source_map=True)
+        options = dict(asset.base_config(self.theme, minify=True))
+        self.assertEqual(options['optimize'], 'uglify2')
+        self.assertIs(options['generateSourceMaps'], True)
+        options = dict(asset.base_config(self.theme, minify=False))
+        self.assertEqual(options['optimize'], 'none')
+        self.assertNotIn('generateSourceMaps', options)
@@ -0,0 +1,137 @@
+from __future__ import absolute_import, print_function, division
+
+import io
+import os.path
+import shutil
+from unittest import TestCase
+
+from ..assets.svg import (SVGAsset, SVGSpriteAsset, optimize_svg,
+                          build_sprite, round_coordinates)
+
+from . import utils
+from .example import foo
+
+
+class SpriteTheme(foo.FooTheme):
+    key = 'sprite'
+    assets = {
+        'icon-svg': SVGAsset('/_foo/images/icon.svg', sprite='icons'),
+        'logo-svg': SVGAsset('/_foo/images/logo.svg', sprite='icons'),
+        'icons': SVGSpriteAsset(),
+    }
+
+
+def read_static(theme, url):
+    with io.open(theme.static_url_to_filesystem_path(url), 'rb') as f:
+        return f.read()
+
+
+class TestOptimizeSVG(TestCase):
+    def setUp(self):
+        self.theme = foo.FooTheme({})
+
+    def test_round_coordinates(self):
+        self.assertEqual(round_coordinates('M 1.23456,2.00001 L-0.0001 3e-2',
+                                           3),
+                         'M 1.235,2 L0 0.03')
+
+    def test_round_arc_flags(self):
+        # The flags are single digits, so "0110" is two flags and "10".
+        self.assertEqual(round_coordinates('M0 0a5 5 0 0110 10', 3),
+                         'M0 0a5 5 0 0110 10')
+        self.assertEqual(
+            round_coordinates('M0 0A5.12345 5 0 1 0 1.23456 2a1 1 0 0010 1',
+                              2),
+            'M0 0A5.12 5 0 1 0 1.23 2a1 1 0 0010 1')
+        self.assertEqual(round_coordinates('M1.75.75L.125-.125', 1),
+                         'M1.8 0.8L0.1-0.1')
+
+    def test_optimize(self):
+        data = optimize_svg(read_static(self.theme, '/_foo/images/icon.svg'))
+        self.assertEqual(data, (
+            b'<svg xmlns="http://www.w3.org/2000/svg" '
+            b'xmlns:xlink="http://www.w3.org/1999/xlink" '
+            b'width="24" height="24">'
+            b'<defs><linearGradient id="fill">'
+            b'<stop offset="0" style="stop-color:#000000"/>'
+            b'</linearGradient></defs>'
+            b'<path d="M 2,3.142 L 22,0 Z" fill="url(#fill)"/></svg>'))
+
+    def test_keeps_text_whitespace(self):
+        data = optimize_svg(b'<svg xmlns="http://www.w3.org/2000/svg">\n'
+                            b'  <text> a  b </text>\n</svg>')
+        self.assertIn(b'<text> a  b </text>', data)
+
+    def test_build_sprite(self):
+        sprite = build_sprite([
+            ('icon', read_static(self.theme, '/_foo/images/icon.svg')),
+            ('logo', read_static(self.theme, '/_foo/images/logo.svg')),
+        ])
+        self.assertIn(b'<symbol id="icon" viewBox="0 0 24 24">', sprite)
+        self.assertIn(b'<symbol id="logo" viewBox="0 0 240 100">', sprite)
+        # IDs within each image are prefixed, along with references to them.
+        self.assertIn(b'<linearGradient id="icon-fill">', sprite)
+        self.assertIn(b'fill="url(#icon-fill)"', sprite)
+        self.assertNotIn(b'inkscape', sprite)
+
+
+class TestSVGAsset(TestCase):
+    def setUp(self):
+        self.theme = SpriteTheme({})
+        self.output_dir = os.path.join(utils.work_dir, 'svg-tests')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def test_compile(self):
+        asset = self.theme.stacked_assets['icon-svg']
+        path = asset.compile(key='icon-svg',
+                             theme=self.theme,
+                             output_dir=self.output_dir)
+        with io.open(path, 'rb') as f:
+            self.assertNotIn(b'metadata', f.read())
+
+        path = asset.compile(key='icon-svg',
+                             theme=self.theme,
+                             output_dir=self.output_dir,
+                             minify=False)
+        with io.open(path, 'rb') as f:
+            self.assertIn(b'metadata', f.read())
+
+    def test_compile_sprite(self):
+        asset = self.theme.stacked_assets['icons']
+        path = asset.compile(key='icons',
+                             theme=self.theme,
+                             output_dir=self.output_dir)
+        self.assertTrue(os.path.basename(path).startswith('sprite.svg-'))
+        with io.open(path, 'rb') as f:
+            sprite = f.read()
+        self.assertIn(b'<symbol id="icon-svg"', sprite)
+        self.assertIn(b'<symbol id="logo-svg"', sprite)
+        to_path = self.theme.static_url_to_filesystem_path
+        self.assertEqual(sorted(asset.dependencies(self.theme)),
+                         [to_path('/_foo/images/icon.svg'),
+                          to_path('/_foo/images/logo.svg')])
+
+    def test_tags(self):
+        self.theme.use_manifest({'sprite': {
+            'icon-svg': {'file': 'icon-1.svg'},
+            'icons': {'file': 'sprite-1.svg'},
+        }})
+        asset = self.theme.stacked_assets['icon-svg']
+        self.assertEqual(
+            asset.tag(self.theme, '/compiled/sprite/icon-1.svg',
+                      production=True, class_='icon'),
+            '<svg aria-hidden="true" class="icon">'
+            '<use href="/compiled/sprite/sprite-1.svg#icon-svg" '
+            'xlink:href="/compiled/sprite/sprite-1.svg#icon-svg"></use>'
+            '</svg>')
+        tag = asset.tag(self.theme, '/compiled/sprite/icon-1.svg',
+                        production=True, alt='Icon')
+        self.assertIn('aria-label="Icon"', tag)
+        self.assertIn('role="img"', tag)
+        self.assertEqual(
+            asset.tag(self.theme, '/_foo/images/icon.svg', production=False),
+            '<img alt="" src="/_foo/images/icon.svg" />')
+        self.assertEqual(self.theme.stacked_assets['icons'].tag(
+            self.theme, '/compiled/sprite/sprite-1.svg'), '')
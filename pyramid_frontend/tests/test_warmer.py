@@ -0,0 +1,86 @@
+from __future__ import absolute_import, print_function, division
+
+import time
+from unittest import TestCase
+from mock import patch
+
+from ..images import chain, filters
+from ..images.chain import PassThroughFilterChain
+from ..images.filters import Filter
+from ..images.warmer import Warmer
+
+from . import utils
+
+
+class RecordingFilter(Filter):
+    def __init__(self):
+        self.seen = []
+
+    def __call__(self, input):
+        self.seen.append(input.name)
+        return input
+
+
+class TestWarmer(TestCase):
+    def setUp(self):
+        utils.load_images()
+        self.filter = RecordingFilter()
+        self.chain = PassThroughFilterChain('warm', filters=[self.filter])
+
+    def test_priority_order(self):
+        warmer = Warmer(utils.default_settings, concurrency=1)
+        warmer.add('smiley-gif-alpha', 'gif', self.chain, priority=1)
+        warmer.add('smiley-jpeg-rgb', 'jpg', self.chain, priority=3)
+        warmer.add('smiley-png24-alpha', 'png', self.chain, priority=2)
+        # Skip external optimization tools for this test.
+        with patch.dict(chain.postprocessors, clear=True):
+            processed, failed = warmer.run()
+        self.assertEqual((processed, failed), (3, 0))
+        names = [path.rsplit('/', 1)[1] for path in self.filter.seen]
+        self.assertEqual(names, ['smiley-jpeg-rgb.jpg',
+                                 'smiley-png24-alpha.png',
+                                 'smiley-gif-alpha.gif'])
+
+    def test_missing_original(self):
+        warmer = Warmer(utils.default_settings, concurrency=2)
+        warmer.add('nonexistent', 'gif', self.chain)
+        warmer.add('smiley-gif-alpha', 'gif', self.chain)
+        self.assertEqual(warmer.run(), (1, 1))
+
+    def test_pause_on_load(self):
+        warmer = Warmer(utils.default_settings, concurrency=1, max_load=4)
+        warmer.add('smiley-gif-alpha', 'gif', self.chain)
+        loads = [(9.0, 0, 0), (5.0, 0, 0), (1.0, 0, 0)]
+        with patch('os.getloadavg', side_effect=loads):
+            with patch('time.sleep') as sleep:
+                warmer.run()
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(len(self.filter.seen), 1)
+
+    def test_tool_concurrency(self):
+        active = []
+        peak = []
+
+        class ShellFilter(Filter):
+            def __call__(self, input):
+                with filters.shell_slot():
+                    active.append(input)
+                    peak.append(len(active))
+                    # The process-wide limit isn't touched.
+                    assert filters.shell_semaphore is None
+                    time.sleep(0.02)
+                    active.remove(input)
+                return input
+
+        shell_chain = PassThroughFilterChain('shell', filters=[ShellFilter()])
+        warmer = Warmer(utils.default_settings, concurrency=3,
+                        tool_concurrency=1)
+        for name, original_ext in (('smiley-gif-alpha', 'gif'),
+                                   ('smiley-jpeg-rgb', 'jpg'),
+                                   ('smiley-png24-alpha', 'png')):
+            warmer.add(name, original_ext, shell_chain, overwrite=True)
+        with patch.dict(chain.postprocessors, clear=True):
+            self.assertEqual(warmer.run(), (3, 0))
+        self.assertEqual(max(peak), 1)
+        self.assertIsNone(filters.shell_semaphore)
+        self.assertIsNone(getattr(filters.shell_local, 'semaphore', None))
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, print_function, division
 
+import logging
+
 import os.path
 import inspect
 import pkg_resources
@@ -8,10 +10,14 @@ from pyramid.decorator import reify
 from pyramid.settings import aslist, asbool
 from pyramid.path import DottedNameResolver
 
+from .assets.builds import compiled_root, link_file
+from .assets.manifest import load_manifest, manifest_path
 from .templating.lookup import SuperTemplateLookup
 from .templating.renderer import (mako_renderer_factory,
                                   mako_renderer_factory_nofilters)
 
+log = logging.getLogger(__name__)
+
 static_dir = pkg_resources.resource_filename('pyramid_frontend', 'static')
 
 
@@ -39,7 +45,11 @@ class Theme(object):
 
     def __init__(self, settings):
         self.settings = settings
+        # The versioned build being written by pcompile, if any.
+        self.build_dir = None
+        self.manifest = {}
         self._compiled_asset_cache = {}
+        self._asset_tag_cache = {}
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.key)
@@ -136,14 +146,23 @@ class Theme(object):
         stack.append(('pfe', static_dir))
         return stack
 
+    def use_manifest(self, manifest):
+        """
+        Look up compiled assets in this theme's section of a build manifest
+        (see ``pyramid_frontend.assets.manifest``), rather than in map files.
+        """
+        self.manifest = (manifest or {}).get(self.key, {})
+        self._asset_tag_cache.clear()
+
     def compiled_asset_path(self, key):
+        entry = self.manifest.get(key)
+        if entry:
+            return entry['file']
         if key in self._compiled_asset_cache:
             return self._compiled_asset_cache[key]
         else:
-            map_path = os.path.join(
-                self.settings['pyramid_frontend.compiled_asset_dir'],
-                self.key,
-                '%s.map' % key)
+            map_path = os.path.join(self.compiled_asset_dir,
+                                    '%s.map' % key)
             with open(map_path) as f:
                 self._compiled_asset_cache[key] = compiled_path = f.read()
                 return compiled_path
@@ -160,6 +179,20 @@ class Theme(object):
         base_dir = theme_dirs[theme_key]
         return os.path.join(base_dir, path)
 
+    def filesystem_path_to_static_url(self, path):
+        """
+        The inverse of ``static_url_to_filesystem_path()``: given the path of
+        a file in one of the theme's static dirs, return its /_<theme
+        key>/<path> URL. Raises ``ValueError`` if the file isn't in any of
+        them.
+        """
+        path = os.path.abspath(path)
+        for key, static_dir in self.keyed_static_dirs:
+            rel_path = os.path.relpath(path, os.path.abspath(static_dir))
+            if rel_path.split(os.sep)[0] != os.pardir:
+                return '/_%s/%s' % (key, rel_path.replace(os.sep, '/'))
+        raise ValueError('path %r is not in any static dirs' % path)
+
     def opt(self, key, default=default_sentinel):
         if default is default_sentinel:
             return getattr(self, key)
@@ -172,15 +205,68 @@ class Theme(object):
                 return '/_%s/%s' % (key, path)
         raise IOError('path %r does not exist in any static dirs' % path)
 
-    def compile(self, minify=True):
-        output_dir = os.path.join(
-            self.settings['pyramid_frontend.compiled_asset_dir'],
-            self.key)
-        for key, asset in self.stacked_assets.items():
-            asset.compile(key=key,
-                          theme=self,
-                          output_dir=output_dir,
-                          minify=minify)
+    @property
+    def compiled_asset_dir(self):
+        """
+        The directory of this theme's compiled assets: in the build being
+        written, if any, otherwise in the build which is being served.
+        """
+        root = self.build_dir or compiled_root(self.settings)
+        return os.path.join(root, self.key)
+
+    def compile_asset(self, key, minify=True, cache=None, fingerprint=None):
+        """
+        Compile a single asset entry point of this theme, returning the path
+        of the compiled file.
+
+        If a ``BuildCache`` is supplied and the asset's inputs have not changed
+        since it was last compiled, compilation is skipped and only the map
+        file is rewritten. The asset's ``fingerprint`` will be computed if it
+        is not supplied.
+        """
+        asset = self.stacked_assets[key]
+        output_dir = self.compiled_asset_dir
+
+        if cache:
+            if fingerprint is None:
+                fingerprint = cache.fingerprint(self, asset, minify)
+            file_name = cache.lookup(self, key, fingerprint)
+            if file_name:
+                log.info('Unchanged, skipping: %s/%s', self.key, key)
+                file_path = os.path.join(output_dir, file_name)
+                asset.write_compressed(file_path)
+                asset.write_map(key, file_name, output_dir)
+                return file_path
+
+        file_path = asset.compile(key=key,
+                                  theme=self,
+                                  output_dir=output_dir,
+                                  minify=minify)
+        if cache:
+            cache.record(self, key, fingerprint, file_path)
+        return file_path
+
+    def link_compiled_asset(self, key, source_path):
+        """
+        Use an identical asset which has already been compiled (generally for
+        another theme) as the compiled result for ``key``, by hard-linking it
+        into this theme's compiled asset directory, and writing the map file.
+        """
+        output_dir = self.compiled_asset_dir
+        file_name = os.path.basename(source_path)
+        file_path = os.path.join(output_dir, file_name)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        asset = self.stacked_assets[key]
+        for path in [source_path] + asset.sidecar_paths(source_path):
+            link_file(path, os.path.join(output_dir, os.path.basename(path)))
+        asset.write_compressed(file_path)
+        asset.write_map(key, file_name, output_dir)
+        return file_path
+
+    def compile(self, minify=True, cache=None):
+        for key in self.stacked_assets:
+            self.compile_asset(key, minify=minify, cache=cache)
 
 
 def add_theme(config, cls):
@@ -211,6 +297,10 @@ def add_theme(config, cls):
     for chain in theme.stacked_image_filters:
         config.add_image_filter(chain, with_theme=theme)
 
+    # Load the compiled asset manifest now, rather than on the first request.
+    if asbool(settings.get('pyramid_frontend.compile')):
+        theme.use_manifest(load_manifest(manifest_path(settings)))
+
     def register(theme):
         themes = settings.setdefault('pyramid_frontend.theme_registry', {})
         themes[theme.key] = theme
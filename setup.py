@@ -1,7 +1,9 @@
 from __future__ import print_function
 
 import os
+import sys
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py as _build_py
 from distutils.command.build import build as _build
 
 
@@ -35,8 +37,23 @@ class build(_build):
                 print(fpath)
 
 
+# Modules which use syntax or APIs that are only available on newer versions
+# of Python, and so are left out of installs on older ones.
+version_modules = {
+    ('pyramid_frontend.images', 'aio'): (3, 7),
+}
+
+
+class build_py(_build_py):
+    def find_package_modules(self, package, package_dir):
+        modules = _build_py.find_package_modules(self, package, package_dir)
+        return [(pkg, module, path) for pkg, module, path in modules
+                if sys.version_info >= version_modules.get((pkg, module),
+                                                           (0,))]
+
+
 setup(name='pyramid_frontend',
-      cmdclass={'build': build},
+      cmdclass={'build': build, 'build_py': build_py},
       version='0.4.2.dev',
       description='Themes, image filtering, and frontend asset handling.',
       long_description='',
@@ -74,4 +91,5 @@ setup(name='pyramid_frontend',
       entry_points="""\
       [console_scripts]
       pcompile = pyramid_frontend.compile:main
+      pimages = pyramid_frontend.images.commands:main
       """)